@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Measure the speedup of the parallel transformation of big batches.
+
+A synthetic AimsApplyTransform (a CPU-bound Python script that applies an
+affine transformation to every point) is put first on the PATH, and a batch
+of points is transformed with an increasing number of parallel workers
+(TRANSFORM_PARALLEL_WORKERS), up to the number of CPUs.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import hbp_spatial_backend
+from hbp_spatial_backend import apply_transform
+
+from common import install_synthetic_aims
+
+
+NUM_POINTS = 400000
+CHUNK_SIZE = 25000
+
+
+def time_transform(config, source_points):
+    app = hbp_spatial_backend.create_app(dict(config, TESTING=True))
+    with app.app_context():
+        time_before = time.perf_counter()
+        target_points = apply_transform.transform_points(source_points, [])
+        elapsed_time = time.perf_counter() - time_before
+    assert len(target_points) == len(source_points)
+    return elapsed_time
+
+
+def main(argv):
+    source_points = np.random.RandomState(0).uniform(-100, 100,
+                                                     size=(NUM_POINTS, 3))
+    with tempfile.TemporaryDirectory() as bin_dir:
+        install_synthetic_aims(bin_dir)
+
+        single_time = time_transform({}, source_points)
+        print('{0} points, {1} CPUs'.format(NUM_POINTS, os.cpu_count()))
+        print('{0:>8} {1:>10} {2:>8}'.format('workers', 'time (s)',
+                                             'speedup'))
+        print('{0:>8} {1:>10.3f} {2:>7.2f}x'.format('single', single_time,
+                                                    1))
+        num_workers = 1
+        while True:
+            elapsed_time = time_transform({
+                'TRANSFORM_PARALLEL_THRESHOLD': CHUNK_SIZE,
+                'TRANSFORM_CHUNK_SIZE': CHUNK_SIZE,
+                'TRANSFORM_PARALLEL_WORKERS': num_workers,
+            }, source_points)
+            print('{0:>8} {1:>10.3f} {2:>7.2f}x'.format(
+                num_workers, elapsed_time, single_time / elapsed_time))
+            if num_workers >= os.cpu_count():
+                break
+            num_workers = min(2 * num_workers, os.cpu_count())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
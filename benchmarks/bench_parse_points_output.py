@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Compare the line-by-line and bulk parsers of AimsApplyTransform output.
+
+The reference path is parse_points_output (one regular expression match and
+three float conversions per line, collected into an N×3 array), the bulk path
+is parse_points_output_array.
+"""
+
+import io
+import sys
+
+import numpy as np
+
+from hbp_spatial_backend.apply_transform import (
+    parse_points_output,
+    parse_points_output_array,
+)
+
+from common import best_time
+
+
+def reference_path(stdout_str):
+    return np.array(list(parse_points_output(io.StringIO(stdout_str))),
+                    dtype=np.float64).reshape(-1, 3)
+
+
+def bulk_path(stdout_str):
+    return parse_points_output_array(stdout_str)
+
+
+def main(argv):
+    print('{0:>9} {1:>14} {2:>14} {3:>8}'.format(
+        'points', 'reference (s)', 'bulk (s)', 'speedup'))
+    for num_points in (10**3, 10**5, 10**6):
+        points = np.random.RandomState(0).uniform(-100, 100,
+                                                  size=(num_points, 3))
+        # AIMS prints a few messages along with the points
+        stdout_str = ('Warning: some message\n'
+                      + ''.join('({0!r}, {1!r}, {2!r})\n'.format(*p)
+                                for p in points.tolist()))
+        repeat = 5 if num_points < 10**6 else 1
+        assert np.array_equal(reference_path(stdout_str),
+                              bulk_path(stdout_str))
+        reference_time = best_time(reference_path, stdout_str, repeat)
+        bulk_time = best_time(bulk_path, stdout_str, repeat)
+        print('{0:>9} {1:>14.4f} {2:>14.4f} {3:>7.1f}x'.format(
+            num_points, reference_time, bulk_time,
+            reference_time / bulk_time))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Compare the validation and serialization paths of /v1/transform-points.
+
+The reference path validates every coordinate with marshmallow and
+serializes the response through TransformPointsResponseSchema, the fast path
+is the one that is used by the API (PointsField and _dumps_json).
+"""
+
+import json
+import sys
+
+from marshmallow import Schema, fields
+from marshmallow.validate import Length
+import numpy as np
+
+from hbp_spatial_backend import api_v1
+
+from common import best_time
+
+
+class ReferenceRequestSchema(Schema):
+    source_space = fields.Str(required=True)
+    target_space = fields.Str(required=True)
+    source_points = fields.List(
+        fields.List(fields.Float, validate=Length(equal=3)),
+        required=True,
+    )
+
+
+def reference_path(request_data):
+    args = ReferenceRequestSchema().load(request_data)
+    response_data = api_v1.TransformPointsResponseSchema().dump({
+        'target_points': args['source_points'],
+    })
+    return json.dumps(response_data).encode('utf-8')
+
+
+def fast_path(request_data):
+    args = api_v1.TransformPointsRequestSchema().load(request_data)
+    return api_v1._dumps_json({'target_points': args['source_points']})
+
+
+def main(argv):
+    print('{0:>9} {1:>14} {2:>14} {3:>8}'.format(
+        'points', 'reference (s)', 'fast (s)', 'speedup'))
+    for num_points in (10**3, 10**5, 10**6):
+        points = np.random.RandomState(0).uniform(-100, 100,
+                                                  size=(num_points, 3))
+        request_data = {
+            'source_space': 'A',
+            'target_space': 'B',
+            'source_points': points.tolist(),
+        }
+        repeat = 5 if num_points < 10**6 else 1
+        assert (json.loads(reference_path(request_data))
+                == json.loads(fast_path(request_data)))
+        reference_time = best_time(reference_path, request_data, repeat)
+        fast_time = best_time(fast_path, request_data, repeat)
+        print('{0:>9} {1:>14.4f} {2:>14.4f} {3:>7.1f}x'.format(
+            num_points, reference_time, fast_time,
+            reference_time / fast_time))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Compare the size and encoding time of /v1/transform-points responses.
+
+The responses are encoded as JSON or raw float32, with or without rounding
+(the precision option), and compressed with every content coding that is
+available (see hbp_spatial_backend.compression).
+"""
+
+import sys
+
+import numpy as np
+
+from hbp_spatial_backend import api_v1
+from hbp_spatial_backend import compression
+from hbp_spatial_backend import point_io
+
+from common import best_time
+
+
+FORMATS = ('json', 'float32')
+PRECISIONS = (None, 3)
+
+
+def encode(points, fmt, precision, encoding):
+    """Encode points in the same way as api_v1._make_points_response."""
+    if precision is not None:
+        points = np.round(points, precision)
+    if fmt == 'json':
+        data = api_v1._dumps_json({'target_points': points})
+    else:
+        data = point_io.points_to_buffer(
+            points, point_io.OCTET_STREAM_MIMETYPE, dtype=fmt)
+    if encoding != 'identity':
+        data = compression.compress(data, encoding)
+    return data
+
+
+def encodings():
+    return ('identity',) + tuple(reversed(compression.available_encodings()))
+
+
+def main(argv):
+    num_points = 10**5
+    # Transformed coordinates have a full-precision mantissa
+    points = np.random.RandomState(0).uniform(-100, 100,
+                                              size=(num_points, 3))
+    print('{0} points'.format(num_points))
+    print('{0:>8} {1:>9} {2:>9} {3:>11} {4:>10}'.format(
+        'format', 'precision', 'encoding', 'size (kB)', 'time (s)'))
+    for fmt in FORMATS:
+        for precision in PRECISIONS:
+            for encoding in encodings():
+                data = encode(points, fmt, precision, encoding)
+                elapsed_time = best_time(
+                    lambda p: encode(p, fmt, precision, encoding), points, 3)
+                print('{0:>8} {1!s:>9} {2:>9} {3:>11.1f} {4:>10.4f}'.format(
+                    fmt, precision, encoding, len(data) / 1000,
+                    elapsed_time))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,137 @@
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Helpers that are shared by the benchmark scripts.
+
+The benchmarks run offline: AimsApplyTransform is replaced by a synthetic
+script, and the transform graphs and displacement fields are generated.
+"""
+
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+from hbp_spatial_backend import numpy_transform
+
+
+# Stand-in for AimsApplyTransform, a CPU-bound Python script that applies an
+# affine transformation to every point (the transformations of the command
+# line are ignored).
+SYNTHETIC_AIMS_APPLY_TRANSFORM = '''\
+#!{python}
+import sys
+matrix = [[0.9, 0.1, 0.0, 1.0], [-0.1, 0.9, 0.0, 2.0], [0.0, 0.0, 1.1, 3.0]]
+for line in sys.stdin:
+    point = [float(c) for c in line.strip('()\\n').split(',')] + [1.0]
+    x, y, z = (sum(m * p for m, p in zip(row, point)) for row in matrix)
+    print('({{0!r}}, {{1!r}}, {{2!r}})'.format(x, y, z))
+'''
+
+
+def best_time(func, arg, repeat):
+    times = []
+    for _ in range(repeat):
+        time_before = time.perf_counter()
+        func(arg)
+        times.append(time.perf_counter() - time_before)
+    return min(times)
+
+
+def time_calls(func, repeat):
+    """Call func() repeat times, return the list of the durations."""
+    times = []
+    for _ in range(repeat):
+        time_before = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - time_before)
+    return times
+
+
+def summarize_times(times):
+    """Summarize a list of durations (in seconds) as a dictionary."""
+    sorted_times = sorted(times)
+    return {
+        'repeat': len(times),
+        'min': sorted_times[0],
+        'median': statistics.median(sorted_times),
+        'p95': sorted_times[min(len(times) - 1,
+                                int(round(0.95 * (len(times) - 1))))],
+        'max': sorted_times[-1],
+    }
+
+
+def install_synthetic_aims(bin_dir):
+    """Put the synthetic AimsApplyTransform first on the PATH."""
+    path = os.path.join(bin_dir, 'AimsApplyTransform')
+    with open(path, 'w') as f:
+        f.write(SYNTHETIC_AIMS_APPLY_TRANSFORM.format(python=sys.executable))
+    os.chmod(path, 0o755)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+    return path
+
+
+def write_synthetic_transforms(directory, field_shape=(64, 80, 64)):
+    """Write a graph.yaml that links space A to space B through a field.
+
+    The chain from A to B is an affine transformation, a displacement field,
+    and another affine transformation, the chain from B to A is the affine
+    inverse of the first one. Returns the path to graph.yaml.
+    """
+    rng = np.random.RandomState(0)
+    matrix = np.eye(4)
+    matrix[:3, :3] += rng.uniform(-0.05, 0.05, size=(3, 3))
+    matrix[:3, 3] = (-32, -40, -32)
+    numpy_transform.write_trm(os.path.join(directory, 'to_field.trm'),
+                              matrix)
+    numpy_transform.write_trm(os.path.join(directory, 'from_field.trm'),
+                              np.linalg.inv(matrix))
+    size_x, size_y, size_z = field_shape
+    field = rng.normal(scale=0.5, size=(size_z, size_y, size_x, 3))
+    numpy_transform.write_gis_field(os.path.join(directory, 'field.ima'),
+                                    field.astype(np.float32), (1, 1, 1))
+    path = os.path.join(directory, 'graph.yaml')
+    with open(path, 'w') as f:
+        f.write('A:\n'
+                '  B: [to_field.trm, field.ima, from_field.trm]\n'
+                'B:\n'
+                '  A: inv:to_field.trm\n')
+    return path
+
+
+def make_synthetic_graph_yaml(num_spaces, extra_links_per_space=2, seed=0):
+    """Generate the YAML text of a graph with num_spaces spaces.
+
+    The spaces form a bidirectional chain, with random additional links.
+    """
+    rng = np.random.RandomState(seed)
+    names = ['Space {0:04d}'.format(i) for i in range(num_spaces)]
+    links = {name: {} for name in names}
+    for i in range(num_spaces - 1):
+        links[names[i]][names[i + 1]] = 'link{0}.trm'.format(i)
+        links[names[i + 1]][names[i]] = 'inv:link{0}.trm'.format(i)
+    for i in range(num_spaces):
+        for j in rng.randint(num_spaces, size=extra_links_per_space):
+            if j != i and names[j] not in links[names[i]]:
+                links[names[i]][names[j]] = 'shortcut{0}-{1}.ima'.format(i, j)
+    lines = []
+    for source, targets in links.items():
+        lines.append('{0}:\n'.format(source))
+        lines.extend('  {0}: {1}\n'.format(target, transform)
+                     for target, transform in targets.items())
+    return ''.join(lines)
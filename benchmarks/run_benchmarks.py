@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+
+"""Run the benchmark suite and write the results as JSON.
+
+The suite runs offline, with a synthetic AimsApplyTransform and generated
+transform graphs and fields. It measures:
+
+- graph_yaml_load: TransformGraph.from_yaml (which also computes the table
+  of transform chains) on graphs of hundreds of spaces;
+- graph_get_transform_chain: TransformGraph.get_transform_chain on the same
+  graphs (time per lookup);
+- json_validation: validation of a /v1/transform-points request and
+  serialization of its response, through marshmallow alone (reference) and
+  through the fast path of the API (see bench_point_validation.py);
+- parse_points_output: parsing of the output of AimsApplyTransform (see
+  bench_parse_points_output.py);
+- single_point_latency: /v1/transform-point requests with each engine;
+- batch_throughput: /v1/transform-points requests of various sizes with each
+  engine;
+- response_encoding: encoding of /v1/transform-points responses with each
+  precision and content coding (see bench_response_encoding.py), with the
+  size of the encoded response.
+
+The requests go through the Flask test client, so the network and the WSGI
+server are not measured. Every result holds the statistics of the measured
+durations in seconds (min, median, p95, max). Compare two result files with
+--baseline to spot regressions between versions.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import hbp_spatial_backend
+from hbp_spatial_backend import api_v1
+from hbp_spatial_backend import apply_transform
+from hbp_spatial_backend.transform_graph import TransformGraph
+
+import bench_parse_points_output
+import bench_point_validation
+import bench_response_encoding
+from common import (
+    install_synthetic_aims,
+    make_synthetic_graph_yaml,
+    summarize_times,
+    time_calls,
+    write_synthetic_transforms,
+)
+
+
+ENGINES = ('numpy', 'subprocess')
+
+
+def result(benchmark, params, times, **extra):
+    res = {'benchmark': benchmark, 'params': params}
+    res.update(summarize_times(times))
+    res.update(extra)
+    return res
+
+
+def bench_graph(sizes, repeat):
+    for num_spaces in sizes:
+        yaml_text = make_synthetic_graph_yaml(num_spaces)
+        times = time_calls(
+            lambda: TransformGraph.from_yaml(io.StringIO(yaml_text)), repeat)
+        yield result('graph_yaml_load', {'spaces': num_spaces}, times)
+
+        tg = TransformGraph.from_yaml(io.StringIO(yaml_text))
+        spaces = list(tg.links)
+        rng = random.Random(0)
+        pairs = [(rng.choice(spaces), rng.choice(spaces))
+                 for _ in range(1000)]
+
+        def lookups():
+            for source_space, target_space in pairs:
+                tg.get_transform_chain(source_space, target_space)
+        times = [t / len(pairs) for t in time_calls(lookups, repeat)]
+        yield result('graph_get_transform_chain', {'spaces': num_spaces},
+                     times)
+
+
+def bench_json_validation(sizes, repeat):
+    for num_points in sizes:
+        points = np.random.RandomState(0).uniform(-100, 100,
+                                                  size=(num_points, 3))
+        request_data = {
+            'source_space': 'A',
+            'target_space': 'B',
+            'source_points': points.tolist(),
+        }
+        for path in ('reference', 'fast'):
+            func = getattr(bench_point_validation, path + '_path')
+            times = time_calls(lambda: func(request_data), repeat)
+            yield result('json_validation',
+                         {'path': path, 'points': num_points}, times)
+
+
+def bench_parse_output(sizes, repeat):
+    for num_points in sizes:
+        points = np.random.RandomState(0).uniform(-100, 100,
+                                                  size=(num_points, 3))
+        stdout_str = ''.join('({0!r}, {1!r}, {2!r})\n'.format(*p)
+                             for p in points.tolist())
+        for path in ('reference', 'bulk'):
+            func = getattr(bench_parse_points_output, path + '_path')
+            times = time_calls(lambda: func(stdout_str), repeat)
+            yield result('parse_points_output',
+                         {'path': path, 'points': num_points}, times)
+
+
+def bench_encoding(sizes, repeat):
+    for num_points in sizes:
+        points = np.random.RandomState(0).uniform(-100, 100,
+                                                  size=(num_points, 3))
+        for fmt in bench_response_encoding.FORMATS:
+            for precision in bench_response_encoding.PRECISIONS:
+                for encoding in bench_response_encoding.encodings():
+                    def encode():
+                        return bench_response_encoding.encode(
+                            points, fmt, precision, encoding)
+                    size = len(encode())
+                    times = time_calls(encode, repeat)
+                    yield result('response_encoding',
+                                 {'format': fmt, 'precision': precision,
+                                  'encoding': encoding,
+                                  'points': num_points},
+                                 times, bytes=size)
+
+
+def make_app(graph_yaml, engine):
+    return hbp_spatial_backend.create_app({
+        'TESTING': True,
+        'DEFAULT_TRANSFORM_GRAPH': graph_yaml,
+        'TRANSFORM_ENGINE': engine,
+    })
+
+
+def bench_single_point(graph_yaml, repeat):
+    query_string = {'source_space': 'A', 'target_space': 'B',
+                    'x': 1.0, 'y': 2.0, 'z': 3.0}
+    for engine in ENGINES:
+        app = make_app(graph_yaml, engine)
+        with app.test_client() as client:
+            def request():
+                response = client.get('/v1/transform-point',
+                                      query_string=query_string)
+                assert response.status_code == 200
+            request()  # load the graph
+            times = time_calls(request, repeat)
+        yield result('single_point_latency', {'engine': engine}, times)
+
+
+def bench_batch(graph_yaml, sizes, repeat):
+    for engine in ENGINES:
+        app = make_app(graph_yaml, engine)
+        with app.test_client() as client:
+            for num_points in sizes:
+                points = np.random.RandomState(0).uniform(
+                    -60, 60, size=(num_points, 3)).tolist()
+
+                def request():
+                    response = client.post('/v1/transform-points', json={
+                        'source_space': 'A',
+                        'target_space': 'B',
+                        'source_points': points,
+                    })
+                    assert response.status_code == 200
+                request()
+                times = time_calls(request, repeat)
+                yield result('batch_throughput',
+                             {'engine': engine, 'points': num_points},
+                             times,
+                             points_per_second=num_points / min(times))
+
+
+def run_suite(quick=False, selected=None):
+    repeat = 3 if quick else 10
+    benchmarks = {
+        'graph': lambda: bench_graph(
+            (100, 300) if quick else (100, 300, 1000), repeat),
+        'json_validation': lambda: bench_json_validation(
+            (10**3, 10**4) if quick else (10**3, 10**5), repeat),
+        'parse_points_output': lambda: bench_parse_output(
+            (10**3, 10**4) if quick else (10**3, 10**5), repeat),
+        'single_point': lambda: bench_single_point(
+            graph_yaml, 10 if quick else 50),
+        'batch': lambda: bench_batch(
+            graph_yaml,
+            (10, 10**3, 10**4) if quick else (10, 10**3, 10**4, 10**5),
+            repeat),
+        'response_encoding': lambda: bench_encoding(
+            (10**4,) if quick else (10**5,), repeat),
+    }
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bin_dir = os.path.join(tmp_dir, 'bin')
+        os.mkdir(bin_dir)
+        install_synthetic_aims(bin_dir)
+        graph_yaml = write_synthetic_transforms(tmp_dir)
+        try:
+            for name, bench in benchmarks.items():
+                if selected and name not in selected:
+                    continue
+                for res in bench():
+                    print('{benchmark} {params}: {median:.3g} s'.format(**res),
+                          file=sys.stderr)
+                    results.append(res)
+        finally:
+            api_v1.clear_transform_graph_cache()
+            apply_transform.clear_folded_chains_cache()
+    return {
+        'version': hbp_spatial_backend.__version__,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'quick': quick,
+        'results': results,
+    }
+
+
+def compare(report, baseline):
+    """Print the ratio of the median times to those of a baseline report."""
+    def key(res):
+        return (res['benchmark'], json.dumps(res['params'], sort_keys=True))
+    baseline_results = {key(res): res for res in baseline['results']}
+    print('{0:<28} {1:<40} {2:>8}'.format('benchmark', 'params', 'ratio'),
+          file=sys.stderr)
+    for res in report['results']:
+        base = baseline_results.get(key(res))
+        if base is None:
+            continue
+        print('{0:<28} {1:<40} {2:>7.2f}x'.format(
+            res['benchmark'], key(res)[1], res['median'] / base['median']),
+            file=sys.stderr)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='Run the benchmark suite of hbp-spatial-backend.')
+    parser.add_argument(
+        '-o', '--output',
+        help='Write the results to this JSON file (default: standard output)')
+    parser.add_argument(
+        '--quick', action='store_true',
+        help='Use smaller sizes and fewer repetitions')
+    parser.add_argument(
+        '--only', action='append', metavar='NAME',
+        choices=['graph', 'json_validation', 'parse_points_output',
+                 'single_point', 'batch', 'response_encoding'],
+        help='Only run this group of benchmarks (can be repeated)')
+    parser.add_argument(
+        '--baseline', metavar='FILE',
+        help='Compare the median times to those of a previous result file '
+             '(ratios above 1 are slowdowns)')
+    return parser.parse_args(argv[1:])
+
+
+def main(argv):
+    args = parse_args(argv)
+    report = run_suite(quick=args.quick, selected=args.only)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(report, json.load(f))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Precompute the composed displacement field of a transform chain.
+
+Example, for a box that covers MNI152 with a 1 mm grid::
+
+    ./compose_transform_chain.py -g /instance/graph.yaml \
+        -s 'MNI 152 ICBM 2009c Nonlinear Asymmetric' \
+        -t 'Big Brain (Histology)' \
+        --origin -98 -134 -72 --shape 197 233 189 --voxel_size 1 1 1 \
+        -o /instance/composed/MNI152-to-BigBrain
+
+See hbp_spatial_backend.compose_field for details.
+"""
+
+import sys
+
+from hbp_spatial_backend.compose_field import main
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -44,6 +44,114 @@ class DefaultConfig:
     # cancelling the request. This is useful if running behind a reverse proxy
     # that has its own timeout anyway
     REQUEST_TIMEOUT = None
+    # Opt-in limit on the number of AimsApplyTransform processes that can run
+    # concurrently in each server process (None, the default, means no
+    # limit). When set, requests wait for a free slot, and the waiting counts
+    # towards REQUEST_TIMEOUT.
+    MAX_CONCURRENT_SUBPROCESSES = None
+    # Engine used for transforming points: 'subprocess' runs
+    # AimsApplyTransform for every request, 'numpy' applies the
+    # transformations in-process (see hbp_spatial_backend.numpy_transform)
+    # and falls back to AimsApplyTransform for unsupported transformations.
+    TRANSFORM_ENGINE = 'subprocess'
+    # Number of points that are read, transformed, and written at a time by
+    # the streaming endpoint (/v1/transform-points-stream)
+    STREAM_CHUNK_SIZE = 10000
+    # Batches of at least this many points are split into chunks of
+    # TRANSFORM_CHUNK_SIZE points, which are transformed in parallel (e.g. by
+    # several AimsApplyTransform processes) and then reassembled in order.
+    # None disables the splitting.
+    TRANSFORM_PARALLEL_THRESHOLD = None
+    TRANSFORM_CHUNK_SIZE = 50000
+    # Maximum number of chunks that are transformed concurrently in each
+    # server process (None means the number of CPUs). The number of
+    # AimsApplyTransform processes is still limited by
+    # MAX_CONCURRENT_SUBPROCESSES.
+    TRANSFORM_PARALLEL_WORKERS = None
+    # Set to True to compose the runs of consecutive affine transformations
+    # (.trm files) of each transform chain into a single .trm file, which is
+    # written to FOLDED_TRANSFORMS_DIR (default: folded-transforms in the
+    # instance folder). The chains are folded when the transform graph is
+    # loaded, and the folded chains are used for transforming points. The
+    # commands returned by the get-*-transform-command endpoints always use
+    # the original chains, because the composed files only exist on the
+    # server.
+    FOLD_AFFINE_TRANSFORMS = False
+    FOLDED_TRANSFORMS_DIR = None
+    # Maximum number of transformed points that are cached (0 disables the
+    # cache)
+    POINT_CACHE_SIZE = 0
+    # Storage of the point cache: 'memory' keeps a separate cache in each
+    # server process, 'sqlite' uses a SQLite database file that is shared by
+    # all the server processes (see POINT_CACHE_PATH)
+    POINT_CACHE_BACKEND = 'memory'
+    # Path to the database of the 'sqlite' point cache backend, which should
+    # be on a local filesystem (default: point-cache.sqlite3 in the instance
+    # folder)
+    POINT_CACHE_PATH = None
+    # Time, in seconds, after which a cached point expires (None means never)
+    POINT_CACHE_TTL = 86400
+    # Number of decimal places of the source coordinates (in millimetres) that
+    # are taken into account for looking up points in the cache
+    POINT_CACHE_PRECISION = 6
+    # Set to True to coalesce the concurrent transformations of the same
+    # points along the same chain within each server process: the first
+    # request runs the transformation, and the identical requests that
+    # arrive while it is in flight wait for its result (see
+    # hbp_spatial_backend.single_flight)
+    COALESCE_TRANSFORMATIONS = False
+    # Time, in seconds, for which the concurrent requests of
+    # /v1/transform-point that use the same transform chain are collected,
+    # so that their points are transformed in a single call (e.g. 0.003).
+    # A batch is run early if it reaches MICRO_BATCH_MAX_SIZE points. None
+    # disables micro-batching, which is only useful if the server processes
+    # handle concurrent requests (e.g. with gevent workers), see
+    # hbp_spatial_backend.micro_batch.
+    MICRO_BATCH_WINDOW = None
+    MICRO_BATCH_MAX_SIZE = 100
+    # Set to True to compress the responses of /v1/transform-points
+    # according to the Accept-Encoding header of the request (see
+    # hbp_spatial_backend.compression), if they are at least
+    # COMPRESS_MIN_SIZE bytes long. Leave it disabled if a reverse proxy
+    # already compresses the responses.
+    COMPRESS_RESPONSES = False
+    COMPRESS_MIN_SIZE = 1024
+    # Maximum size, in bytes, of the store of the results of
+    # /v1/transform-points (0 disables the store). The results are stored in
+    # RESULT_STORE_DIR (default: results in the instance folder), which can
+    # be shared by all the server processes. Each response then has a
+    # Location header with an immutable GET URL of the result, which can be
+    # cached by a reverse proxy (see hbp_spatial_backend.result_store).
+    RESULT_STORE_SIZE = 0
+    RESULT_STORE_DIR = None
+    # Set to True to warm up each server process before it reports itself as
+    # ready on /health: the transform graph is loaded and every transform
+    # file is read into the page cache (see hbp_spatial_backend.warmup).
+    # Until the warm-up has completed, /health returns 503, and it keeps
+    # returning 503 if the warm-up fails. Under gunicorn, pass
+    # --config=python:hbp_spatial_backend.gunicorn_config so that every
+    # worker is warmed up as soon as it has started.
+    WARM_UP = False
+    # Set to True to also transform a canary point between every pair of
+    # spaces during the warm-up
+    WARM_UP_CANARY = False
+    # Set to True to enable the /stats endpoint, which reports statistics
+    # such as the hit rate of the point cache, or the memory used by the
+    # displacement fields
+    ENABLE_STATS = False
+    # Set to True to expose metrics in the Prometheus format on /metrics:
+    # request counts and latencies per endpoint and per pair of spaces, time
+    # spent in each stage of the requests, batch sizes, and requests in
+    # progress. This needs the prometheus_client package (see
+    # hbp_spatial_backend.metrics for running under Gunicorn).
+    ENABLE_METRICS = False
+    # Set to True to allow clients to profile individual requests, by
+    # sending the X-Profile header or the profile query parameter. The
+    # profiles are written to PROFILING_DIR (default: profiles in the
+    # instance folder), see hbp_spatial_backend.profiling. Do not enable
+    # this on a public instance.
+    ENABLE_PROFILING = False
+    PROFILING_DIR = None
     # Set up werkzeug.middleware.proxy_fix.ProxyFix with the provided keyword
     # arguments, see
     # https://werkzeug.palletsprojects.com/en/0.15.x/middleware/proxy_fix/
@@ -151,8 +259,47 @@ def create_app(test_config=None):
     # health checks.
     @app.route("/health")
     def health():
+        if app.config.get('WARM_UP'):
+            from . import warmup
+            if not warmup.is_ready(app):
+                error = warmup.get_error(app)
+                if error is not None:
+                    return 'warm-up failed: {0}'.format(error), 503
+                return 'warming up', 503
         return '', 200
 
+    if app.config.get('WARM_UP'):
+        from . import warmup
+        warmup.init_app(app)
+
+    if app.config.get('ENABLE_STATS'):
+        @app.route('/stats')
+        def stats():
+            from . import apply_transform
+            from . import field_store
+            from . import result_store
+            cache = apply_transform.get_point_cache()
+            store = result_store.get_result_store()
+            coalescer = apply_transform.get_single_flight()
+            batcher = apply_transform.get_micro_batcher()
+            return flask.jsonify({
+                'point_cache': cache.stats() if cache is not None else None,
+                'field_store': field_store.default_store.stats(),
+                'result_store': store.stats() if store is not None else None,
+                'single_flight': (coalescer.stats() if coalescer is not None
+                                  else None),
+                'micro_batcher': (batcher.stats() if batcher is not None
+                                  else None),
+            })
+
+    if app.config.get('ENABLE_METRICS'):
+        from . import metrics
+        metrics.init_app(app)
+
+    if app.config.get('ENABLE_PROFILING'):
+        from . import profiling
+        profiling.init_app(app)
+
     if app.config.get('ENABLE_ECHO'):
         @app.route('/echo')
         def echo():
@@ -14,8 +14,14 @@
 # See the Licence for the specific language governing permissions and
 # limitations under the Licence.
 
+import functools
+import hashlib
+import itertools
+import json
 import logging
+import os
 import os.path
+import threading
 
 import flask
 from flask import current_app, g, jsonify
@@ -23,9 +29,21 @@ import flask_smorest
 from flask_smorest import abort
 import marshmallow
 from marshmallow import Schema, fields
-from marshmallow.validate import Length
+from marshmallow.validate import Length, OneOf, Range
+import numpy as np
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from hbp_spatial_backend import apply_transform
+from hbp_spatial_backend import compression
+from hbp_spatial_backend import field_store
+from hbp_spatial_backend import file_digests
+from hbp_spatial_backend import metrics
+from hbp_spatial_backend import numpy_transform
+from hbp_spatial_backend import point_io
+from hbp_spatial_backend import result_store
 from hbp_spatial_backend.transform_graph import TransformGraph
 
 logger = logging.getLogger(__name__)
@@ -50,15 +68,110 @@ which are used within this API:
 )
 
 
+# Process-wide cache of the parsed transform graphs, indexed by path. Each
+# entry is a (file_identity, TransformGraph) tuple, see
+# file_digests.file_identity.
+_transform_graph_cache = {}
+_transform_graph_cache_lock = threading.Lock()
+
+
+def load_transform_graph(tg_path):
+    """Get the TransformGraph stored in a YAML file.
+
+    The parsed graph is cached for the lifetime of the process, and is
+    re-loaded when the file is modified or replaced.
+    """
+    identity = file_digests.file_identity(tg_path)
+    with _transform_graph_cache_lock:
+        cached = _transform_graph_cache.get(tg_path)
+    if cached is not None and cached[0] == identity:
+        return cached[1]
+    logger.info('Loading the transform graph from %s', tg_path)
+    with open(tg_path, 'rb') as f:
+        tg = TransformGraph.from_yaml(f)
+    # The transformations may have changed along with the graph
+    apply_transform.clear_folded_chains_cache()
+    if current_app.config['FOLD_AFFINE_TRANSFORMS']:
+        cwd = os.path.dirname(tg_path)
+        for transform_chain in tg.get_chain_table().values():
+            apply_transform.fold_transform_chain(transform_chain, cwd=cwd)
+    _map_displacement_fields(tg, os.path.dirname(tg_path))
+    with _transform_graph_cache_lock:
+        _transform_graph_cache[tg_path] = (identity, tg)
+    return tg
+
+
+def _map_displacement_fields(tg, cwd):
+    """Memory-map every displacement field that is referenced by the graph.
+
+    This makes the fields show up in the statistics of the field store (see
+    hbp_spatial_backend.field_store), whichever engine is used.
+    """
+    paths = set()
+    for t in tg.iter_transforms():
+        if t.startswith(numpy_transform.INVERSE_PREFIX):
+            t = t[len(numpy_transform.INVERSE_PREFIX):]
+        if t.endswith('.ima'):
+            paths.add(os.path.join(cwd, t))
+    for path in sorted(paths):
+        try:
+            field_store.default_store.get(path)
+        except (OSError, ValueError) as exc:
+            logger.warning('Cannot memory-map displacement field %s: %s',
+                           path, exc)
+
+
+def clear_transform_graph_cache():
+    """Force the transform graphs to be re-loaded on their next use."""
+    with _transform_graph_cache_lock:
+        _transform_graph_cache.clear()
+    apply_transform.clear_folded_chains_cache()
+
+
 def _get_transform_graph():
     if 'transform_graph' not in g:
         tg_path = current_app.config['DEFAULT_TRANSFORM_GRAPH']
         g.transform_graph_cwd = os.path.dirname(tg_path)
-        with open(tg_path, 'rb') as f:
-            g.transform_graph = TransformGraph.from_yaml(f)
+        g.transform_graph = load_transform_graph(tg_path)
     return g.transform_graph
 
 
+def _chains_etag(*transform_chains):
+    """Compute the ETag of a response that depends on transform chains.
+
+    The ETag is derived from the contents of the transform graph and of the
+    files of the chains. Returns None if one of these files cannot be read.
+    """
+    tg_path = current_app.config['DEFAULT_TRANSFORM_GRAPH']
+    try:
+        digests = [file_digests.file_digest(tg_path)]
+        digests.extend(file_digests.chain_digest(transform_chain,
+                                                 cwd=os.path.dirname(tg_path))
+                       for transform_chain in transform_chains)
+    except OSError as exc:
+        logger.debug('Cannot compute the ETag: %s', exc)
+        return None
+    return hashlib.sha1(' '.join(digests).encode('ascii')).hexdigest()
+
+
+def _make_cacheable(response, etag=None):
+    if etag is not None:
+        response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 86400  # 1 day
+    return response
+
+
+def _not_modified_response(etag):
+    """Get a 304 response if the client already has this version.
+
+    Returns None if the response has to be computed.
+    """
+    if etag is None or not flask.request.if_none_match.contains_weak(etag):
+        return None
+    return _make_cacheable(flask.Response(status=304), etag)
+
+
 @bp.route('/graph.yaml')
 @bp.response()
 def get_graph_yaml():
@@ -68,11 +181,17 @@ def get_graph_yaml():
     which links the template spaces. **The format of this file is subject to
     change, this endpoint may be modified or removed at any time.**
     """
-    logger.info('default path to graph.yaml: %s',
-                current_app.config['DEFAULT_TRANSFORM_GRAPH'])
+    tg_path = current_app.config['DEFAULT_TRANSFORM_GRAPH']
+    logger.info('default path to graph.yaml: %s', tg_path)
     logger.info('instance path: %s', current_app.instance_path)
-    return flask.send_file(current_app.config['DEFAULT_TRANSFORM_GRAPH'],
-                           mimetype='text/x-yaml')
+    etag = file_digests.file_digest(tg_path)
+    if flask.request.if_none_match.contains_weak(etag):
+        response = flask.Response(status=304)
+    else:
+        response = flask.send_file(tg_path, mimetype='text/x-yaml',
+                                   add_etags=False)
+    response.set_etag(etag)
+    return response
 
 
 class TransformPointRequestSchema(Schema):
@@ -155,24 +274,76 @@ class ErrorResponseSchema(Schema):
              })
 def transform_point(args):
     """Transform a single point."""
+    metrics.record_stage_since_request_start('validation')
     source_point = (args['x'], args['y'], args['z'])
     source_space = args['source_space']
     target_space = args['target_space']
-
-    tg = _get_transform_graph()
-    try:
-        transform_chain = tg.get_transform_chain(source_space, target_space)
-    except KeyError:
-        abort(400, message='source_space or target_space not found')
+    with metrics.stage('graph_lookup'):
+        tg = _get_transform_graph()
+        try:
+            transform_chain = tg.get_transform_chain(source_space,
+                                                     target_space)
+        except KeyError:
+            abort(400, message='source_space or target_space not found')
+        metrics.observe_transform_request(source_space, target_space, 1)
+        shortcut = tg.get_shortcut(source_space, target_space)
+        etag = _chains_etag(transform_chain, shortcut)
+    response = _not_modified_response(etag)
+    if response is not None:
+        return response
     target_point = apply_transform.transform_point(
-        source_point, transform_chain, cwd=g.transform_graph_cwd)
+        source_point, transform_chain, cwd=g.transform_graph_cwd,
+        shortcut=shortcut)
+
+    with metrics.stage('serialization'):
+        response = jsonify(TransformPointResponseSchema().dump({
+            'target_point': target_point,
+        }))
+    return _make_cacheable(response, etag)
 
-    response = jsonify(TransformPointResponseSchema().dump({
-        'target_point': target_point,
-    }))
-    response.cache_control.public = True
-    response.cache_control.max_age = 86400  # 1 day
-    return response
+
+def _contains_bool(points):
+    return bool in set(map(type, itertools.chain.from_iterable(points)))
+
+
+class PointsField(fields.List):
+    """List of [x, y, z] points, deserialized to an N×3 array.
+
+    The fast path converts the whole list with NumPy and validates it in one
+    vectorized pass. Anything that does not pass this check goes through the
+    element-by-element validation of fields.List, which produces detailed
+    error messages. This field is documented like a list of lists of floats.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(fields.List(fields.Float, validate=Length(equal=3)),
+                         **kwargs)
+
+    def _deserialize(self, value, attr, data, **kwargs):
+        try:
+            # Without an explicit dtype, NumPy refuses ragged lists and keeps
+            # strings and booleans out of the numeric dtypes
+            array = np.array(value)
+        except (TypeError, ValueError):
+            array = None
+        if (array is not None and array.dtype.kind in 'iuf'
+                and (array.shape == (0,)
+                     or (array.ndim == 2 and array.shape[1] == 3))
+                # Booleans mixed with numbers are converted to numbers by
+                # NumPy, they are rejected by fields.Float
+                and not _contains_bool(value)):
+            array = array.astype(np.float64, copy=False).reshape(-1, 3)
+            if np.all(np.isfinite(array)):
+                return array
+        points = super()._deserialize(value, attr, data, **kwargs)
+        return np.array(points, dtype=np.float64).reshape(-1, 3)
+
+
+def _dumps_json(data):
+    """Serialize data (which may contain NumPy arrays) to JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(data, default=lambda a: a.tolist()).encode('utf-8')
 
 
 class TransformPointsRequestSchema(Schema):
@@ -187,8 +358,7 @@ class TransformPointsRequestSchema(Schema):
         required=True,
         metadata=dict(description='Identifier of the target template space.'),
     )
-    source_points = fields.List(
-        fields.List(fields.Float, validate=Length(equal=3)),
+    source_points = PointsField(
         required=True,
         metadata=dict(
             description='List of points to be transformed. Each point is a '
@@ -253,7 +423,198 @@ class GetTransformCommandResponseSchema(Schema):
     )
 
 
+class PointsOptionsSchema(Schema):
+    class Meta:
+        unknown = marshmallow.EXCLUDE
+
+    dtype = fields.Str(
+        load_default='float64',
+        validate=OneOf(sorted(point_io.DTYPES)),
+        metadata=dict(
+            description='Data type of the coordinates in the binary '
+                        'encodings of points (application/octet-stream).',
+        ),
+    )
+    precision = fields.Int(
+        load_default=None,
+        validate=Range(min=0, max=15),
+        metadata=dict(
+            description='Number of decimal places (in millimetres) to which '
+                        'the coordinates of the transformed points are '
+                        'rounded. This makes JSON responses smaller and '
+                        'faster to encode (AimsApplyTransform is accurate '
+                        'to about 6 significant digits). By default, the '
+                        'coordinates are not rounded.',
+        ),
+    )
+
+
+class TransformPointsQuerySchema(PointsOptionsSchema):
+    class Meta(PointsOptionsSchema.Meta):
+        ordered = True
+
+    source_space = fields.Str(
+        metadata=dict(
+            description='Identifier of the source template space, required '
+                        'with a binary request body (and ignored otherwise).',
+        ),
+    )
+    target_space = fields.Str(
+        metadata=dict(
+            description='Identifier of the target template space, required '
+                        'with a binary request body (and ignored otherwise).',
+        ),
+    )
+
+
+class TransformPointsBinaryQuerySchema(PointsOptionsSchema):
+    class Meta(PointsOptionsSchema.Meta):
+        ordered = True
+
+    source_space = fields.Str(
+        required=True,
+        metadata=dict(description='Identifier of the source template space.'),
+    )
+    target_space = fields.Str(
+        required=True,
+        metadata=dict(description='Identifier of the target template space.'),
+    )
+
+
+def _binary_points_request(view):
+    """Handle requests whose body contains points in a binary encoding.
+
+    The JSON parsing of the decorated view is bypassed for these requests,
+    the source and target spaces are passed in the query string instead. The
+    first argument of the view are the query arguments (see
+    TransformPointsQuerySchema). The binary encodings are added to the
+    documentation of the request body.
+    """
+    @functools.wraps(view)
+    def wrapper(query_args, *args, **kwargs):
+        mimetype = flask.request.mimetype
+        if mimetype not in point_io.BINARY_MIMETYPES:
+            return view(query_args, *args, **kwargs)
+        with metrics.stage('validation'):
+            missing_args = {
+                name: ['Missing data for required field.']
+                for name in ('source_space', 'target_space')
+                if name not in query_args
+            }
+            if missing_args:
+                abort(422, errors={'query': missing_args})
+            try:
+                source_points = point_io.parse_points_buffer(
+                    flask.request.get_data(), mimetype,
+                    dtype=query_args['dtype'])
+            except ValueError as exc:
+                abort(422, message=str(exc))
+        target_points, result_key = _transform_points(
+            query_args['source_space'], query_args['target_space'],
+            source_points)
+        return _make_points_response(target_points, query_args,
+                                     result_key=result_key)
+    return bp.doc(requestBody={'content': {
+        binary_mimetype: {'schema': {'type': 'string', 'format': 'binary'}}
+        for binary_mimetype in point_io.BINARY_MIMETYPES
+    }})(wrapper)
+
+
+def _negotiate_points_mimetype():
+    return flask.request.accept_mimetypes.best_match(
+        ('application/json',) + point_io.BINARY_MIMETYPES,
+        default='application/json')
+
+
+def _negotiate_content_encoding():
+    """Choose the compression of the response (None for no compression)."""
+    if not current_app.config['COMPRESS_RESPONSES']:
+        return None
+    return compression.negotiate_encoding(flask.request.accept_encodings)
+
+
+def _make_points_response(target_points, options, result_key=None):
+    """Encode the points as requested by the Accept header.
+
+    The points are rounded and encoded according to options (the query
+    arguments of PointsOptionsSchema), the response is compressed according
+    to the Accept-Encoding header. If result_key is given, the Location
+    header points to the URL of the stored result. Returns a response object.
+    """
+    mimetype = _negotiate_points_mimetype()
+    encoding = _negotiate_content_encoding()
+    with metrics.stage('serialization'):
+        if options['precision'] is not None:
+            target_points = np.round(
+                np.asarray(target_points, dtype=np.float64).reshape(-1, 3),
+                options['precision'])
+        if mimetype not in point_io.BINARY_MIMETYPES:
+            # The response is serialized directly rather than through
+            # TransformPointsResponseSchema, which is only used for
+            # documentation
+            data = _dumps_json({'target_points': target_points})
+        else:
+            data = point_io.points_to_buffer(target_points, mimetype,
+                                             dtype=options['dtype'])
+        compress = (encoding is not None and len(data)
+                    >= current_app.config['COMPRESS_MIN_SIZE'])
+        if compress:
+            data = compression.compress(data, encoding)
+    response = flask.Response(data, mimetype=mimetype)
+    if compress:
+        response.content_encoding = encoding
+    if current_app.config['COMPRESS_RESPONSES']:
+        response.vary.add('Accept-Encoding')
+    if result_key is not None:
+        response.headers['Location'] = flask.url_for(
+            'api_v1.get_transform_points_result', key=result_key)
+    return response
+
+
+def _transform_points(source_space, target_space, source_points):
+    """Transform points between two spaces.
+
+    Returns a (target_points, result_key) tuple, where result_key is the key
+    of the result in the result store (None if the store is disabled).
+    """
+    with metrics.stage('graph_lookup'):
+        tg = _get_transform_graph()
+        try:
+            transform_chain = tg.get_transform_chain(source_space,
+                                                     target_space)
+        except KeyError:
+            abort(400, errors=['source_space or target_space not found'])
+        metrics.observe_transform_request(source_space, target_space,
+                                          len(source_points))
+        shortcut = tg.get_shortcut(source_space, target_space)
+    cwd = g.transform_graph_cwd
+    store = result_store.get_result_store()
+    if store is None:
+        return apply_transform.transform_points(
+            source_points, transform_chain, cwd=cwd, shortcut=shortcut), None
+    try:
+        key = result_store.result_key(transform_chain, source_points,
+                                      cwd=cwd, shortcut=shortcut)
+    except OSError as exc:
+        logger.debug('Cannot compute the result key: %s', exc)
+        return apply_transform.transform_points(
+            source_points, transform_chain, cwd=cwd, shortcut=shortcut), None
+    target_points = store.get(key)
+    if target_points is None:
+        target_points = apply_transform.transform_points(
+            source_points, transform_chain, cwd=cwd, shortcut=shortcut)
+        try:
+            if not store.put(key, target_points):
+                return target_points, None
+        except OSError as exc:
+            logger.warning('Cannot store the result %s: %s', key, exc)
+            return target_points, None
+    return target_points, key
+
+
 @bp.route('/transform-points', methods=['POST'])
+@bp.arguments(TransformPointsQuerySchema, location='query')
+@_binary_points_request
 @bp.arguments(TransformPointsRequestSchema, location='json',
               example={
                   'source_space': 'MNI 152 ICBM 2009c Nonlinear Asymmetric',
@@ -280,20 +641,316 @@ class GetTransformCommandResponseSchema(Schema):
                      [55.8957, 16.8771, -25.3469],
                  ],
              })
-def transform_points(args):
-    """Transform a batch of points."""
-    source_space = args['source_space']
-    target_space = args['target_space']
+def transform_points(query_args, args):
+    """Transform a batch of points.
 
-    tg = _get_transform_graph()
+    Besides JSON, the points can be sent and received as packed
+    little-endian floats (`application/octet-stream`, an N×3 array in C
+    order, whose data type is given by the `dtype` query parameter) or in the
+    NumPy `.npy` format (`application/x-npy`). With a binary request body,
+    `source_space` and `target_space` are passed as query parameters. The
+    encoding of the response is chosen according to the `Accept` header.
+
+    The coordinates of the response can be rounded with the `precision`
+    query parameter. Depending on the configuration of the server, the
+    response is compressed according to the `Accept-Encoding` header (gzip,
+    and possibly `br` and `zstd`).
+
+    If the result store is enabled on the server, the response has a
+    `Location` header with the URL of a cacheable copy of the result (see
+    `/v1/transform-points-results/{key}`).
+    """
+    # The JSON body has been deserialized and validated by webargs
+    metrics.record_stage_since_request_start('validation')
+    target_points, result_key = _transform_points(args['source_space'],
+                                                  args['target_space'],
+                                                  args['source_points'])
+    return _make_points_response(target_points, query_args,
+                                 result_key=result_key)
+
+
+@bp.route('/transform-points-results/<key>')
+@bp.arguments(PointsOptionsSchema, location='query')
+# The error responses come first, the schemas are only used for
+# documentation
+@bp.response(ErrorResponseSchema,
+             code=404, description='Unknown or evicted result')
+# The successful response must be the last response decorator, its schema
+# is used for serializing the response.
+@bp.response(TransformPointsResponseSchema)
+def get_transform_points_result(args, key):
+    """Download a stored result of `/v1/transform-points`.
+
+    The URL of a result is given by the `Location` header of the response to
+    `/v1/transform-points`. Its contents never change, so it can be cached
+    for a long time. Results are evicted from the server when its store is
+    full, the request then has to be sent again to `/v1/transform-points`.
+    The encoding of the response is chosen according to the `Accept` header,
+    as for `/v1/transform-points`.
+    """
+    store = result_store.get_result_store()
+    if store is None or not result_store.KEY_RE.match(key):
+        abort(404, message='result not found')
+    mimetype = _negotiate_points_mimetype()
+    # The result has one representation per encoding
+    etag = '{0}-{1}-{2}-{3}-{4}'.format(key, mimetype, args['dtype'],
+                                        args['precision'],
+                                        _negotiate_content_encoding())
+    response = _not_modified_response(etag)
+    if response is None:
+        target_points = store.get(key)
+        if target_points is None:
+            abort(404, message='result not found (it may have been evicted)')
+        response = _make_points_response(target_points, args)
+        response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 31536000  # 1 year
+    response.vary.add('Accept')
+    return response
+
+
+class TransformPointsBatchRequestSchema(Schema):
+    jobs = fields.List(
+        fields.Nested(TransformPointsRequestSchema),
+        required=True,
+        metadata=dict(
+            description='List of transformation jobs, each of which has the '
+                        'same fields as the body of /v1/transform-points.',
+        ),
+    )
+
+
+class TransformPointsJobResultSchema(Schema):
+    class Meta:
+        ordered = True
+
+    target_points = fields.List(
+        fields.List(fields.Float, validate=Length(equal=3)),
+        required=False,
+        metadata=dict(
+            description='Coordinates of the transformed points of the job '
+                        '(absent if the job has failed).',
+        ),
+    )
+    error = fields.Nested(
+        ErrorResponseSchema,
+        required=False,
+        metadata=dict(
+            description='Reason why the job has failed (absent if the job '
+                        'has succeeded).',
+        ),
+    )
+
+
+class TransformPointsBatchResponseSchema(Schema):
+    results = fields.List(
+        fields.Nested(TransformPointsJobResultSchema),
+        required=True,
+        metadata=dict(
+            description='Result of each job, in the same order as `jobs` in '
+                        'the request.',
+        ),
+    )
+
+
+def _job_error(code, message):
+    return {'error': {'code': code, 'message': message}}
+
+
+@bp.route('/transform-points-batch', methods=['POST'])
+@bp.arguments(TransformPointsBatchRequestSchema, location='json',
+              example={
+                  'jobs': [
+                      {
+                          'source_space':
+                          'MNI 152 ICBM 2009c Nonlinear Asymmetric',
+                          'target_space': 'Big Brain (Histology)',
+                          'source_points': [[1, 2, 3]],
+                      },
+                      {
+                          'source_space':
+                          'MNI 152 ICBM 2009c Nonlinear Asymmetric',
+                          'target_space': 'MNI Colin 27',
+                          'source_points': [[1, 2, 3], [4, 5, 6]],
+                      },
+                  ],
+              })
+# Code 422 is raised by webargs for request validation errors
+@bp.response(ErrorResponseSchema,
+             code=422, description='Semantically invalid request')
+# The successful response must be the last response decorator, its schema
+# is used for serializing the response.
+@bp.response(TransformPointsBatchResponseSchema,
+             example={
+                 'results': [
+                     {'target_points': [[2.20432, 14.2799, -2.02697]]},
+                     {'error': {
+                         'code': 400,
+                         'message': 'source_space or target_space not found',
+                     }},
+                 ],
+             })
+def transform_points_batch(args):
+    """Transform several batches of points, between several pairs of spaces.
+
+    This is equivalent to one call to `/v1/transform-points` per job, in a
+    single request. The points of the jobs that use the same transformation
+    are transformed together, and the different transformations run
+    concurrently. Jobs fail individually: the result of a failed job holds
+    an `error` object, whose `code` is the status code that
+    `/v1/transform-points` would have returned.
+    """
+    metrics.record_stage_since_request_start('validation')
+    jobs = args['jobs']
+    results = [None] * len(jobs)
+    runnable_indices = []
+    with metrics.stage('graph_lookup'):
+        tg = _get_transform_graph()
+        transform_chains = []
+        for i, job in enumerate(jobs):
+            try:
+                transform_chain = tg.get_transform_chain(job['source_space'],
+                                                         job['target_space'])
+            except KeyError:
+                results[i] = _job_error(
+                    400, 'source_space or target_space not found')
+                continue
+            if transform_chain is None:
+                results[i] = _job_error(
+                    400, 'no transformation from source_space to '
+                    'target_space')
+                continue
+            metrics.observe_transform_request(job['source_space'],
+                                              job['target_space'],
+                                              len(job['source_points']))
+            runnable_indices.append(i)
+            transform_chains.append((transform_chain, tg.get_shortcut(
+                job['source_space'], job['target_space'])))
+
+    job_results = apply_transform.transform_points_jobs(
+        [(jobs[i]['source_points'], chain, shortcut)
+         for i, (chain, shortcut) in zip(runnable_indices,
+                                         transform_chains)],
+        cwd=g.transform_graph_cwd)
+    for i, job_result in zip(runnable_indices, job_results):
+        if isinstance(job_result, Exception):
+            results[i] = _job_error(500, 'the transformation has failed')
+        else:
+            results[i] = {'target_points': job_result}
+
+    with metrics.stage('serialization'):
+        # The response is serialized directly rather than through
+        # TransformPointsBatchResponseSchema, which is only used for
+        # documentation
+        return flask.Response(_dumps_json({'results': results}),
+                              mimetype='application/json')
+
+
+def _stream_target_points(source_chunks, transform_chain, cwd, mimetype,
+                          dtype, precision=None, shortcut=None):
+    for source_points in source_chunks:
+        target_points = apply_transform.transform_points(
+            source_points, transform_chain, cwd=cwd, shortcut=shortcut)
+        if precision is not None:
+            target_points = np.round(
+                np.asarray(target_points, dtype=np.float64).reshape(-1, 3),
+                precision).tolist()
+        if mimetype == point_io.NDJSON_MIMETYPE:
+            yield b''.join(_dumps_json(point) + b'\n'
+                           for point in target_points)
+        else:
+            yield point_io.points_to_buffer(target_points, mimetype,
+                                            dtype=dtype)
+
+
+def _stream_points_response(source_chunks, transform_chain, cwd, mimetype,
+                            dtype, precision=None, shortcut=None):
     try:
-        transform_chain = tg.get_transform_chain(source_space, target_space)
-    except KeyError:
-        abort(400, errors=['source_space or target_space not found'])
-    target_points = apply_transform.transform_points(
-        args['source_points'], transform_chain, cwd=g.transform_graph_cwd)
+        yield from _stream_target_points(source_chunks, transform_chain, cwd,
+                                         mimetype, dtype, precision,
+                                         shortcut)
+    except ValueError as exc:
+        # The response has already started, so the status code cannot be
+        # changed anymore
+        logger.warning('Malformed points in the request stream: %s', exc)
+        if mimetype == point_io.NDJSON_MIMETYPE:
+            yield _dumps_json({'error': str(exc)}) + b'\n'
+        else:
+            # A binary response has no room for an error message, so the
+            # connection is aborted for the client to see an incomplete
+            # transfer, instead of a response that looks complete
+            raise
 
-    return {'target_points': target_points}
+
+@bp.route('/transform-points-stream', methods=['POST'])
+@bp.arguments(TransformPointsBinaryQuerySchema, location='query')
+# The error responses come first, the schemas are only used for
+# documentation
+@bp.response(ErrorResponseSchema,
+             code=400,
+             example={'message': 'source_space or target_space not found'})
+@bp.response(ErrorResponseSchema,
+             code=415, description='Unsupported request body encoding')
+# Code 422 is raised by webargs for request validation errors
+@bp.response(ErrorResponseSchema,
+             code=422, description='Semantically invalid request')
+@bp.response(code=200, description='Stream of transformed points')
+def transform_points_stream(args):
+    """Transform a stream of points of arbitrary length.
+
+    The request body is read incrementally, and the transformed points are
+    streamed back as soon as they are available, so that the memory use of
+    the server does not depend on the number of points. The points are sent
+    either as newline-delimited JSON (`application/x-ndjson`, one `[x, y, z]`
+    array per line) or as packed little-endian floats
+    (`application/octet-stream`, whose data type is given by the `dtype`
+    query parameter). The response uses the same encoding as the request,
+    unless the `Accept` header asks for the other one.
+
+    Malformed points are only detected when they are reached, so an error
+    that occurs after the response has started truncates the response: an
+    NDJSON response then ends with an `{"error": ...}` line, the transfer of
+    a binary response is aborted (the connection is closed without
+    terminating the chunked encoding).
+    """
+    request_mimetype = flask.request.mimetype
+    if request_mimetype not in point_io.STREAMING_MIMETYPES:
+        abort(415, message='the request body must be one of: {0}'.format(
+            ', '.join(point_io.STREAMING_MIMETYPES)))
+    response_mimetype = flask.request.accept_mimetypes.best_match(
+        (request_mimetype,) + tuple(m for m in point_io.STREAMING_MIMETYPES
+                                    if m != request_mimetype),
+        default=request_mimetype)
+
+    with metrics.stage('graph_lookup'):
+        tg = _get_transform_graph()
+        try:
+            transform_chain = tg.get_transform_chain(args['source_space'],
+                                                     args['target_space'])
+        except KeyError:
+            abort(400, errors=['source_space or target_space not found'])
+        metrics.observe_transform_request(args['source_space'],
+                                          args['target_space'])
+        shortcut = tg.get_shortcut(args['source_space'], args['target_space'])
+
+    source_chunks = point_io.iter_points_chunks(
+        flask.request.stream, request_mimetype,
+        current_app.config['STREAM_CHUNK_SIZE'], dtype=args['dtype'])
+    # Read the first chunk before the response starts, so that errors in the
+    # first points (the most common case) get a proper status code
+    try:
+        first_chunk = next(source_chunks, None)
+    except ValueError as exc:
+        abort(422, message=str(exc))
+    if first_chunk is not None:
+        source_chunks = itertools.chain([first_chunk], source_chunks)
+    else:
+        source_chunks = iter(())
+    return flask.Response(
+        flask.stream_with_context(_stream_points_response(
+            source_chunks, transform_chain, g.transform_graph_cwd,
+            response_mimetype, args['dtype'], args['precision'], shortcut)),
+        mimetype=response_mimetype)
 
 
 @bp.route('/get-mesh-transform-command')
@@ -326,20 +983,22 @@ def get_mesh_transform_command(args):
                                                          source_space)
     except KeyError:
         abort(400, errors=['source_space or target_space not found'])
+    etag = _chains_etag(direct_transform_chain, inverse_transform_chain)
+    response = _not_modified_response(etag)
+    if response is not None:
+        return response
 
     transform_command = apply_transform.get_transform_command(
         direct_transform_chain=direct_transform_chain,
         inverse_transform_chain=inverse_transform_chain,
         input_coords=input_coords,
+        cwd=g.transform_graph_cwd,
     )
 
     response = jsonify(GetTransformCommandResponseSchema().dump({
         'transform_command': transform_command,
     }))
-
-    response.cache_control.public = True
-    response.cache_control.max_age = 86400  # 1 day
-    return response
+    return _make_cacheable(response, etag)
 
 
 @bp.route('/get-image-transform-command')
@@ -370,6 +1029,10 @@ def get_image_transform_command(args):
                                                          source_space)
     except KeyError:
         abort(400, errors=['source_space or target_space not found'])
+    etag = _chains_etag(inverse_transform_chain)
+    response = _not_modified_response(etag)
+    if response is not None:
+        return response
 
     # For resampling images we have use AIMS image coordinates (whose origin is
     # in the corner of the field of view), so we have to remove the last affine
@@ -390,12 +1053,10 @@ def get_image_transform_command(args):
         inverse_transform_chain=inverse_transform_chain,
         reference=reference,
         input_coords=input_coords,
+        cwd=g.transform_graph_cwd,
     )
 
     response = jsonify(GetTransformCommandResponseSchema().dump({
         'transform_command': transform_command,
     }))
-
-    response.cache_control.public = True
-    response.cache_control.max_age = 86400  # 1 day
-    return response
+    return _make_cacheable(response, etag)
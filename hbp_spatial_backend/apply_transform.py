@@ -14,20 +14,405 @@
 # See the Licence for the specific language governing permissions and
 # limitations under the Licence.
 
-import io
+import concurrent.futures
+import hashlib
 import logging
+import os
 import re
 import shlex
 import subprocess
+import sys
+import threading
 import time
 
 from flask import current_app
+import numpy as np
+
+from hbp_spatial_backend import extensions
+from hbp_spatial_backend import file_digests
+from hbp_spatial_backend import metrics
+from hbp_spatial_backend import micro_batch
+from hbp_spatial_backend import numpy_transform
+from hbp_spatial_backend import point_cache
+from hbp_spatial_backend import single_flight
 
 
 logger = logging.getLogger(__name__)
 
 
-def transform_points(source_points, direct_transform_chain, cwd=None):
+def transform_points(source_points, direct_transform_chain, cwd=None,
+                     shortcut=None):
+    """Transform a batch of points along a transform chain.
+
+    shortcut is an optional composed chain that approximates the transform
+    chain within a box (see hbp_spatial_backend.compose_field): it is used
+    for the points that are within the box, the other points are
+    transformed along the transform chain. Returns a list of (x, y, z)
+    tuples.
+    """
+    if shortcut is not None:
+        return _transform_points_with_shortcut(
+            source_points, direct_transform_chain, shortcut, cwd=cwd)
+    cache = get_point_cache()
+    coalescer = get_single_flight()
+    version = None
+    if cache is not None or coalescer is not None:
+        # The contents of the files are part of the keys, so that a modified
+        # transformation does not return stale points. The digest is that of
+        # the chain before folding, like the ETags of the API.
+        try:
+            version = file_digests.chain_digest(direct_transform_chain,
+                                                cwd=cwd)
+        except OSError:
+            pass  # the transformation itself will fail
+    direct_transform_chain = fold_transform_chain(direct_transform_chain,
+                                                  cwd=cwd)
+    if coalescer is None:
+        return _transform_points_cached(source_points, direct_transform_chain,
+                                        cwd=cwd, cache=cache, version=version)
+    key = (cwd, tuple(direct_transform_chain or ()), version, hashlib.sha256(
+        np.ascontiguousarray(source_points, dtype='<f8').tobytes()
+    ).digest())
+    # The callers get their own list, the tuples of coordinates are immutable
+    return list(coalescer.do(key, lambda: _transform_points_cached(
+        source_points, direct_transform_chain, cwd=cwd, cache=cache,
+        version=version)))
+
+
+def _transform_points_with_shortcut(source_points, direct_transform_chain,
+                                    shortcut, cwd=None):
+    from hbp_spatial_backend import compose_field
+    source_points = np.asarray(source_points, dtype=np.float64).reshape(-1, 3)
+    try:
+        inside = compose_field.shortcut_domain(source_points, shortcut,
+                                               cwd=cwd)
+    except (OSError, ValueError) as exc:
+        logger.warning('Cannot use the shortcut %s: %s', shortcut, exc)
+        inside = np.zeros(len(source_points), dtype=bool)
+    target_points = [None] * len(source_points)
+    for mask, transform_chain in ((inside, shortcut),
+                                  (~inside, direct_transform_chain)):
+        indices = np.flatnonzero(mask)
+        if len(indices) == 0:
+            continue
+        for i, point in zip(indices.tolist(), transform_points(
+                source_points[indices], transform_chain, cwd=cwd)):
+            target_points[i] = point
+    return target_points
+
+
+def _transform_points_cached(source_points, direct_transform_chain,
+                             cwd=None, cache=None, version=None):
+    if cache is None:
+        return _transform_points_uncached(source_points,
+                                          direct_transform_chain,
+                                          cwd=cwd)
+    keys = cache.make_keys(source_points, direct_transform_chain, cwd=cwd,
+                           version=version)
+    target_points = cache.get_many(keys)
+    miss_indices = [i for i, p in enumerate(target_points) if p is None]
+    if miss_indices:
+        logger.debug('Point cache: %d hits, %d misses',
+                     len(target_points) - len(miss_indices),
+                     len(miss_indices))
+        computed_points = _transform_points_uncached(
+            [source_points[i] for i in miss_indices],
+            direct_transform_chain,
+            cwd=cwd)
+        cache.set_many([keys[i] for i in miss_indices], computed_points)
+        for i, point in zip(miss_indices, computed_points):
+            target_points[i] = point
+    return target_points
+
+
+# Process-wide cache of the folded transform chains, indexed by (cwd, chain,
+# output directory). Each entry is a (file identities, folded chain) tuple.
+_folded_chains = {}
+_folded_chains_lock = threading.Lock()
+
+
+def fold_transform_chain(transform_chain, cwd=None):
+    """Compose the consecutive affine transformations of a chain.
+
+    This is a no-op unless FOLD_AFFINE_TRANSFORMS is set. The folded chains
+    are cached, see numpy_transform.fold_affine_transforms. If the chain
+    cannot be folded (e.g. a file is missing), it is returned unchanged.
+    """
+    if (transform_chain is None
+            or not current_app.config['FOLD_AFFINE_TRANSFORMS']):
+        return transform_chain
+    output_dir = (current_app.config['FOLDED_TRANSFORMS_DIR']
+                  or os.path.join(current_app.instance_path,
+                                  'folded-transforms'))
+    key = (cwd, tuple(transform_chain), output_dir)
+    # A chain is folded again if one of its files has been modified
+    try:
+        identities = file_digests.chain_identity(transform_chain, cwd=cwd)
+    except OSError as exc:
+        logger.warning('Cannot fold the affine transformations of %s: %s',
+                       transform_chain, exc)
+        return list(transform_chain)
+    with _folded_chains_lock:
+        cached = _folded_chains.get(key)
+    folded_chain = (cached[1] if cached is not None
+                    and cached[0] == identities else None)
+    if folded_chain is None:
+        try:
+            folded_chain = numpy_transform.fold_affine_transforms(
+                transform_chain, output_dir, cwd=cwd)
+        except (OSError, ValueError) as exc:
+            logger.warning('Cannot fold the affine transformations of %s: %s',
+                           transform_chain, exc)
+            folded_chain = list(transform_chain)
+        else:
+            if len(folded_chain) < len(transform_chain):
+                logger.debug('Folded transform chain %s into %s',
+                             transform_chain, folded_chain)
+        with _folded_chains_lock:
+            _folded_chains[key] = (identities, folded_chain)
+    return list(folded_chain)
+
+
+def clear_folded_chains_cache():
+    """Forget the folded chains, e.g. after the transform graph has changed.
+
+    The composed .trm files are kept on disk.
+    """
+    with _folded_chains_lock:
+        _folded_chains.clear()
+
+
+def _create_point_cache(app):
+    kwargs = dict(
+        max_size=app.config['POINT_CACHE_SIZE'],
+        ttl=app.config['POINT_CACHE_TTL'],
+        precision=app.config['POINT_CACHE_PRECISION'],
+    )
+    backend = app.config['POINT_CACHE_BACKEND']
+    if backend == 'memory':
+        return point_cache.MemoryPointCache(**kwargs)
+    elif backend == 'sqlite':
+        path = (app.config['POINT_CACHE_PATH']
+                or os.path.join(app.instance_path, 'point-cache.sqlite3'))
+        return point_cache.SQLitePointCache(path, **kwargs)
+    else:
+        raise ValueError('invalid POINT_CACHE_BACKEND: {0!r}'
+                         .format(backend))
+
+
+def get_point_cache(app=None):
+    """Get the cache of transformed points of the application.
+
+    Returns None if the cache is disabled (POINT_CACHE_SIZE is 0).
+    """
+    if app is None:
+        app = current_app._get_current_object()
+    if not app.config['POINT_CACHE_SIZE']:
+        return None
+    return extensions.get_extension(app, 'point_cache',
+                                    lambda: _create_point_cache(app))
+
+
+def get_single_flight(app=None):
+    """Get the coalescer of the concurrent identical transformations.
+
+    Returns None if COALESCE_TRANSFORMATIONS is disabled.
+    """
+    if app is None:
+        app = current_app._get_current_object()
+    if not app.config['COALESCE_TRANSFORMATIONS']:
+        return None
+    return extensions.get_extension(app, 'single_flight',
+                                    single_flight.SingleFlight)
+
+
+def transform_points_jobs(jobs, cwd=None):
+    """Transform several batches of points, each along its own chain.
+
+    jobs is a list of (source_points, direct_transform_chain) or
+    (source_points, direct_transform_chain, shortcut) tuples, see
+    transform_points. The points of the jobs that share a transform chain
+    are transformed together, and the groups of jobs that use different
+    chains are transformed concurrently. Returns a list with, for each job in
+    order, either the list of its target points or the exception that was
+    raised while transforming its group.
+    """
+    groups = {}
+    for index, job in enumerate(jobs):
+        direct_transform_chain = job[1]
+        shortcut = job[2] if len(job) > 2 else None
+        # transform_points folds the chain, and derives the versions of the
+        # cache keys from the unfolded chain
+        chain_key = (tuple(direct_transform_chain),
+                     tuple(shortcut) if shortcut is not None else None)
+        groups.setdefault(chain_key, []).append(index)
+
+    def transform_group(chain_key, indices):
+        transform_chain, shortcut = chain_key
+        group_points = [jobs[i][0] for i in indices]
+        offsets = np.cumsum([0] + [len(p) for p in group_points])
+        if offsets[-1] == 0:
+            return [[] for _ in indices]
+        try:
+            target_points = transform_points(
+                np.concatenate([np.asarray(p, dtype=np.float64).reshape(-1, 3)
+                                for p in group_points]),
+                list(transform_chain), cwd=cwd,
+                shortcut=list(shortcut) if shortcut is not None else None)
+        except Exception as exc:
+            logger.exception('Transformation along %s failed',
+                             transform_chain)
+            return [exc] * len(indices)
+        return [target_points[start:stop]
+                for start, stop in zip(offsets[:-1], offsets[1:])]
+
+    results = [None] * len(jobs)
+    if len(groups) == 1:
+        group_results = [transform_group(*next(iter(groups.items())))]
+    else:
+        group_results = _map_in_executor(
+            lambda item: transform_group(*item), list(groups.items()))
+    for indices, job_results in zip(groups.values(), group_results):
+        for i, job_result in zip(indices, job_results):
+            results[i] = job_result
+    return results
+
+
+def _transform_points_uncached(source_points, direct_transform_chain,
+                               cwd=None):
+    threshold = current_app.config['TRANSFORM_PARALLEL_THRESHOLD']
+    # Tasks that already run in the executor must not wait for other tasks
+    # of the same executor, which could deadlock
+    if (threshold is not None and len(source_points) >= threshold
+            and not getattr(_executor_thread, 'active', False)):
+        return _transform_points_parallel(source_points,
+                                          direct_transform_chain,
+                                          cwd=cwd)
+    return _transform_points_engine(source_points, direct_transform_chain,
+                                    cwd=cwd)
+
+
+# Marks the threads (or greenlets) that run tasks of the parallel executor
+_executor_thread = threading.local()
+
+
+def _get_parallel_executor(app=None):
+    """Get the thread pool that runs the chunks of big batches of points.
+
+    Threads are enough because the actual work is done in child processes
+    (or in NumPy code that releases the GIL).
+    """
+    if app is None:
+        app = current_app._get_current_object()
+    return extensions.get_extension(
+        app, 'parallel_executor',
+        lambda: concurrent.futures.ThreadPoolExecutor(
+            max_workers=(app.config['TRANSFORM_PARALLEL_WORKERS']
+                         or os.cpu_count()),
+            thread_name_prefix='transform-chunk',
+        ))
+
+
+def _map_in_executor(func, items):
+    """Call func on every item in the parallel executor.
+
+    func is called within an application context. Returns the list of the
+    results, in the order of the items.
+    """
+    app = current_app._get_current_object()
+
+    def run_task(item):
+        _executor_thread.active = True
+        try:
+            with app.app_context():
+                return func(item)
+        finally:
+            _executor_thread.active = False
+
+    return list(_get_parallel_executor(app).map(run_task, items))
+
+
+def _transform_points_parallel(source_points, direct_transform_chain,
+                               cwd=None):
+    chunk_size = current_app.config['TRANSFORM_CHUNK_SIZE']
+    chunks = [source_points[start:start + chunk_size]
+              for start in range(0, len(source_points), chunk_size)]
+
+    def transform_chunk(chunk):
+        return _transform_points_engine(chunk, direct_transform_chain,
+                                        cwd=cwd)
+
+    time_before = time.perf_counter()
+    target_points = []
+    for chunk_target_points in _map_in_executor(transform_chunk, chunks):
+        target_points.extend(chunk_target_points)
+    elapsed_time = time.perf_counter() - time_before
+    logger.info('Parallel transform of %d points in %d chunks completed in '
+                '%.3f s', len(source_points), len(chunks), elapsed_time)
+    return target_points
+
+
+def _transform_points_engine(source_points, direct_transform_chain,
+                             cwd=None):
+    engine = current_app.config['TRANSFORM_ENGINE']
+    with metrics.engine_call(engine):
+        if engine == 'numpy':
+            try:
+                return _transform_points_numpy(source_points,
+                                               direct_transform_chain,
+                                               cwd=cwd)
+            except numpy_transform.UnsupportedTransformError as exc:
+                logger.info('Falling back to AimsApplyTransform: %s', exc)
+        elif engine != 'subprocess':
+            raise ValueError('invalid TRANSFORM_ENGINE: {0!r}'.format(engine))
+        return _transform_points_subprocess(source_points,
+                                            direct_transform_chain,
+                                            cwd=cwd)
+
+
+def _transform_points_numpy(source_points, direct_transform_chain, cwd=None):
+    time_before = time.perf_counter()
+    with metrics.stage('engine'):
+        target_points = numpy_transform.transform_points(
+            source_points, direct_transform_chain, cwd=cwd)
+    elapsed_time = time.perf_counter() - time_before
+    logger.info('In-process transform completed in %.3f s', elapsed_time)
+    return [tuple(p) for p in target_points.tolist()]
+
+
+def _get_subprocess_module():
+    """Get the subprocess module that cooperates with the running event loop.
+
+    Under the gevent worker class of Gunicorn, a blocking subprocess call
+    would stall every greenlet of the worker. Gunicorn normally monkey-patches
+    the subprocess module, but we use gevent.subprocess explicitly so that
+    this does not depend on the monkey-patching configuration.
+    """
+    gevent_monkey = sys.modules.get('gevent.monkey')
+    if (gevent_monkey is not None
+            and gevent_monkey.is_module_patched('threading')):
+        import gevent.subprocess
+        return gevent.subprocess
+    return subprocess
+
+
+def _get_subprocess_semaphore(app=None):
+    """Get the semaphore that limits the number of concurrent subprocesses.
+
+    Returns None if the number of subprocesses is not limited.
+    """
+    if app is None:
+        app = current_app._get_current_object()
+    max_subprocesses = app.config['MAX_CONCURRENT_SUBPROCESSES']
+    if max_subprocesses is None:
+        return None
+    return extensions.get_extension(
+        app, 'semaphore',
+        lambda: threading.BoundedSemaphore(max_subprocesses))
+
+
+def _transform_points_subprocess(source_points, direct_transform_chain,
+                                 cwd=None):
     transform_params = []
     for t in direct_transform_chain:
         transform_params.extend(['--direct-transform', t])
@@ -38,37 +423,55 @@ def transform_points(source_points, direct_transform_chain, cwd=None):
         '--input', '-',
         '--output', '-'
     ] + transform_params
-    input_points_str = '\n'.join(
-        '({0}, {1}, {2})'.format(*p) for p in source_points
-    )
+    input_points_str = format_points_input(source_points)
     if logger.isEnabledFor(logging.DEBUG):
         logger.debug('Transforming %d points with: %s', len(source_points),
                      ' '.join(shlex.quote(arg) for arg in cmd))
+    timeout = current_app.config['REQUEST_TIMEOUT']
     time_before = time.perf_counter()
 
-    res = subprocess.run(
-        cmd,
-        check=True,
-        input=input_points_str,
-        stdout=subprocess.PIPE,
-        universal_newlines=True,  # synonym of text=True for Python < 3.7
-        cwd=cwd,
-        timeout=current_app.config['REQUEST_TIMEOUT'],
-    )
+    semaphore = _get_subprocess_semaphore()
+    if semaphore is not None and not semaphore.acquire(timeout=timeout):
+        raise subprocess.TimeoutExpired(cmd, timeout)
+    try:
+        if timeout is not None:
+            # The time spent waiting for the semaphore counts towards the
+            # timeout of the request
+            remaining_time = timeout - (time.perf_counter() - time_before)
+            if remaining_time <= 0:
+                raise subprocess.TimeoutExpired(cmd, timeout)
+        else:
+            remaining_time = None
+        with metrics.stage('engine'):
+            res = _get_subprocess_module().run(
+                cmd,
+                check=True,
+                input=input_points_str,
+                stdout=subprocess.PIPE,
+                universal_newlines=True,  # synonym of text=True for Py < 3.7
+                cwd=cwd,
+                timeout=remaining_time,
+            )
+    finally:
+        if semaphore is not None:
+            semaphore.release()
     elapsed_time = time.perf_counter() - time_before
     logger.info('AimsApplyTransform completed in %.3f s', elapsed_time)
-    target_points = list(parse_points_output(io.StringIO(res.stdout)))
+    with metrics.stage('parsing'):
+        target_points = parse_points_output_array(res.stdout)
     assert len(target_points) == len(source_points)
-    return target_points
+    return list(map(tuple, target_points.tolist()))
 
 
 def get_transform_command(direct_transform_chain=None,
                           inverse_transform_chain=None,
                           reference=None,
-                          input_coords=None):
+                          input_coords=None,
+                          cwd=None):
     assert ((direct_transform_chain is not None)
             or (inverse_transform_chain is not None))
-
+    # The chains are never folded here: the composed files only exist on the
+    # server, whereas the commands are run by the clients
     cmd = ['AimsApplyTransform']
     if direct_transform_chain is not None:
         for t in direct_transform_chain:
@@ -83,14 +486,60 @@ def get_transform_command(direct_transform_chain=None,
     return cmd
 
 
-def transform_point(source_point, direct_transform_chain, cwd=None):
+def transform_point(source_point, direct_transform_chain, cwd=None,
+                    shortcut=None):
+    batcher = get_micro_batcher()
+    if batcher is not None:
+        key = (cwd, tuple(direct_transform_chain or ()),
+               tuple(shortcut) if shortcut is not None else None)
+        return batcher.submit(
+            key, tuple(source_point),
+            lambda points: _transform_point_batch(
+                points, direct_transform_chain, cwd=cwd, shortcut=shortcut))
     target_points = transform_points([source_point],
                                      direct_transform_chain,
-                                     cwd=cwd)
+                                     cwd=cwd, shortcut=shortcut)
     assert len(target_points) == 1
     return target_points[0]
 
 
+def _transform_point_batch(source_points, direct_transform_chain, cwd=None,
+                           shortcut=None):
+    # The clients of a viewer often ask for the same points at the same time
+    unique_points = list(dict.fromkeys(source_points))
+    target_points = dict(zip(unique_points, transform_points(
+        unique_points, direct_transform_chain, cwd=cwd, shortcut=shortcut)))
+    return [target_points[point] for point in source_points]
+
+
+def get_micro_batcher(app=None):
+    """Get the micro-batcher of the single-point transformations.
+
+    Returns None if micro-batching is disabled (MICRO_BATCH_WINDOW is None).
+    """
+    if app is None:
+        app = current_app._get_current_object()
+    if app.config['MICRO_BATCH_WINDOW'] is None:
+        return None
+    return extensions.get_extension(
+        app, 'micro_batcher',
+        lambda: micro_batch.MicroBatcher(
+            window=app.config['MICRO_BATCH_WINDOW'],
+            max_size=app.config['MICRO_BATCH_MAX_SIZE']))
+
+
+def format_points_input(source_points):
+    """Format points as expected by AimsApplyTransform --input.
+
+    The coordinates are written with repr, which round-trips exactly. The
+    whole batch is formatted in a single operation.
+    """
+    flat_coords = np.asarray(source_points,
+                             dtype=np.float64).ravel().tolist()
+    num_points = len(flat_coords) // 3
+    return ('(%r, %r, %r)\n' * num_points) % tuple(flat_coords)
+
+
 def parse_points_output(stdout_stream):
     """Parse a list of points in the format output by AimsApplyTransform.
 
@@ -109,3 +558,25 @@ def parse_points_output(stdout_stream):
         # Non-matching lines are discarded. AIMS tends to print messages,
         # warnings, etc. on stdout, so we are more robust by ignoring output
         # that we cannot parse.
+
+
+# Same as the regular expression of parse_points_output, but applied to a
+# whole buffer: [^\S\n] (whitespace except newline) and [^,\n] keep every
+# match on a single line.
+_POINT_MULTILINE_RE = re.compile(r'^[^\S\n]*\([^\S\n]*([^,\n]+)[^\S\n]*,'
+                                 r'[^\S\n]*([^,\n]+)[^\S\n]*,'
+                                 r'[^\S\n]*([^,\n]+)[^\S\n]*\)[^\S\n]*$',
+                                 re.MULTILINE)
+
+
+def parse_points_output_array(stdout_str):
+    """Parse the whole output of AimsApplyTransform into an N×3 array.
+
+    This is equivalent to parse_points_output, including the handling of
+    lines that cannot be parsed (which are discarded), but processes the
+    whole buffer at once.
+    """
+    coords = _POINT_MULTILINE_RE.findall(stdout_str)
+    if not coords:
+        return np.empty((0, 3))
+    return np.array(coords, dtype=np.float64)
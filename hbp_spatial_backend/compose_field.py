@@ -0,0 +1,231 @@
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Composition of a whole transform chain into a single displacement field.
+
+The chain is sampled on a regular grid that covers a box of the source space,
+and stored as a pair of transformations that can be declared as a shortcut
+in graph.yaml::
+
+    Source space:
+      Target space: {shortcut: [composed-shift.trm, composed.ima]}
+
+The .trm file translates the source coordinates so that the corner of the box
+is at the origin of the field, the .ima file holds the displacement field,
+which is applied with trilinear interpolation. The composed transformation
+approximates the chain within the box (it is exact at the grid nodes), but
+is meaningless outside of it, where the field does not displace the points.
+
+A shortcut is not a link of the graph: the chain between the two spaces
+still goes through the regular links. The shortcut is only used for
+transforming the points that are within its box (see shortcut_domain), the
+other points are transformed along the whole chain, and the commands
+returned by the get-*-transform-command endpoints use the whole chain.
+"""
+
+import argparse
+import logging
+import os
+import os.path
+import subprocess
+import sys
+
+import numpy as np
+
+from hbp_spatial_backend import apply_transform
+from hbp_spatial_backend import numpy_transform
+from hbp_spatial_backend.transform_graph import TransformGraph
+
+
+logger = logging.getLogger(__name__)
+
+# Number of grid points that are transformed at a time
+SLAB_NUM_POINTS = 10**6
+
+
+def transform_points_aims(source_points, direct_transform_chain, cwd=None):
+    """Transform an N×3 array of points with AimsApplyTransform."""
+    cmd = ['AimsApplyTransform', '--points', '--mmap-fields',
+           '--input', '-', '--output', '-']
+    for t in direct_transform_chain:
+        cmd.extend(['--direct-transform', t])
+    res = subprocess.run(
+        cmd,
+        check=True,
+        input=apply_transform.format_points_input(source_points),
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        cwd=cwd,
+    )
+    target_points = apply_transform.parse_points_output_array(res.stdout)
+    assert len(target_points) == len(source_points)
+    return target_points
+
+
+def compose_displacement_field(direct_transform_chain, origin, shape,
+                               voxel_size, cwd=None,
+                               transform_points=None):
+    """Sample a transform chain as a displacement field.
+
+    The field has shape[0] × shape[1] × shape[2] voxels of size voxel_size
+    (x, y, z), the first voxel is centred on origin (in source space
+    coordinates). transform_points is called on N×3 arrays of points, by
+    default numpy_transform.transform_points is used. Returns an array of
+    shape (z, y, x, 3), for use with the translation by -origin.
+    """
+    if transform_points is None:
+        transform_points = numpy_transform.transform_points
+    size_x, size_y, size_z = shape
+    voxel_size = np.asarray(voxel_size, dtype=np.float64)
+    origin = np.asarray(origin, dtype=np.float64)
+    field = np.empty((size_z, size_y, size_x, 3), dtype=np.float32)
+    slab_z = max(1, SLAB_NUM_POINTS // (size_x * size_y))
+    for z_start in range(0, size_z, slab_z):
+        z_stop = min(z_start + slab_z, size_z)
+        k, j, i = np.meshgrid(np.arange(z_start, z_stop),
+                              np.arange(size_y),
+                              np.arange(size_x),
+                              indexing='ij')
+        grid_points = np.stack([i, j, k], axis=-1).reshape(-1, 3) * voxel_size
+        target_points = transform_points(grid_points + origin,
+                                         direct_transform_chain, cwd=cwd)
+        field[z_start:z_stop] = (np.asarray(target_points) - grid_points
+                                 ).reshape(z_stop - z_start, size_y,
+                                           size_x, 3)
+        logger.info('Sampled %d/%d planes', z_stop, size_z)
+    return field
+
+
+def write_composed_transform(output_prefix, field, origin, voxel_size):
+    """Write the composed transformation to output_prefix{-shift.trm,.ima}.
+
+    Returns the list of the two transformation files, in the order of
+    application.
+    """
+    output_dir = os.path.dirname(output_prefix)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    shift_path = output_prefix + '-shift.trm'
+    field_path = output_prefix + '.ima'
+    matrix = np.eye(4)
+    matrix[:3, 3] = -np.asarray(origin, dtype=np.float64)
+    numpy_transform.write_trm(shift_path, matrix)
+    numpy_transform.write_gis_field(field_path, field, voxel_size)
+    return [shift_path, field_path]
+
+
+def shortcut_domain(source_points, shortcut, cwd=None):
+    """Test which points are within the box of a composed shortcut.
+
+    shortcut is a chain of affine transformations followed by one
+    displacement field, like the one that is written by
+    write_composed_transform. Returns a boolean array, which is True for the
+    points of the N×3 array source_points that are within the box. Raises
+    UnsupportedTransformError for other chains, OSError if a file cannot be
+    read.
+    """
+    if (not shortcut
+            or not all(numpy_transform.is_affine_transform(t)
+                       for t in shortcut[:-1])
+            or numpy_transform.is_affine_transform(shortcut[-1])):
+        raise numpy_transform.UnsupportedTransformError(
+            'not a composed shortcut: {0}'.format(shortcut))
+    field = numpy_transform.load_transform(shortcut[-1], cwd=cwd)
+    if not isinstance(field, numpy_transform.DisplacementFieldTransform):
+        raise numpy_transform.UnsupportedTransformError(
+            'not a composed shortcut: {0}'.format(shortcut))
+    points = numpy_transform.transform_points(source_points, shortcut[:-1],
+                                              cwd=cwd)
+    return field.inside(points)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description='Compose the transform chain between two spaces of a '
+                    'transform graph into a single displacement field, '
+                    'which can be used as a shortcut in the graph.')
+    parser.add_argument(
+        '-g', '--graph', required=True,
+        help='Path to the graph.yaml file that describes the transform graph '
+             '(relative paths of transformations are interpreted relative to '
+             'its directory)')
+    parser.add_argument(
+        '-s', '--source_space', required=True,
+        help='Identifier of the source template space')
+    parser.add_argument(
+        '-t', '--target_space', required=True,
+        help='Identifier of the target template space')
+    parser.add_argument(
+        '--origin', type=float, nargs=3, required=True,
+        metavar=('X', 'Y', 'Z'),
+        help='Source space coordinates of the first voxel of the field, in '
+             'millimetres')
+    parser.add_argument(
+        '--shape', type=int, nargs=3, required=True,
+        metavar=('NX', 'NY', 'NZ'),
+        help='Number of voxels of the field along each axis')
+    parser.add_argument(
+        '--voxel_size', type=float, nargs=3, required=True,
+        metavar=('DX', 'DY', 'DZ'),
+        help='Voxel size of the field, in millimetres')
+    parser.add_argument(
+        '-o', '--output', required=True,
+        help='Prefix of the output files (PREFIX-shift.trm, PREFIX.ima and '
+             'PREFIX.dim), preferably in the directory of graph.yaml')
+    parser.add_argument(
+        '--engine', choices=['numpy', 'aims'], default='numpy',
+        help='Use the in-process implementation of the transformations '
+             '(numpy, the default) or AimsApplyTransform (aims), which '
+             'supports every transformation')
+    return parser.parse_args(argv[1:])
+
+
+def main(argv=sys.argv):
+    """Entry point of the compose_transform_chain.py script."""
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args(argv)
+    with open(args.graph, 'rb') as f:
+        tg = TransformGraph.from_yaml(f)
+    cwd = os.path.dirname(os.path.abspath(args.graph))
+    try:
+        chain = tg.get_transform_chain(args.source_space, args.target_space)
+    except KeyError as exc:
+        logger.error('Unknown space: %s', exc)
+        return 1
+    if chain is None:
+        logger.error('There is no transform chain from %r to %r',
+                     args.source_space, args.target_space)
+        return 1
+    logger.info('Composing the chain %s', chain)
+
+    transform_points = (transform_points_aims if args.engine == 'aims'
+                        else numpy_transform.transform_points)
+    try:
+        field = compose_displacement_field(
+            chain, args.origin, args.shape, args.voxel_size, cwd=cwd,
+            transform_points=transform_points)
+    except numpy_transform.UnsupportedTransformError as exc:
+        logger.error('%s (try --engine=aims)', exc)
+        return 1
+    paths = write_composed_transform(args.output, field, args.origin,
+                                     args.voxel_size)
+
+    links = [os.path.relpath(os.path.abspath(path), cwd) for path in paths]
+    print('Add the following shortcut to {0}:'.format(args.graph))
+    print('{0}:\n  {1}: {{shortcut: [{2}, {3}]}}'.format(
+        args.source_space, args.target_space, *links))
+    return 0
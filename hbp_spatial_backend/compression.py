@@ -0,0 +1,73 @@
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Compression of the responses (enabled by the COMPRESS_RESPONSES setting).
+
+gzip is always available, Brotli (br) and Zstandard (zstd) need the optional
+brotli and zstandard packages. The levels favour speed over ratio: point
+coordinates do not compress much better at higher levels.
+"""
+
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+ZSTD_LEVEL = 3
+
+
+def available_encodings():
+    """List the supported content codings, in order of preference."""
+    encodings = []
+    if zstandard is not None:
+        encodings.append('zstd')
+    if brotli is not None:
+        encodings.append('br')
+    encodings.append('gzip')
+    return encodings
+
+
+def negotiate_encoding(accept_encodings):
+    """Choose a content coding from an Accept-Encoding header.
+
+    accept_encodings is a werkzeug Accept object. Returns None if no
+    compression is acceptable.
+    """
+    return accept_encodings.best_match(available_encodings())
+
+
+def compress(data, encoding):
+    """Compress bytes with the given content coding."""
+    if encoding == 'gzip':
+        # zlib rather than the gzip module, whose header holds the current
+        # time (the output must only depend on the input, because of ETags)
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    elif encoding == 'br' and brotli is not None:
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    elif encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    raise ValueError('unsupported content coding: {0!r}'.format(encoding))
@@ -0,0 +1,47 @@
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+
+"""Lazily created per-process resources of the application.
+
+Caches, coalescers, thread pools and other such objects are stored in
+``app.extensions``, and created on first use instead of in create_app.
+Under ``gunicorn --preload`` the application is created in the master
+process, and with the gevent worker class the threading module is only
+monkey-patched in each worker after the fork. Creating these objects on
+first use means that they belong to the worker that uses them, and that
+their locks and threads are those of gevent if it is in use.
+"""
+
+import threading
+
+
+_extensions_lock = threading.RLock()
+
+
+def get_extension(app, name, factory):
+    """Get the extension called name of the application.
+
+    The extension is created by calling factory() on first use, and stored
+    in ``app.extensions['hbp_spatial_backend.' + name]``.
+    """
+    key = 'hbp_spatial_backend.' + name
+    with _extensions_lock:
+        extension = app.extensions.get(key)
+        if extension is None:
+            extension = factory()
+            app.extensions[key] = extension
+    return extension
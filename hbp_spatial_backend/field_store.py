@@ -0,0 +1,151 @@
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Store of memory-mapped displacement fields.
+
+Each displacement field is memory-mapped read-only once per process. The
+mapped pages belong to the page cache of the kernel, so they are shared by
+all the server processes of a host, and with the AimsApplyTransform
+processes (which use --mmap-fields). The store reports how much of each field
+is resident in memory, which helps with tuning the memory limits of the
+server.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import mmap
+import os
+import threading
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+class FieldStore:
+    """Memory-mapped displacement fields, indexed by absolute path.
+
+    A field is mapped again if its file has been modified or replaced.
+    """
+
+    def __init__(self):
+        self._fields = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._fields)
+
+    def get(self, path):
+        """Get a displacement field as a (field, voxel_size) tuple.
+
+        See numpy_transform.read_gis_field.
+        """
+        from hbp_spatial_backend import numpy_transform
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        identity = (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+        with self._lock:
+            entry = self._fields.get(path)
+            if entry is not None and entry[0] == identity:
+                return entry[1]
+            logger.debug('Memory-mapping displacement field %s', path)
+            field = numpy_transform.read_gis_field(path)
+            self._fields[path] = (identity, field)
+            return field
+
+    def preload(self, path):
+        """Map a field and ask the kernel to read it into memory.
+
+        The pages are read in the background, this function does not wait.
+        """
+        field, _ = self.get(path)
+        mm = getattr(field, '_mmap', None)
+        if mm is not None and hasattr(mm, 'madvise'):
+            mm.madvise(mmap.MADV_WILLNEED)
+
+    def clear(self):
+        with self._lock:
+            self._fields.clear()
+
+    def stats(self):
+        """Report the size of the fields and their resident size, in bytes.
+
+        The resident size is the part of a field that is currently in the
+        page cache (None if it cannot be determined on this platform).
+        """
+        with self._lock:
+            entries = list(self._fields.items())
+        fields = []
+        for path, (_, (field, _)) in sorted(entries):
+            fields.append({
+                'path': path,
+                'size': field.nbytes,
+                'resident_size': resident_size(field),
+            })
+        resident_sizes = [f['resident_size'] for f in fields]
+        return {
+            'fields': fields,
+            'size': sum(f['size'] for f in fields),
+            'resident_size': (None if None in resident_sizes
+                              else sum(resident_sizes)),
+        }
+
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t,
+                                     ctypes.POINTER(ctypes.c_ubyte)]
+            libc.mincore.restype = ctypes.c_int
+        except (OSError, AttributeError):
+            libc = False
+        _libc = libc
+    return _libc or None
+
+
+def resident_size(array):
+    """Number of bytes of a memory-mapped array that are resident in memory.
+
+    This uses mincore(2). Returns None if it is not available.
+    """
+    libc = _get_libc()
+    if libc is None:
+        return None
+    if array.nbytes == 0:
+        return 0
+    page_size = mmap.PAGESIZE
+    address = array.__array_interface__['data'][0]
+    start = address - address % page_size
+    length = array.nbytes + (address - start)
+    num_pages = (length + page_size - 1) // page_size
+    vec = (ctypes.c_ubyte * num_pages)()
+    if libc.mincore(start, length, vec) != 0:
+        logger.debug('mincore failed: %s', os.strerror(ctypes.get_errno()))
+        return None
+    resident_pages = int(np.count_nonzero(
+        np.frombuffer(vec, dtype=np.uint8) & 1))
+    return min(resident_pages * page_size, array.nbytes)
+
+
+# Store that is shared by the whole process
+default_store = FieldStore()
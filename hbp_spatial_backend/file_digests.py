@@ -0,0 +1,107 @@
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Content digests of the transform graph and of the transformation files.
+
+The digests identify a version of the transformations: they are used as
+ETags of the responses and as part of the keys of the point cache. Each file
+is hashed once per process, the digest is cached until the file is modified
+or replaced. Hashing yields between the reads of a file, so that hashing a
+large field does not block the other greenlets when gevent is in use.
+"""
+
+import hashlib
+import os
+import threading
+import time
+
+from hbp_spatial_backend import numpy_transform
+
+
+# Size of the reads of the files that are hashed
+_READ_CHUNK_SIZE = 1 << 20
+
+# Process-wide cache of the digests, indexed by absolute path. Each entry is
+# a (file_identity, digest) tuple.
+_digests = {}
+_digests_lock = threading.Lock()
+
+
+def file_identity(path):
+    # The inode changes when Kubernetes rotates the contents of a mounted
+    # volume (os.stat follows the symbolic links that it uses), the
+    # modification time changes when the file is edited in place.
+    st = os.stat(path)
+    return (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def file_digest(path):
+    """Get the SHA-1 digest of a file, as a hexadecimal string."""
+    path = os.path.abspath(path)
+    identity = file_identity(path)
+    with _digests_lock:
+        cached = _digests.get(path)
+    if cached is not None and cached[0] == identity:
+        return cached[1]
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_READ_CHUNK_SIZE), b''):
+            h.update(block)
+            # Let other greenlets run if gevent is in use
+            time.sleep(0)
+    digest = h.hexdigest()
+    with _digests_lock:
+        _digests[path] = (identity, digest)
+    return digest
+
+
+def transform_files(transform, cwd=None):
+    """List the files of a transformation (in the syntax of the graph)."""
+    if transform.startswith(numpy_transform.INVERSE_PREFIX):
+        transform = transform[len(numpy_transform.INVERSE_PREFIX):]
+    path = os.path.join(cwd or '', transform)
+    if path.endswith('.ima'):
+        return [path, os.path.splitext(path)[0] + '.dim']
+    return [path]
+
+
+def chain_digest(transform_chain, cwd=None):
+    """Get a digest of a transform chain and of the contents of its files.
+
+    Raises OSError if a file cannot be read.
+    """
+    h = hashlib.sha1()
+    for transform in transform_chain or []:
+        h.update(transform.encode('utf-8') + b'\0')
+        for path in transform_files(transform, cwd=cwd):
+            h.update(file_digest(path).encode('ascii'))
+    return h.hexdigest()
+
+
+def chain_identity(transform_chain, cwd=None):
+    """Get the identities of the files of a transform chain.
+
+    This is cheaper than chain_digest, for detecting that a file has been
+    modified since the last call. Raises OSError if a file does not exist.
+    """
+    return tuple(file_identity(path)
+                 for transform in transform_chain or []
+                 for path in transform_files(transform, cwd=cwd))
+
+
+def clear():
+    with _digests_lock:
+        _digests.clear()
@@ -0,0 +1,36 @@
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+
+"""Gunicorn configuration, for use with ``--config=python:<this module>``.
+
+This module only defines server hooks, the other settings can still be passed
+on the command line.
+"""
+
+
+def post_worker_init(worker):
+    """Start the warm-up of the worker (if WARM_UP is set).
+
+    This hook runs in each worker after the application has been loaded, and
+    after the gevent worker class has monkey-patched the standard library, so
+    every worker is warmed up as soon as it has started, even if the
+    application was created in the master process (``--preload``).
+    """
+    app = worker.wsgi
+    if app.config.get('WARM_UP'):
+        from hbp_spatial_backend import warmup
+        warmup.ensure_started(app)
@@ -0,0 +1,211 @@
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Prometheus metrics (enabled by the ENABLE_METRICS setting).
+
+The metrics are exposed in the Prometheus text format on /metrics. This needs
+the optional prometheus_client package, which is only imported if the
+metrics are enabled. Under Gunicorn, set the PROMETHEUS_MULTIPROC_DIR
+environment variable to aggregate the metrics of all the worker processes
+(see the multiprocess mode of prometheus_client).
+
+The time spent in the main stages of a request is measured with
+:func:`stage`, which can be used whether or not the metrics are enabled.
+"""
+
+import contextlib
+import os
+import time
+
+import flask
+from flask import current_app, g
+
+
+# Buckets of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf'))
+# Buckets of the batch size histogram, in points
+BATCH_SIZE_BUCKETS = (1, 10, 100, 1000, 10**4, 10**5, 10**6, 10**7,
+                      float('inf'))
+
+
+class Metrics:
+    """The metrics of an application, in their own registry."""
+
+    def __init__(self):
+        import prometheus_client
+        self.registry = prometheus_client.CollectorRegistry()
+        kwargs = dict(namespace='hbp_spatial_backend',
+                      registry=self.registry)
+        self.requests = prometheus_client.Counter(
+            'requests', 'Number of requests', ['endpoint', 'status'],
+            **kwargs)
+        self.request_duration = prometheus_client.Histogram(
+            'request_duration_seconds', 'Latency of the requests',
+            ['endpoint'], buckets=LATENCY_BUCKETS, **kwargs)
+        self.requests_in_progress = prometheus_client.Gauge(
+            'requests_in_progress', 'Number of requests being processed',
+            ['endpoint'], multiprocess_mode='livesum', **kwargs)
+        self.pair_requests = prometheus_client.Counter(
+            'pair_requests', 'Number of transformation requests per pair of '
+            'spaces', ['endpoint', 'source_space', 'target_space'], **kwargs)
+        self.pair_request_duration = prometheus_client.Histogram(
+            'pair_request_duration_seconds', 'Latency of the transformation '
+            'requests per pair of spaces', ['source_space', 'target_space'],
+            buckets=LATENCY_BUCKETS, **kwargs)
+        self.stage_duration = prometheus_client.Histogram(
+            'stage_duration_seconds', 'Time spent in each stage of the '
+            'requests (validation, graph_lookup, engine, parsing, '
+            'serialization)', ['stage'], buckets=LATENCY_BUCKETS, **kwargs)
+        self.batch_size = prometheus_client.Histogram(
+            'batch_size_points', 'Number of points per transformation '
+            'request', ['endpoint'], buckets=BATCH_SIZE_BUCKETS, **kwargs)
+        self.engine_calls_in_progress = prometheus_client.Gauge(
+            'engine_calls_in_progress', 'Number of batches of points being '
+            'transformed by the engine', ['engine'],
+            multiprocess_mode='livesum', **kwargs)
+
+    def generate_latest(self):
+        import prometheus_client
+        registry = self.registry
+        if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+            from prometheus_client import multiprocess
+            registry = prometheus_client.CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        return prometheus_client.generate_latest(registry)
+
+
+def init_app(app):
+    """Set up the metrics of the application and the /metrics endpoint."""
+    import prometheus_client
+    metrics = Metrics()
+    app.extensions['hbp_spatial_backend.metrics'] = metrics
+
+    def endpoint_label():
+        return flask.request.endpoint or 'unknown'
+
+    @app.before_request
+    def start_request_metrics():
+        start_request_timer()
+        g.metrics_endpoint = endpoint_label()
+        metrics.requests_in_progress.labels(g.metrics_endpoint).inc()
+
+    @app.after_request
+    def record_request_metrics(response):
+        if 'metrics_endpoint' in g:
+            elapsed_time = time.perf_counter() - g.request_start_time
+            metrics.requests.labels(g.metrics_endpoint,
+                                    str(response.status_code)).inc()
+            metrics.request_duration.labels(g.metrics_endpoint).observe(
+                elapsed_time)
+            pairs = g.get('metrics_pairs')
+            # The latency of a request that involves several pairs cannot be
+            # attributed to any of them
+            if pairs is not None and len(pairs) == 1:
+                metrics.pair_request_duration.labels(*next(iter(pairs))
+                                                     ).observe(elapsed_time)
+        return response
+
+    @app.teardown_request
+    def finish_request_metrics(exc):
+        endpoint = g.pop('metrics_endpoint', None)
+        if endpoint is not None:
+            metrics.requests_in_progress.labels(endpoint).dec()
+
+    @app.route('/metrics')
+    def prometheus_metrics():
+        return flask.Response(metrics.generate_latest(),
+                              mimetype=prometheus_client.CONTENT_TYPE_LATEST)
+
+
+def get_metrics():
+    """Get the metrics of the current application (None if disabled)."""
+    if not flask.has_app_context():
+        return None
+    return current_app.extensions.get('hbp_spatial_backend.metrics')
+
+
+def observe_transform_request(source_space, target_space, num_points=None):
+    """Record the pair of spaces and the batch size of the current request.
+
+    This is called once per transformation job, i.e. several times for the
+    requests of the batch endpoint. The spaces become label values, so this
+    must only be called for spaces that exist in the transform graph, to
+    keep the number of label sets bounded.
+    """
+    metrics = get_metrics()
+    if metrics is None:
+        return
+    endpoint = flask.request.endpoint or 'unknown'
+    g.setdefault('metrics_pairs', set()).add((source_space, target_space))
+    metrics.pair_requests.labels(endpoint, source_space, target_space).inc()
+    if num_points is not None:
+        metrics.batch_size.labels(endpoint).observe(num_points)
+
+
+def record_stage(name, elapsed_time):
+    """Record the time spent in a stage of the current request.
+
+    The timings are also kept in flask.g.stage_timings, as a list of
+    (name, seconds) tuples.
+    """
+    if not flask.has_app_context():
+        return
+    if 'stage_timings' not in g:
+        g.stage_timings = []
+    g.stage_timings.append((name, elapsed_time))
+    metrics = get_metrics()
+    if metrics is not None:
+        metrics.stage_duration.labels(name).observe(elapsed_time)
+
+
+def start_request_timer():
+    """Record the start time of the current request (if not already done)."""
+    g.setdefault('request_start_time', time.perf_counter())
+
+
+def record_stage_since_request_start(name):
+    """Record the time elapsed since the start of the request as a stage.
+
+    Nothing is recorded unless start_request_timer has been called.
+    """
+    if flask.has_request_context() and 'request_start_time' in g:
+        record_stage(name, time.perf_counter() - g.request_start_time)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Context manager that measures the time spent in a stage."""
+    time_before = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - time_before)
+
+
+@contextlib.contextmanager
+def engine_call(engine):
+    """Context manager that counts the engine calls in progress."""
+    metrics = get_metrics()
+    if metrics is None:
+        yield
+        return
+    gauge = metrics.engine_calls_in_progress.labels(engine)
+    gauge.inc()
+    try:
+        yield
+    finally:
+        gauge.dec()
@@ -0,0 +1,123 @@
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Micro-batching of concurrent single-point transformations.
+
+Every transformation has a fixed cost (e.g. starting AimsApplyTransform),
+which dominates for single points. The micro-batcher collects the points
+that are submitted concurrently for the same transform chain, for up to a
+short time window or up to a maximum number of points, and transforms them
+in a single call. Each caller then gets its own row of the result.
+
+The first caller of a batch waits for the window to expire (or the batch to
+fill up), runs the batch, and hands out the results; so a batch only adds a
+bounded delay to the requests, and no background thread is needed. This is
+only useful if a server process handles concurrent requests (gevent or
+threaded workers). The waiting uses the primitives of the threading module,
+like single_flight.
+"""
+
+import logging
+import threading
+
+from hbp_spatial_backend import single_flight
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Batch:
+    def __init__(self):
+        self.items = []
+        self.full = threading.Event()
+        self.flight = single_flight.Flight()
+
+
+class MicroBatcher:
+    """Batches of the items that are submitted concurrently with a key.
+
+    window is the time, in seconds, for which a batch collects items, and
+    max_size is the maximum number of items of a batch.
+    """
+
+    def __init__(self, window, max_size):
+        if max_size < 1:
+            raise ValueError('max_size must be at least 1')
+        self.window = window
+        self.max_size = max_size
+        self._batches = {}
+        self._lock = threading.Lock()
+        self._num_batches = 0
+        self._num_items = 0
+
+    def submit(self, key, item, func):
+        """Add an item to the batch of key and return its result.
+
+        func is called with the list of the items of a batch, and must return
+        the list of their results, in the same order. The first caller of a
+        batch calls func; if it raises an Exception, the exception is raised
+        to every caller of the batch. If the first caller is interrupted by
+        a BaseException (see single_flight.Flight), the other callers submit
+        their items again.
+        """
+        while True:
+            with self._lock:
+                batch = self._batches.get(key)
+                leader = batch is None
+                if leader:
+                    batch = self._batches[key] = _Batch()
+                index = len(batch.items)
+                batch.items.append(item)
+                if len(batch.items) >= self.max_size:
+                    # No item can be added to a batch once it is closed
+                    del self._batches[key]
+                    batch.full.set()
+            if leader:
+                break
+            try:
+                return batch.flight.wait()[index]
+            except single_flight.AbandonedError:
+                logger.debug('The batch was interrupted, submitting again')
+
+        def run_batch():
+            # The waiters are also released if the leader is interrupted
+            # while collecting the items
+            try:
+                batch.full.wait(self.window)
+            finally:
+                with self._lock:
+                    if self._batches.get(key) is batch:
+                        del self._batches[key]
+                    self._num_batches += 1
+                    self._num_items += len(batch.items)
+            logger.debug('Running a batch of %d items', len(batch.items))
+            results = func(batch.items)
+            if len(results) != len(batch.items):
+                raise ValueError('the batch function returned {0} results '
+                                 'for {1} items'.format(len(results),
+                                                        len(batch.items)))
+            return results
+
+        return batch.flight.run(run_batch)[index]
+
+    def stats(self):
+        """Report the number of batches that were run, and their items."""
+        with self._lock:
+            return {
+                'open_batches': len(self._batches),
+                'batches': self._num_batches,
+                'items': self._num_items,
+            }
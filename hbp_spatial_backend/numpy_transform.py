@@ -0,0 +1,358 @@
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""In-process implementation of AimsApplyTransform for points.
+
+Only the subset of the AIMS transformation formats that is used in the
+transform graph is supported:
+
+- affine transformations in the ``.trm`` text format, optionally inverted
+  with the ``inv:`` prefix;
+
+- displacement fields stored as GIS volumes of ``POINT3DF`` (``.ima`` data
+  file with its ``.dim`` header), which are applied with trilinear
+  interpolation like the ``TrilinearFfd`` class of AIMS.
+
+Any other transformation raises :class:`UnsupportedTransformError`, so that
+the caller can fall back to running AimsApplyTransform.
+"""
+
+import functools
+import hashlib
+import io
+import logging
+import os
+import os.path
+import tempfile
+
+import numpy as np
+
+from hbp_spatial_backend import field_store
+
+logger = logging.getLogger(__name__)
+
+INVERSE_PREFIX = 'inv:'
+
+# Number of loaded transformations that are kept in memory
+LOADED_TRANSFORMS_CACHE_SIZE = 64
+
+
+class UnsupportedTransformError(ValueError):
+    """Raised for transformations that cannot be applied in-process."""
+
+
+def read_trm(path):
+    """Read an affine transformation in the AIMS .trm format.
+
+    The first line of the file contains the translation, the next three lines
+    contain the rows of the linear part. The transformation is returned as a
+    4×4 matrix in homogeneous coordinates.
+    """
+    values = np.loadtxt(path, dtype=np.float64, ndmin=2)
+    if values.shape != (4, 3):
+        raise ValueError('Malformed .trm file: {0}'.format(path))
+    matrix = np.eye(4)
+    matrix[:3, :3] = values[1:]
+    matrix[:3, 3] = values[0]
+    return matrix
+
+
+def write_trm(path, matrix):
+    """Write a 4×4 affine matrix in the AIMS .trm format."""
+    with open(path, 'wt') as f:
+        f.write(_format_trm(matrix))
+
+
+def _format_trm(matrix):
+    matrix = np.asarray(matrix, dtype=np.float64)
+    values = np.vstack([matrix[:3, 3], matrix[:3, :3]])
+    buf = io.StringIO()
+    np.savetxt(buf, values, fmt='%.17g')
+    return buf.getvalue()
+
+
+# Data types of GIS volumes that can hold displacement fields. The byte order
+# is filled in from the -bo field of the header.
+_GIS_FIELD_TYPES = {
+    'POINT3DF': 'f4',
+    'POINT3DD': 'f8',
+}
+
+
+def read_gis_header(dim_path):
+    """Parse the .dim header of a GIS volume.
+
+    Returns a dictionary with the keys ``shape`` (x, y, z, t),
+    ``voxel_size`` (x, y, z), ``type``, ``byte_order`` and ``open_mode``.
+    """
+    with open(dim_path, 'rt') as f:
+        tokens = f.read().split()
+    shape = []
+    while tokens and not tokens[0].startswith('-'):
+        shape.append(int(tokens.pop(0)))
+    if not 1 <= len(shape) <= 4:
+        raise ValueError('Malformed GIS header: {0}'.format(dim_path))
+    shape += [1] * (4 - len(shape))
+    options = dict(zip(tokens[::2], tokens[1::2]))
+    return {
+        'shape': tuple(shape),
+        'voxel_size': tuple(float(options.get(key, 1.0))
+                            for key in ('-dx', '-dy', '-dz')),
+        'type': options.get('-type', 'U8'),
+        'byte_order': options.get('-bo', 'DCBA'),
+        'open_mode': options.get('-om', 'binar'),
+    }
+
+
+def read_gis_field(ima_path):
+    """Read a displacement field stored as a GIS volume of 3D vectors.
+
+    The data file is memory-mapped read-only. Returns a 2-tuple containing an
+    array of shape (z, y, x, 3) and the voxel size.
+    """
+    dim_path = os.path.splitext(ima_path)[0] + '.dim'
+    header = read_gis_header(dim_path)
+    try:
+        dtype = _GIS_FIELD_TYPES[header['type']]
+    except KeyError:
+        raise UnsupportedTransformError(
+            'unsupported GIS data type {0} in {1}'
+            .format(header['type'], dim_path))
+    if header['open_mode'] != 'binar':
+        raise UnsupportedTransformError(
+            'unsupported GIS open mode {0} in {1}'
+            .format(header['open_mode'], dim_path))
+    if header['byte_order'] == 'DCBA':
+        dtype = '<' + dtype
+    elif header['byte_order'] == 'ABCD':
+        dtype = '>' + dtype
+    else:
+        raise ValueError('invalid GIS byte order {0} in {1}'
+                         .format(header['byte_order'], dim_path))
+    size_x, size_y, size_z, size_t = header['shape']
+    data = np.memmap(ima_path, dtype=dtype, mode='r',
+                     shape=(size_t, size_z, size_y, size_x, 3))
+    return data[0], header['voxel_size']
+
+
+def write_gis_field(ima_path, field, voxel_size):
+    """Write a displacement field of shape (z, y, x, 3) as a GIS volume."""
+    field = np.ascontiguousarray(field, dtype='<f4')
+    size_z, size_y, size_x, _ = field.shape
+    dim_path = os.path.splitext(ima_path)[0] + '.dim'
+    with open(dim_path, 'wt') as f:
+        f.write('{0} {1} {2} 1\n'.format(size_x, size_y, size_z))
+        f.write('-type POINT3DF\n')
+        f.write('-dx {0!r} -dy {1!r} -dz {2!r} -dt 1\n'
+                .format(*(float(v) for v in voxel_size)))
+        f.write('-bo DCBA\n')
+        f.write('-om binar\n')
+    field.tofile(ima_path)
+
+
+class AffineTransform:
+    def __init__(self, matrix):
+        self.matrix = np.asarray(matrix, dtype=np.float64)
+        self._inverse = None
+
+    def inverse(self):
+        # Loaded transformations are cached, so caching the inverse here
+        # saves a matrix inversion on every use of an inv: transformation
+        if self._inverse is None:
+            self._inverse = AffineTransform(np.linalg.inv(self.matrix))
+            self._inverse._inverse = self
+        return self._inverse
+
+    def transform(self, points):
+        return points @ self.matrix[:3, :3].T + self.matrix[:3, 3]
+
+
+class DisplacementFieldTransform:
+    """Displacement field applied with trilinear interpolation.
+
+    A point p (in millimetres) is mapped to p + D(p), where D is interpolated
+    from the vectors stored at the voxel centres of the field (the voxel
+    (i, j, k) is located at (i, j, k) × voxel_size). Points outside of the
+    field of view are not displaced.
+    """
+
+    def __init__(self, field, voxel_size):
+        self.field = field
+        self.voxel_size = np.asarray(voxel_size, dtype=np.float64)
+
+    def inverse(self):
+        raise UnsupportedTransformError(
+            'inversion of displacement fields is not supported')
+
+    def _dims(self):
+        # field is indexed as (z, y, x), reverse to get (x, y, z)
+        return np.array(self.field.shape[2::-1])
+
+    def inside(self, points):
+        """Test which points are within the field of view (boolean array)."""
+        voxel_coords = points / self.voxel_size
+        return np.all((voxel_coords >= 0)
+                      & (voxel_coords <= self._dims() - 1), axis=1)
+
+    def displacement(self, points):
+        field = self.field
+        dims = self._dims()
+        voxel_coords = points / self.voxel_size
+        inside = self.inside(points)
+        result = np.zeros_like(points)
+        if not np.any(inside):
+            return result
+        voxel_coords = voxel_coords[inside]
+        low = np.minimum(np.floor(voxel_coords).astype(np.intp),
+                         np.maximum(dims - 2, 0))
+        frac = voxel_coords - low
+        high = np.minimum(low + 1, dims - 1)
+        values = np.zeros((len(voxel_coords), 3))
+        for corner_x in (0, 1):
+            ix = high[:, 0] if corner_x else low[:, 0]
+            wx = frac[:, 0] if corner_x else 1 - frac[:, 0]
+            for corner_y in (0, 1):
+                iy = high[:, 1] if corner_y else low[:, 1]
+                wy = frac[:, 1] if corner_y else 1 - frac[:, 1]
+                for corner_z in (0, 1):
+                    iz = high[:, 2] if corner_z else low[:, 2]
+                    wz = frac[:, 2] if corner_z else 1 - frac[:, 2]
+                    weight = wx * wy * wz
+                    values += weight[:, np.newaxis] * field[iz, iy, ix]
+        result[inside] = values
+        return result
+
+    def transform(self, points):
+        return points + self.displacement(points)
+
+
+@functools.lru_cache(maxsize=LOADED_TRANSFORMS_CACHE_SIZE)
+def _load_transform_file(path, mtime_ns, size):
+    # mtime_ns and size are only used as cache keys, so that a modified file
+    # is re-loaded
+    logger.debug('Loading transformation %s', path)
+    if path.endswith('.trm'):
+        return AffineTransform(read_trm(path))
+    elif path.endswith('.ima'):
+        return DisplacementFieldTransform(*field_store.default_store.get(path))
+    else:
+        raise UnsupportedTransformError(
+            'unsupported transformation format: {0}'.format(path))
+
+
+def load_transform(transform, cwd=None):
+    """Load a transformation given in the syntax of AimsApplyTransform.
+
+    Relative paths are interpreted relative to cwd. Loaded transformations are
+    cached in memory for the lifetime of the process.
+    """
+    inverse = transform.startswith(INVERSE_PREFIX)
+    if inverse:
+        transform = transform[len(INVERSE_PREFIX):]
+    path = os.path.abspath(os.path.join(cwd or '', transform))
+    st = os.stat(path)
+    loaded = _load_transform_file(path, st.st_mtime_ns, st.st_size)
+    if inverse:
+        loaded = loaded.inverse()
+    return loaded
+
+
+def transform_points(source_points, direct_transform_chain, cwd=None):
+    """Apply a chain of transformations to an array of points.
+
+    The transformations are applied in the order of the chain, like with the
+    --direct-transform option of AimsApplyTransform. Returns an N×3 array.
+    """
+    # Load the whole chain first, so that UnsupportedTransformError is raised
+    # before doing any computation
+    transforms = [load_transform(t, cwd=cwd) for t in direct_transform_chain]
+    points = np.array(source_points, dtype=np.float64).reshape(-1, 3)
+    for t in transforms:
+        points = t.transform(points)
+    return points
+
+
+def is_affine_transform(transform):
+    """Test if a transformation (in AimsApplyTransform syntax) is affine."""
+    if transform.startswith(INVERSE_PREFIX):
+        transform = transform[len(INVERSE_PREFIX):]
+    return transform.endswith('.trm')
+
+
+def compose_affine_chain(direct_transform_chain, cwd=None):
+    """Compose a chain of affine transformations into one 4×4 matrix."""
+    matrix = np.eye(4)
+    for t in direct_transform_chain:
+        transform = load_transform(t, cwd=cwd)
+        if not isinstance(transform, AffineTransform):
+            raise UnsupportedTransformError(
+                'not an affine transformation: {0}'.format(t))
+        matrix = transform.matrix @ matrix
+    return matrix
+
+
+def fold_affine_transforms(direct_transform_chain, output_dir, cwd=None):
+    """Replace runs of consecutive affine transformations by a single one.
+
+    Each run of at least two .trm transformations (inverted or not) is
+    composed into one matrix, which is written to a .trm file in output_dir.
+    These files are named after a hash of their contents, so they can be
+    shared between chains and processes. The new chain is returned, the paths
+    to the composed files are relative to cwd if output_dir is below it.
+    """
+    folded_chain = []
+    run = []
+
+    def flush_run():
+        if len(run) >= 2:
+            matrix = compose_affine_chain(run, cwd=cwd)
+            path = _write_composed_trm(matrix, output_dir)
+            relpath = os.path.relpath(path, os.path.abspath(cwd or ''))
+            if not relpath.startswith(os.pardir):
+                path = relpath
+            folded_chain.append(path)
+        else:
+            folded_chain.extend(run)
+        run.clear()
+
+    for t in direct_transform_chain:
+        if is_affine_transform(t):
+            run.append(t)
+        else:
+            flush_run()
+            folded_chain.append(t)
+    flush_run()
+    return folded_chain
+
+
+def _write_composed_trm(matrix, output_dir):
+    contents = _format_trm(matrix)
+    digest = hashlib.sha1(contents.encode('ascii')).hexdigest()
+    path = os.path.abspath(os.path.join(output_dir,
+                                        'composed-{0}.trm'.format(digest)))
+    if not os.path.exists(path):
+        os.makedirs(output_dir, exist_ok=True)
+        # Write atomically, another process may be reading the file
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=output_dir)
+        try:
+            with os.fdopen(fd, 'wt') as f:
+                f.write(contents)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    return path
@@ -0,0 +1,227 @@
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Caches of transformed points.
+
+Two backends are provided: :class:`MemoryPointCache` is private to each
+server process, :class:`SQLitePointCache` stores the points in a SQLite
+database file that is shared by all the processes of a host (or a pod).
+"""
+
+import collections
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+
+class PointCache:
+    """Base class of the caches of transformed points.
+
+    Points are indexed by the transform chain (including the directory that
+    relative paths refer to, and a version of the transformations, see
+    file_digests.chain_digest) and by their source coordinates, rounded to
+    ``precision`` decimal places. Entries expire ``ttl`` seconds after they
+    have been stored (never if ttl is None).
+
+    Subclasses implement _get_many, _set_many, clear and __len__.
+    """
+
+    def __init__(self, max_size, ttl=None, precision=6):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.precision = precision
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def make_keys(self, source_points, direct_transform_chain, cwd=None,
+                  version=None):
+        chain_key = (cwd, tuple(direct_transform_chain), version)
+        precision = self.precision
+        if isinstance(source_points, np.ndarray):
+            source_points = source_points.tolist()
+        return [(chain_key, round(x, precision), round(y, precision),
+                 round(z, precision))
+                for x, y, z in source_points]
+
+    def get_many(self, keys):
+        """Look up a list of keys, None is returned for missing entries."""
+        results = self._get_many(keys)
+        hits = sum(1 for r in results if r is not None)
+        with self._lock:
+            self.hits += hits
+            self.misses += len(results) - hits
+        return results
+
+    def set_many(self, keys, values):
+        self._set_many(keys, [tuple(value) for value in values])
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self),
+            'max_size': self.max_size,
+        }
+
+
+class MemoryPointCache(PointCache):
+    """LRU cache of transformed points, private to the current process."""
+
+    def __init__(self, max_size, ttl=None, precision=6):
+        super().__init__(max_size, ttl=ttl, precision=precision)
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get_many(self, keys):
+        now = time.monotonic()
+        results = []
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    expiry_time, value = entry
+                    if expiry_time is None or expiry_time > now:
+                        self._entries.move_to_end(key)
+                        results.append(value)
+                        continue
+                    del self._entries[key]
+                results.append(None)
+        return results
+
+    def _set_many(self, keys, values):
+        expiry_time = None
+        if self.ttl is not None:
+            expiry_time = time.monotonic() + self.ttl
+        with self._lock:
+            for key, value in zip(keys, values):
+                self._entries[key] = (expiry_time, value)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLitePointCache(PointCache):
+    """Cache of transformed points shared between processes.
+
+    The points are stored in a SQLite database at ``path``, which should be on
+    a local filesystem (e.g. under /dev/shm). When the cache is full, the
+    points that were stored first are evicted first.
+    """
+
+    def __init__(self, path, max_size, ttl=None, precision=6):
+        super().__init__(max_size, ttl=ttl, precision=precision)
+        self.path = path
+        self._connection = None
+        self._connection_pid = None
+
+    def _connect(self):
+        # Connections must not be shared with forked child processes
+        if self._connection_pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=10,
+                                         isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=OFF')
+            connection.execute('PRAGMA temp_store=MEMORY')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS points ('
+                'chain TEXT, x REAL, y REAL, z REAL, '
+                'tx REAL, ty REAL, tz REAL, expiry REAL, '
+                'PRIMARY KEY (chain, x, y, z))')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS points_expiry ON points (expiry)')
+            # Keys that are looked up together are joined with the points
+            connection.execute(
+                'CREATE TEMP TABLE IF NOT EXISTS lookup ('
+                'i INTEGER PRIMARY KEY, chain TEXT, x REAL, y REAL, z REAL)')
+            self._connection = connection
+            self._connection_pid = os.getpid()
+        return self._connection
+
+    def __len__(self):
+        with self._lock:
+            connection = self._connect()
+            return connection.execute(
+                'SELECT COUNT(*) FROM points').fetchone()[0]
+
+    @staticmethod
+    def _chain_key(key):
+        return json.dumps(key[0])
+
+    def _get_many(self, keys):
+        now = time.time()
+        chain_keys = {}
+        rows = []
+        for i, key in enumerate(keys):
+            chain_key = chain_keys.get(key[0])
+            if chain_key is None:
+                chain_key = chain_keys[key[0]] = self._chain_key(key)
+            rows.append((i, chain_key) + key[1:])
+        results = [None] * len(keys)
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute('BEGIN')
+                connection.executemany(
+                    'INSERT INTO lookup VALUES (?, ?, ?, ?, ?)', rows)
+                found = connection.execute(
+                    'SELECT lookup.i, tx, ty, tz FROM lookup '
+                    'JOIN points USING (chain, x, y, z) '
+                    'WHERE expiry IS NULL OR expiry > ?', (now,)).fetchall()
+                connection.execute('DELETE FROM lookup')
+        for row in found:
+            results[row[0]] = row[1:]
+        return results
+
+    def _set_many(self, keys, values):
+        now = time.time()
+        expiry_time = None
+        if self.ttl is not None:
+            expiry_time = now + self.ttl
+        rows = [(self._chain_key(key),) + key[1:] + value + (expiry_time,)
+                for key, value in zip(keys, values)]
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute('BEGIN')
+                connection.executemany(
+                    'INSERT OR REPLACE INTO points VALUES (?, ?, ?, ?, ?, ?, '
+                    '?, ?)', rows)
+                connection.execute('DELETE FROM points WHERE expiry <= ?',
+                                   (now,))
+                # Rows get increasing rowids, so this evicts the oldest rows
+                count = connection.execute(
+                    'SELECT COUNT(*) FROM points').fetchone()[0]
+                if count > self.max_size:
+                    connection.execute(
+                        'DELETE FROM points WHERE rowid IN ('
+                        'SELECT rowid FROM points ORDER BY rowid LIMIT ?)',
+                        (count - self.max_size,))
+
+    def clear(self):
+        with self._lock:
+            self._connect().execute('DELETE FROM points')
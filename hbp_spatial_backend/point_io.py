@@ -0,0 +1,210 @@
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Binary and streaming encodings of arrays of points.
+
+Two binary encodings of an N×3 array of coordinates are supported:
+
+- ``application/octet-stream``: packed little-endian floats (float32 or
+  float64), in the order x₀, y₀, z₀, x₁, y₁, z₁…;
+
+- ``application/x-npy``: the NumPy ``.npy`` format, holding a C-ordered
+  array of shape (N, 3) of float32 or float64.
+
+Streams of points can be read incrementally (see :func:`iter_points_chunks`)
+from ``application/octet-stream`` or from newline-delimited JSON
+(``application/x-ndjson``), which holds one ``[x, y, z]`` array per line.
+"""
+
+import io
+import json
+
+import numpy as np
+import numpy.lib.format
+
+
+OCTET_STREAM_MIMETYPE = 'application/octet-stream'
+NPY_MIMETYPE = 'application/x-npy'
+NDJSON_MIMETYPE = 'application/x-ndjson'
+BINARY_MIMETYPES = (OCTET_STREAM_MIMETYPE, NPY_MIMETYPE)
+STREAMING_MIMETYPES = (NDJSON_MIMETYPE, OCTET_STREAM_MIMETYPE)
+
+DTYPES = {
+    'float32': np.dtype('<f4'),
+    'float64': np.dtype('<f8'),
+}
+
+
+def parse_points_buffer(data, mimetype, dtype='float64'):
+    """Decode an N×3 array of points from a binary buffer.
+
+    The returned array is a read-only view on data (no copy is made). For
+    application/octet-stream, dtype is the name of the data type (float32 or
+    float64), the .npy format carries its own data type. Raises ValueError if
+    the buffer is malformed or if the points are not finite.
+    """
+    if mimetype == OCTET_STREAM_MIMETYPE:
+        try:
+            dtype = DTYPES[dtype]
+        except KeyError:
+            raise ValueError('unsupported dtype: {0}'.format(dtype))
+        if len(data) % (3 * dtype.itemsize) != 0:
+            raise ValueError('the buffer size is not a multiple of 3 '
+                             '{0}'.format(dtype.name))
+        points = np.frombuffer(data, dtype=dtype).reshape(-1, 3)
+    elif mimetype == NPY_MIMETYPE:
+        stream = io.BytesIO(data)
+        version = numpy.lib.format.read_magic(stream)
+        if version == (1, 0):
+            header = numpy.lib.format.read_array_header_1_0(stream)
+        elif version == (2, 0):
+            header = numpy.lib.format.read_array_header_2_0(stream)
+        else:
+            raise ValueError('unsupported .npy version: {0}.{1}'
+                             .format(*version))
+        shape, fortran_order, dtype = header
+        if dtype not in (np.dtype('<f4'), np.dtype('<f8'),
+                         np.dtype('>f4'), np.dtype('>f8')):
+            raise ValueError('unsupported dtype: {0}'.format(dtype))
+        if len(shape) != 2 or shape[1] != 3:
+            raise ValueError('the array must have shape (N, 3)')
+        if fortran_order:
+            raise ValueError('the array must be in C order')
+        count = shape[0] * 3
+        if len(data) - stream.tell() != count * dtype.itemsize:
+            raise ValueError('truncated .npy data')
+        points = np.frombuffer(data, dtype=dtype, count=count,
+                               offset=stream.tell()).reshape(shape)
+    else:
+        raise ValueError('unsupported MIME type: {0}'.format(mimetype))
+    if not np.all(np.isfinite(points)):
+        raise ValueError('the coordinates must be finite')
+    return points
+
+
+def points_to_buffer(points, mimetype, dtype='float64'):
+    """Encode an N×3 array of points into bytes."""
+    try:
+        dtype = DTYPES[dtype]
+    except KeyError:
+        raise ValueError('unsupported dtype: {0}'.format(dtype))
+    points = np.ascontiguousarray(points, dtype=dtype).reshape(-1, 3)
+    if mimetype == OCTET_STREAM_MIMETYPE:
+        return points.tobytes()
+    elif mimetype == NPY_MIMETYPE:
+        stream = io.BytesIO()
+        np.save(stream, points, allow_pickle=False)
+        return stream.getvalue()
+    else:
+        raise ValueError('unsupported MIME type: {0}'.format(mimetype))
+
+
+def iter_points_chunks(stream, mimetype, chunk_size, dtype='float64'):
+    """Read points from a file-like object, chunk by chunk.
+
+    This generator yields N×3 arrays of at most chunk_size points, so that
+    the memory use does not depend on the total number of points. mimetype
+    is one of STREAMING_MIMETYPES, dtype is used for
+    application/octet-stream. Raises ValueError when reaching malformed data
+    (the chunks that come before it have been yielded already).
+    """
+    if mimetype == OCTET_STREAM_MIMETYPE:
+        return _iter_octet_stream_chunks(stream, chunk_size, dtype)
+    elif mimetype == NDJSON_MIMETYPE:
+        return _iter_ndjson_chunks(stream, chunk_size)
+    else:
+        raise ValueError('unsupported MIME type for streaming: {0}'
+                         .format(mimetype))
+
+
+def _iter_octet_stream_chunks(stream, chunk_size, dtype):
+    try:
+        dtype = DTYPES[dtype]
+    except KeyError:
+        raise ValueError('unsupported dtype: {0}'.format(dtype))
+    chunk_bytes = chunk_size * 3 * dtype.itemsize
+    while True:
+        # A read may return less than requested before the end of stream
+        parts = []
+        size = 0
+        while size < chunk_bytes:
+            data = stream.read(chunk_bytes - size)
+            if not data:
+                break
+            parts.append(data)
+            size += len(data)
+        if not size:
+            return
+        data = b''.join(parts)
+        if len(data) % (3 * dtype.itemsize) != 0:
+            raise ValueError('the stream size is not a multiple of 3 '
+                             '{0}'.format(dtype.name))
+        points = np.frombuffer(data, dtype=dtype).reshape(-1, 3)
+        if not np.all(np.isfinite(points)):
+            raise ValueError('the coordinates must be finite')
+        yield points
+        if size < chunk_bytes:
+            return
+
+
+def _iter_ndjson_chunks(stream, chunk_size):
+    lines = []
+    line_numbers = []
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        lines.append(line)
+        line_numbers.append(line_number)
+        if len(lines) >= chunk_size:
+            yield _parse_ndjson_lines(lines, line_numbers)
+            lines = []
+            line_numbers = []
+    if lines:
+        yield _parse_ndjson_lines(lines, line_numbers)
+
+
+def _parse_ndjson_lines(lines, line_numbers):
+    data = b'[' + b','.join(lines) + b']'
+    points = None
+    # NumPy would silently convert booleans mixed with numbers
+    if b'true' not in data and b'false' not in data:
+        try:
+            points = np.array(json.loads(data))
+        except ValueError:
+            pass
+    if (points is not None and points.dtype.kind in 'iuf'
+            and points.ndim == 2 and points.shape[1] == 3
+            and np.all(np.isfinite(points))):
+        return points.astype(np.float64, copy=False)
+    # Find the offending line to produce a helpful error message
+    for line_number, line in zip(line_numbers, lines):
+        try:
+            point = json.loads(line)
+        except ValueError:
+            raise ValueError('line {0}: invalid JSON'.format(line_number))
+        try:
+            valid = (isinstance(point, list) and len(point) == 3
+                     and all(type(c) in (int, float) for c in point)
+                     and np.all(np.isfinite(np.array(point,
+                                                     dtype=np.float64))))
+        except OverflowError:
+            valid = False
+        if not valid:
+            raise ValueError('line {0}: each line must contain an array of '
+                             '3 finite numbers'.format(line_number))
+    raise ValueError('lines {0} to {1}: each line must contain an array of 3 '
+                     'finite numbers'.format(line_numbers[0],
+                                             line_numbers[-1]))
@@ -0,0 +1,126 @@
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Profiling of individual requests (enabled by the ENABLE_PROFILING setting).
+
+A request is profiled if it has the ``X-Profile`` header or the ``profile``
+query parameter (with any value but ``0``). The request is then run under
+cProfile, which covers the whole processing of the request (including
+api_v1._get_transform_graph and apply_transform.transform_points), and:
+
+- the profile is stored in PROFILING_DIR, in the binary format of the pstats
+  module (use e.g. ``python -m pstats`` or snakeviz to read it), and its file
+  name is returned in the ``X-Profile-File`` response header;
+- the time spent in each stage of the request (see metrics.stage) is
+  returned in the ``Server-Timing`` response header, in milliseconds.
+
+Only the thread that handles the request is profiled: the chunks of big
+batches that are transformed in parallel are not, and under gevent the
+profile includes the other greenlets that run at the same time. The body of
+streamed responses is produced after the profile has been collected.
+"""
+
+import cProfile
+import itertools
+import logging
+import os
+import time
+
+import flask
+from flask import g
+
+from hbp_spatial_backend import metrics
+
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_QUERY_PARAMETER = 'profile'
+
+# Makes the names of the profiles unique within a process
+_profile_counter = itertools.count()
+
+
+def is_profiling_requested(request):
+    value = request.headers.get(PROFILE_HEADER)
+    if value is None:
+        value = request.args.get(PROFILE_QUERY_PARAMETER)
+    return value is not None and value != '0'
+
+
+def format_server_timing(stage_timings, total_time=None):
+    """Format the value of a Server-Timing header.
+
+    stage_timings is a list of (name, seconds) tuples, the times of stages
+    that occur several times are added up.
+    """
+    durations = {}
+    for name, elapsed_time in stage_timings:
+        durations[name] = durations.get(name, 0.0) + elapsed_time
+    if total_time is not None:
+        durations['total'] = total_time
+    return ', '.join('{0};dur={1:.3f}'.format(name, 1000 * elapsed_time)
+                     for name, elapsed_time in durations.items())
+
+
+def init_app(app):
+    """Set up the profiling of the requests of the application."""
+    profiles_dir = (app.config['PROFILING_DIR']
+                    or os.path.join(app.instance_path, 'profiles'))
+
+    @app.before_request
+    def start_profiling():
+        metrics.start_request_timer()
+        if not is_profiling_requested(flask.request):
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as exc:
+            # Only one profiler can be active at a time since Python 3.12
+            logger.warning('Cannot profile the request: %s', exc)
+            return
+        g.profiler = profiler
+
+    @app.after_request
+    def finish_profiling(response):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return response
+        profiler.disable()
+        total_time = time.perf_counter() - g.request_start_time
+        response.headers['Server-Timing'] = format_server_timing(
+            g.get('stage_timings', []), total_time)
+        file_name = '{0}-{1}-{2}-{3}.prof'.format(
+            time.strftime('%Y%m%dT%H%M%S'), os.getpid(),
+            next(_profile_counter), flask.request.endpoint or 'unknown')
+        try:
+            os.makedirs(profiles_dir, exist_ok=True)
+            profiler.dump_stats(os.path.join(profiles_dir, file_name))
+        except OSError as exc:
+            logger.warning('Cannot store the profile: %s', exc)
+        else:
+            logger.info('Profile of %s stored in %s', flask.request.path,
+                        file_name)
+            response.headers['X-Profile-File'] = file_name
+        return response
+
+    @app.teardown_request
+    def stop_profiling(exc):
+        # The profiler is still enabled if the request raised an exception
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.disable()
@@ -0,0 +1,186 @@
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Content-addressed store of the results of /v1/transform-points.
+
+Each result is stored on disk under a key that is a hash of the transform
+chain, of the contents of its files, and of the source points. The results
+can then be downloaded from a GET URL, which is immutable and therefore
+cacheable by browsers and reverse proxies. The store is shared by all the
+server processes that use the same directory. When it exceeds its maximum
+size, the least recently used results are evicted.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+
+from flask import current_app
+import numpy as np
+
+from hbp_spatial_backend import extensions
+from hbp_spatial_backend import file_digests
+
+
+logger = logging.getLogger(__name__)
+
+KEY_RE = re.compile(r'^[0-9a-f]{64}$')
+
+_SUFFIX = '.npy'
+
+# The directory is re-scanned at least every EVICTION_INTERVAL puts, to take
+# into account the results that are stored by the other processes
+EVICTION_INTERVAL = 100
+
+
+def result_key(direct_transform_chain, source_points, cwd=None,
+               shortcut=None):
+    """Compute the key of the result of a transformation.
+
+    See apply_transform.transform_points for the shortcut argument. Raises
+    OSError if a file of the chain cannot be read.
+    """
+    h = hashlib.sha256()
+    h.update(file_digests.chain_digest(direct_transform_chain,
+                                       cwd=cwd).encode('ascii'))
+    if shortcut is not None:
+        h.update(file_digests.chain_digest(shortcut,
+                                           cwd=cwd).encode('ascii'))
+    h.update(np.ascontiguousarray(source_points, dtype='<f8').tobytes())
+    return h.hexdigest()
+
+
+class ResultStore:
+    """Results stored as .npy files in a directory, up to max_size bytes."""
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # Running estimate of the total size, None if it must be re-scanned
+        self._size = None
+        self._puts_since_eviction = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        if not KEY_RE.match(key):
+            raise ValueError('invalid result key: {0!r}'.format(key))
+        return os.path.join(self.directory, key + _SUFFIX)
+
+    def get(self, key):
+        """Get a result as an N×3 array (None if absent)."""
+        path = self._path(key)
+        try:
+            array = np.load(path, allow_pickle=False)
+            # The modification time records the last use, for eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as exc:
+            logger.warning('Cannot read result %s: %s', path, exc)
+            return None
+        return array
+
+    def put(self, key, target_points):
+        """Store a result, then evict old results if the store is full.
+
+        Return False if the result is not stored because it is larger than
+        the whole store.
+        """
+        path = self._path(key)
+        array = np.asarray(target_points, dtype=np.float64).reshape(-1, 3)
+        if array.nbytes > self.max_size:
+            logger.debug('Result %s is too large to be stored (%d bytes)',
+                         key, array.nbytes)
+            return False
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, array, allow_pickle=False)
+                size = f.tell()
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        with self._lock:
+            self._puts_since_eviction += 1
+            if self._size is not None:
+                self._size += size
+            must_evict = (self._size is None
+                          or self._size > self.max_size
+                          or self._puts_since_eviction >= EVICTION_INTERVAL)
+        if must_evict:
+            self.evict()
+        return True
+
+    def evict(self):
+        """Remove the least recently used results beyond max_size."""
+        with self._lock:
+            entries = []
+            total_size = 0
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if not entry.name.endswith(_SUFFIX):
+                        continue
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue  # evicted by another process
+                    entries.append((st.st_mtime_ns, st.st_size, entry.path))
+                    total_size += st.st_size
+            self._puts_since_eviction = 0
+            if total_size > self.max_size:
+                entries.sort()
+                for _, size, path in entries:
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+                    total_size -= size
+                    if total_size <= self.max_size:
+                        break
+            self._size = total_size
+
+    def stats(self):
+        sizes = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(_SUFFIX):
+                    try:
+                        sizes.append(entry.stat().st_size)
+                    except FileNotFoundError:
+                        pass
+        return {
+            'results': len(sizes),
+            'size': sum(sizes),
+            'max_size': self.max_size,
+        }
+
+
+def get_result_store(app=None):
+    """Get the result store of the application (None if disabled)."""
+    if app is None:
+        app = current_app._get_current_object()
+    max_size = app.config['RESULT_STORE_SIZE']
+    if not max_size:
+        return None
+    directory = (app.config['RESULT_STORE_DIR']
+                 or os.path.join(app.instance_path, 'results'))
+    return extensions.get_extension(
+        app, 'result_store', lambda: ResultStore(directory, max_size))
@@ -0,0 +1,139 @@
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Coalescing of concurrent identical calls ("single flight").
+
+When several requests ask for the same computation at the same time (e.g.
+the clients of a viewer that ask for the same point when a page loads), the
+first call runs the computation and the others wait for its result, instead
+of each running its own AimsApplyTransform process.
+
+Only calls that are in flight at the same time are coalesced, results are
+not kept afterwards (that is the job of the point cache). The waiting uses
+the primitives of the threading module, so it also works with greenlets
+under gevent (see hbp_spatial_backend.extensions).
+"""
+
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class AbandonedError(Exception):
+    """Raised by Flight.wait if the leader has given up the computation."""
+
+
+class Flight:
+    """A computation that is run by a leader and shared with waiters.
+
+    The leader calls run, the waiters call wait. Only the result, or an
+    Exception, is shared. If the leader is interrupted by a BaseException
+    (e.g. GreenletExit or gevent.Timeout, which are meant for the leader
+    alone), the waiters get AbandonedError, and should start over.
+    """
+
+    def __init__(self):
+        self.waiters = 0
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+        self._abandoned = False
+
+    def run(self, func, detach=None):
+        """Call func and share its outcome with the waiters.
+
+        detach is called before the waiters are woken up, e.g. to stop new
+        waiters from joining this flight.
+        """
+        try:
+            self._result = func()
+        except Exception as exc:
+            self._exception = exc
+            raise
+        except BaseException:
+            self._abandoned = True
+            raise
+        finally:
+            if detach is not None:
+                detach()
+            self._done.set()
+        return self._result
+
+    def wait(self):
+        """Wait for the outcome of the flight, and return its result.
+
+        Raises the exception of the leader, or AbandonedError.
+        """
+        self._done.wait()
+        if self._abandoned:
+            raise AbandonedError()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+class SingleFlight:
+    """Deduplication of the concurrent calls that have the same key."""
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._num_calls = 0
+        self._num_coalesced = 0
+
+    def __len__(self):
+        return len(self._flights)
+
+    def do(self, key, func):
+        """Call func, unless a call with the same key is already in flight.
+
+        In that case, wait for the call in flight and return its result (or
+        raise its exception). The result is shared by all the callers, so it
+        must not be modified. If the call in flight is interrupted by a
+        BaseException, its waiters start over, one of them calling func.
+        """
+        while True:
+            with self._lock:
+                flight = self._flights.get(key)
+                if flight is None:
+                    flight = self._flights[key] = Flight()
+                    self._num_calls += 1
+                    break
+                flight.waiters += 1
+                self._num_coalesced += 1
+            try:
+                return flight.wait()
+            except AbandonedError:
+                logger.debug('The call in flight was interrupted, retrying')
+
+        def detach():
+            with self._lock:
+                del self._flights[key]
+            if flight.waiters:
+                logger.debug('%d identical calls coalesced', flight.waiters)
+
+        return flight.run(func, detach)
+
+    def stats(self):
+        """Report the number of calls that were run and coalesced."""
+        with self._lock:
+            return {
+                'in_flight': len(self._flights),
+                'calls': self._num_calls,
+                'coalesced_calls': self._num_coalesced,
+            }
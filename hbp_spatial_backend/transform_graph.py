@@ -16,6 +16,7 @@
 
 import collections
 import logging
+import types
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +24,21 @@ logger = logging.getLogger(__name__)
 class TransformGraph:
     def __init__(self):
         self.links = {}
+        self.shortcuts = {}
+
+    @property
+    def links(self):
+        """Dictionary of the links: {from_space: {to_space: transform}}.
+
+        The links must be modified through add_space, add_link and
+        remove_link, so that the table of transform chains is kept up to date.
+        """
+        return self._links
+
+    @links.setter
+    def links(self, links):
+        self._links = links
+        self._chain_table = None
 
     @classmethod
     def from_yaml(cls, yaml_stream):
@@ -30,6 +46,20 @@ class TransformGraph:
         links = yaml.safe_load(yaml_stream)
         if not isinstance(links, dict):
             raise ValueError('Malformed TransformGraph YAML file')
+        # Shortcuts are written like links, but are kept apart
+        shortcuts = {}
+        for source, targets in links.items():
+            for target, link in list(targets.items()):
+                if not isinstance(link, dict):
+                    continue
+                shortcut = link.get('shortcut')
+                if (len(link) != 1 or not isinstance(shortcut, list)
+                        or not all(isinstance(t, str) for t in shortcut)):
+                    raise ValueError('Malformed shortcut from {0!r} to {1!r} '
+                                     'in the TransformGraph YAML file'
+                                     .format(source, target))
+                shortcuts[source, target] = shortcut
+                del targets[target]
         # Ensure that every space that is listed as a target also appears as a
         # source
         sources_to_add = []
@@ -46,6 +76,8 @@ class TransformGraph:
             links.setdefault(space, {})
         tg = cls()
         tg.links = links
+        tg.shortcuts = shortcuts
+        tg.get_chain_table()  # precompute the chains at load time
         return tg
 
     def add_space(self, name):
@@ -53,21 +85,107 @@ class TransformGraph:
         if name in self.links:
             raise ValueError('there is already a space named {0}'.format(name))
         self.links[name] = {}
+        self._chain_table = None
 
     def add_link(self, from_space, to_space, transform_file):
         if to_space in self.links[from_space]:
             raise ValueError('{0} already has a link to {1}'.format(from_space,
                                                                     to_space))
         self.links[from_space][to_space] = transform_file
+        self._chain_table = None
 
     def remove_link(self, from_space, to_space):
         del self.links[from_space][to_space]
+        self._chain_table = None
+
+    def add_shortcut(self, from_space, to_space, transform_files):
+        self.shortcuts[from_space, to_space] = list(transform_files)
+
+    def get_shortcut(self, from_space, to_space):
+        """Get the shortcut from a space to another (None if there is none).
+
+        A shortcut is a list of transform files that approximates the
+        transform chain between two spaces within a bounded region (see
+        hbp_spatial_backend.compose_field). Shortcuts are not links: they
+        are not part of the transform chains.
+        """
+        shortcut = self.shortcuts.get((from_space, to_space))
+        return list(shortcut) if shortcut is not None else None
+
+    def iter_transforms(self):
+        """Iterate over the transforms of every link and shortcut.
+
+        Each transform is only listed once.
+        """
+        seen = set()
+        transforms = [link for targets in self.links.values()
+                      for link in targets.values()]
+        for shortcut in self.shortcuts.values():
+            transforms.extend(shortcut)
+        for transform in transforms:
+            if transform not in seen:
+                seen.add(transform)
+                yield transform
+
+    def get_chain_table(self):
+        """Get the shortest transform chain between every pair of spaces.
+
+        The table is a read-only mapping of (from_space, to_space) to a tuple
+        of transforms, pairs that are not connected are absent. It is computed
+        on first use, and re-computed after the graph has been modified.
+        """
+        if self._chain_table is None:
+            table = {}
+            for from_space in self.links:
+                for to_space, chain in self._find_all_chains(from_space):
+                    table[from_space, to_space] = tuple(chain)
+            self._chain_table = types.MappingProxyType(table)
+        return self._chain_table
 
     def get_transform_chain(self, from_space, to_space):
         # Trigger KeyError if the source or target space does not exist
         self.links[from_space]
         self.links[to_space]
 
+        chain = self.get_chain_table().get((from_space, to_space))
+        if chain is None:
+            return None
+        return list(chain)
+
+    def _find_all_chains(self, from_space):
+        """Yield (to_space, chain) for every space reachable from from_space.
+
+        This is a breadth-first search over the whole graph, which finds the
+        same chains as _find_transform_chain.
+        """
+        to_visit = collections.deque([from_space])
+        back_pointers = {from_space: (None, None)}
+        while to_visit:
+            space = to_visit.popleft()
+            chain = []
+            to_space = space
+            while back_pointers[to_space][0] is not None:
+                to_space, transform = back_pointers[to_space]
+                chain.append(transform)
+            chain.reverse()
+            yield space, chain
+
+            for target_space, transform in self.links[space].items():
+                if target_space not in back_pointers:
+                    to_visit.append(target_space)
+                    back_pointers[target_space] = (space, transform)
+
+    def _find_transform_chain(self, from_space, to_space):
+        """Find the shortest transform chain between two spaces.
+
+        This is the reference implementation for a single pair of spaces, the
+        chains are normally looked up in the table returned by
+        get_chain_table.
+        """
+        # Trigger KeyError if the source or target space does not exist
+        self.links[from_space]
+        self.links[to_space]
+
         to_visit = collections.deque([from_space])
         visited = {from_space}
         back_pointers = {from_space: (None, None)}
@@ -0,0 +1,164 @@
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+"""Warm-up of a server process (enabled by the WARM_UP setting).
+
+The warm-up loads the transform graph, resolves every transform chain, reads
+every transform file (so that it is in the page cache, instead of being
+faulted in from the network storage by the first requests, and so that its
+digest is ready for computing ETags, see file_digests), and optionally
+transforms a canary point between every pair of spaces (WARM_UP_CANARY),
+which also runs AimsApplyTransform once.
+
+The warm-up runs in a background thread of each server process, which is
+started as soon as the process can serve requests: by create_app, or under
+gunicorn by the post_worker_init hook of hbp_spatial_backend.gunicorn_config.
+Under ``gunicorn --preload`` the application is created in the master
+process, whose threads do not survive the fork of the workers (and gevent
+workers only monkey-patch the threading module after the fork), so
+create_app leaves the warm-up to that hook. As a fallback, the warm-up of a
+process is also started by its first health probe.
+
+If the warm-up fails, /health keeps returning 503 and reports the error.
+"""
+
+import logging
+import os
+import sys
+import threading
+import time
+
+from flask import current_app
+
+
+logger = logging.getLogger(__name__)
+
+# Point that is transformed between every pair of spaces by the canary
+CANARY_POINT = (0.0, 0.0, 0.0)
+
+
+class WarmUpState:
+    def __init__(self):
+        self.pid = os.getpid()
+        self.done = threading.Event()
+        self.thread = None
+        # Description of the exception that made the warm-up fail, if any
+        self.error = None
+
+
+_warm_up_lock = threading.Lock()
+
+
+def init_app(app):
+    """Start the warm-up of the process that creates the application.
+
+    Under gunicorn, the warm-up of each worker is started by the
+    post_worker_init hook of hbp_spatial_backend.gunicorn_config instead.
+    """
+    if 'gunicorn' not in sys.modules:
+        ensure_started(app)
+
+
+def ensure_started(app):
+    """Start the warm-up of the current process, unless already started."""
+    with _warm_up_lock:
+        state = app.extensions.get('hbp_spatial_backend.warm_up')
+        # A state that was inherited from the parent process is stale
+        if state is None or state.pid != os.getpid():
+            state = WarmUpState()
+            state.thread = threading.Thread(target=_run_warm_up,
+                                            args=(app, state),
+                                            name='warm-up', daemon=True)
+            app.extensions['hbp_spatial_backend.warm_up'] = state
+            state.thread.start()
+    return state
+
+
+def is_ready(app):
+    """Test if the warm-up of the current process has completed successfully.
+
+    The warm-up is started if needed.
+    """
+    state = ensure_started(app)
+    return state.done.is_set() and state.error is None
+
+
+def get_error(app):
+    """Return the error that made the warm-up of this process fail, or None."""
+    state = app.extensions.get('hbp_spatial_backend.warm_up')
+    if state is None or state.pid != os.getpid():
+        return None
+    return state.error
+
+
+def _run_warm_up(app, state):
+    time_before = time.perf_counter()
+    try:
+        with app.app_context():
+            warm_up()
+        logger.info('Warm-up completed in %.3f s',
+                    time.perf_counter() - time_before)
+    except Exception as exc:
+        # The process could still serve requests, but it reports the failure
+        # on /health instead of hiding it
+        logger.exception('Warm-up failed')
+        state.error = '{0}: {1}'.format(type(exc).__name__, exc)
+    finally:
+        state.done.set()
+
+
+def warm_up():
+    """Load the transform graph and the transform files of the application.
+
+    Must be called within an application context. Errors on individual files
+    or canary transformations are logged, and do not stop the warm-up.
+    """
+    from hbp_spatial_backend import api_v1
+    from hbp_spatial_backend import apply_transform
+    from hbp_spatial_backend import field_store
+    from hbp_spatial_backend import file_digests
+
+    tg_path = current_app.config['DEFAULT_TRANSFORM_GRAPH']
+    cwd = os.path.dirname(tg_path)
+    tg = api_v1.load_transform_graph(tg_path)
+    chain_table = tg.get_chain_table()
+    logger.info('Warm-up: %d transform chains', len(chain_table))
+
+    file_digests.file_digest(tg_path)
+    for transform in tg.iter_transforms():
+        paths = file_digests.transform_files(transform, cwd=cwd)
+        try:
+            if paths[0].endswith('.ima'):
+                field_store.default_store.preload(paths[0])
+            # Hashing a file reads it (yielding between its chunks)
+            for path in paths:
+                file_digests.file_digest(path)
+        except (OSError, ValueError) as exc:
+            logger.warning('Warm-up: cannot read %s: %s', paths[0], exc)
+        # Let other greenlets run if gevent is in use
+        time.sleep(0)
+
+    if current_app.config['WARM_UP_CANARY']:
+        for (source_space, target_space), chain in sorted(
+                chain_table.items()):
+            if not chain:
+                continue
+            try:
+                apply_transform.transform_points([CANARY_POINT], list(chain),
+                                                 cwd=cwd)
+            except Exception as exc:
+                logger.warning('Warm-up: canary transformation from %r to %r '
+                               'failed: %s', source_space, target_space, exc)
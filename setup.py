@@ -58,6 +58,7 @@ setuptools.setup(
         "Flask-Cors",
         "flask-smorest ~= 0.18.4",
         "marshmallow ~= 3.0",
+        "numpy",
         # see https://github.com/yaml/pyyaml/issues/601
         # see https://github.com/yaml/pyyaml/issues/723
         # see https://github.com/yaml/pyyaml/issues/724
@@ -76,6 +77,13 @@ setuptools.setup(
             "readme_renderer",
             "tox",
         ],
+        "compression": [
+            "brotli",
+            "zstandard",
+        ],
+        "metrics": [
+            "prometheus_client",
+        ],
         "tests": tests_require,
     },
     setup_requires=pytest_runner,
@@ -14,6 +14,9 @@
 # See the Licence for the specific language governing permissions and
 # limitations under the Licence.
 
+import os
+import sys
+
 import pytest
 
 import hbp_spatial_backend
@@ -30,3 +33,34 @@ def app():
 @pytest.fixture
 def client(app):
     return app.test_client()
+
+
+# Stand-in for AimsApplyTransform, which applies the translation given by the
+# STUB_AIMS_OFFSET environment variable, after sleeping for STUB_AIMS_DELAY
+# seconds.
+STUB_AIMS_APPLY_TRANSFORM = '''\
+#!{python}
+import os
+import sys
+import time
+time.sleep(float(os.environ.get('STUB_AIMS_DELAY', '0')))
+offset = float(os.environ.get('STUB_AIMS_OFFSET', '0'))
+print('AIMS prints messages on stdout that should be ignored')
+for line in sys.stdin:
+    x, y, z = (float(c) + offset for c in line.strip('()\\n').split(','))
+    print('({{0}}, {{1}}, {{2}})'.format(x, y, z))
+'''
+
+
+@pytest.fixture
+def stub_aims(tmpdir, monkeypatch):
+    """Put a stub AimsApplyTransform executable first on the PATH."""
+    bin_dir = tmpdir / 'stub_bin'
+    bin_dir.mkdir()
+    path = str(bin_dir / 'AimsApplyTransform')
+    with open(path, 'w') as f:
+        f.write(STUB_AIMS_APPLY_TRANSFORM.format(python=sys.executable))
+    os.chmod(path, 0o755)
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep
+                       + os.environ.get('PATH', ''))
+    return path
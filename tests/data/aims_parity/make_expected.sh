@@ -0,0 +1,25 @@
+#! /bin/sh
+#
+# Regenerate the expected outputs of the AIMS parity tests
+# (test_numpy_engine_matches_AIMS_reference in tests/test_numpy_transform.py)
+# by running AimsApplyTransform on points.txt, e.g. in the image built from
+# docker-aims/.
+#
+# field.ima is a multilinear displacement field on 4×3×2 voxels of
+# 2×1.5×3 mm, points.txt holds points inside the field, exactly on its
+# borders, and just outside of it.
+
+set -e
+cd "$(dirname -- "$0")"
+
+run() {
+    output=$1
+    shift
+    AimsApplyTransform --points --input points.txt --output "$output" "$@"
+}
+
+run expected-field.txt --direct-transform field.ima
+run expected-affine-field.txt \
+    --direct-transform affine.trm --direct-transform field.ima
+run expected-field-invaffine.txt \
+    --direct-transform field.ima --direct-transform inv:affine.trm
@@ -14,6 +14,11 @@
 # See the Licence for the specific language governing permissions and
 # limitations under the Licence.
 
+import io
+import json
+import os
+
+import numpy as np
 import pytest
 
 
@@ -29,7 +34,8 @@ def dummy_graph_yaml(tmpdir):
 def fake_apply_transform(monkeypatch):
     from hbp_spatial_backend import apply_transform
 
-    def transform_points_mock(source_points, transform_chain, cwd=None):
+    def transform_points_mock(source_points, transform_chain, cwd=None,
+                              shortcut=None):
         if transform_chain in (['A_to_B'], ['B_to_A']):
             return [tuple(point) for point in source_points]
         raise RuntimeError('Unexpected call')
@@ -47,6 +53,31 @@ def test__get_transform_graph(app, dummy_graph_yaml):
     assert tg1 is tg2  # test that the graph is only loaded once per request
 
 
+def test_transform_graph_cache(app, dummy_graph_yaml):
+    from hbp_spatial_backend import api_v1
+    app.config['DEFAULT_TRANSFORM_GRAPH'] = dummy_graph_yaml
+    with app.test_request_context():
+        tg1 = api_v1._get_transform_graph()
+    with app.test_request_context():
+        tg2 = api_v1._get_transform_graph()
+    assert tg1 is tg2  # the graph is cached across requests
+
+    # Replacing the file (as done by Kubernetes when updating a mounted
+    # volume) invalidates the cache
+    with open(dummy_graph_yaml + '.new', 'w') as f:
+        f.write('{A: {B: A_to_B}, B: {A: B_to_A, C: B_to_C}, C: {}}')
+    os.replace(dummy_graph_yaml + '.new', dummy_graph_yaml)
+    with app.test_request_context():
+        tg3 = api_v1._get_transform_graph()
+    assert tg3 is not tg1
+    assert tg3.get_transform_chain('A', 'C') == ['A_to_B', 'B_to_C']
+
+    api_v1.clear_transform_graph_cache()
+    with app.test_request_context():
+        tg4 = api_v1._get_transform_graph()
+    assert tg4 is not tg3
+
+
 def test_get_graph_yaml(app, client, dummy_graph_yaml):
     app.config['DEFAULT_TRANSFORM_GRAPH'] = dummy_graph_yaml
     response = client.get('/v1/graph.yaml')
@@ -54,6 +85,78 @@ def test_get_graph_yaml(app, client, dummy_graph_yaml):
     with open(dummy_graph_yaml, 'rt') as f:
         graph_yaml_contents = f.read()
     assert response.get_data(as_text=True) == graph_yaml_contents
+    etag, _ = response.get_etag()
+    assert etag is not None
+
+    response = client.get('/v1/graph.yaml',
+                          headers={'If-None-Match': '"{0}"'.format(etag)})
+    assert response.status_code == 304
+    assert response.get_etag() == (etag, False)
+
+    with open(dummy_graph_yaml, 'a') as f:
+        f.write('\n# modified\n')
+    response = client.get('/v1/graph.yaml',
+                          headers={'If-None-Match': '"{0}"'.format(etag)})
+    assert response.status_code == 200
+    assert response.get_etag()[0] != etag
+
+
+def test_etags(app, client, tmpdir, monkeypatch):
+    from hbp_spatial_backend import apply_transform
+    graph_yaml = str(tmpdir / 'graph.yaml')
+    with open(graph_yaml, 'w') as f:
+        f.write('{A: {B: a.trm}, B: {A: inv:a.trm, C: c.trm}, '
+                'C: {B: inv:c.trm}}')
+    for name in ('a.trm', 'c.trm'):
+        with open(str(tmpdir / name), 'w') as f:
+            f.write('0 0 0\n1 0 0\n0 1 0\n0 0 1\n')
+    app.config['DEFAULT_TRANSFORM_GRAPH'] = graph_yaml
+    calls = []
+
+    def transform_points_mock(source_points, transform_chain, cwd=None,
+                              shortcut=None):
+        calls.append(transform_chain)
+        return [tuple(point) for point in source_points]
+    monkeypatch.setattr(apply_transform, 'transform_points',
+                        transform_points_mock)
+
+    def get(url, query_string, etag=None):
+        headers = {}
+        if etag is not None:
+            headers['If-None-Match'] = '"{0}"'.format(etag)
+        return client.get(url, query_string=query_string, headers=headers)
+
+    point_args = {'source_space': 'A', 'target_space': 'B',
+                  'x': 1, 'y': 2, 'z': 3}
+    command_args = {'source_space': 'A', 'target_space': 'B'}
+    for url, query_string in [('/v1/transform-point', point_args),
+                              ('/v1/get-mesh-transform-command',
+                               command_args)]:
+        response = get(url, query_string)
+        assert response.status_code == 200
+        etag, weak = response.get_etag()
+        assert etag is not None and not weak
+        assert response.cache_control.max_age == 86400
+
+        response = get(url, query_string, etag=etag)
+        assert response.status_code == 304
+        assert response.get_etag() == (etag, False)
+        assert response.cache_control.public
+    # The engine is skipped for the conditional request
+    assert calls == [['a.trm']]
+
+    # The ETag depends on the files of the chain only
+    response = get('/v1/transform-point', point_args)
+    etag = response.get_etag()[0]
+    with open(str(tmpdir / 'c.trm'), 'w') as f:
+        f.write('10 0 0\n1 0 0\n0 1 0\n0 0 1\n')
+    response = get('/v1/transform-point', point_args, etag=etag)
+    assert response.status_code == 304
+    with open(str(tmpdir / 'a.trm'), 'w') as f:
+        f.write('10 0 0\n1 0 0\n0 1 0\n0 0 1\n')
+    response = get('/v1/transform-point', point_args, etag=etag)
+    assert response.status_code == 200
+    assert response.get_etag()[0] != etag
 
 
 def test_transform_point_request_validation(app, client, dummy_graph_yaml):
@@ -132,6 +235,14 @@ def test_transform_points_request_validation(app, client, dummy_graph_yaml):
     })
     assert response.status_code == 422
 
+    # Booleans are not numbers, even when mixed with numbers
+    response = client.post('/v1/transform-points', json={
+        'source_space': 'A',
+        'target_space': 'B',
+        'source_points': [[True, 1, 2]],
+    })
+    assert response.status_code == 422
+
 
 def test_get_mesh_transform_command(app, client, dummy_graph_yaml):
     app.config['DEFAULT_TRANSFORM_GRAPH'] = dummy_graph_yaml
@@ -200,3 +311,527 @@ def test_get_image_transform_command(app, client,
                           query_string={'source_space': 'nonexistent',
                                         'target_space': 'B'})
     assert response.status_code == 400
+
+
+def test_transform_points_binary(app, client, dummy_graph_yaml):
+    app.config['DEFAULT_TRANSFORM_GRAPH'] = dummy_graph_yaml
+    points = np.array([[1, 2, 3.5], [0, -1, 0.5]])
+
+    response = client.post('/v1/transform-points',
+                           query_string={'source_space': 'A',
+                                         'target_space': 'B',
+                                         'dtype': 'float32'},
+                           data=points.astype('<f4').tobytes(),
+                           content_type='application/octet-stream')
+    assert response.status_code == 200
+    assert response.json == {'target_points': points.tolist()}
+
+    buf = io.BytesIO()
+    np.save(buf, points)
+    response = client.post('/v1/transform-points',
+                           query_string={'source_space': 'A',
+                                         'target_space': 'B'},
+                           data=buf.getvalue(),
+                           content_type='application/x-npy',
+                           headers={'Accept': 'application/x-npy'})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-npy'
+    assert np.array_equal(np.load(io.BytesIO(response.data)), points)
+
+    response = client.post('/v1/transform-points',
+                           query_string={'dtype': 'float32'},
+                           json={
+                               'source_space': 'A',
+                               'target_space': 'B',
+                               'source_points': points.tolist(),
+                           },
+                           headers={'Accept': 'application/octet-stream'})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/octet-stream'
+    assert np.array_equal(
+        np.frombuffer(response.data, dtype='<f4').reshape(-1, 3), points)
+
+
+def test_transform_points_binary_validation(app, client, dummy_graph_yaml):
+    app.config['DEFAULT_TRANSFORM_GRAPH'] = dummy_graph_yaml
+    data = np.zeros((2, 3)).tobytes()
+
+    response = client.post('/v1/transform-points',
+                           query_string={'source_space': 'A'},
+                           data=data,
+                           content_type='application/octet-stream')
+    assert response.status_code == 422
+    assert 'target_space' in response.json['errors']['query']
+
+    response = client.post('/v1/transform-points',
+                           query_string={'source_space': 'A',
+                                         'target_space': 'B',
+                                         'dtype': 'int8'},
+                           data=data,
+                           content_type='application/octet-stream')
+    assert response.status_code == 422
+
+    response = client.post('/v1/transform-points',
+                           query_string={'source_space': 'A',
+                                         'target_space': 'B'},
+                           data=data[:-8],
+                           content_type='application/octet-stream')
+    assert response.status_code == 422
+
+    response = client.post('/v1/transform-points',
+                           query_string={'source_space': 'A',
+                                         'target_space': 'B'},
+                           data=np.array([[np.nan, 0, 0]]).tobytes(),
+                           content_type='application/octet-stream')
+    assert response.status_code == 422
+
+    response = client.post('/v1/transform-points',
+                           query_string={'source_space': 'A',
+                                         'target_space': 'nonexistent'},
+                           data=data,
+                           content_type='application/octet-stream')
+    assert response.status_code == 400
+
+
+def test_transform_points_spec(client):
+    response = client.get('/openapi.json')
+    operation = response.json['paths']['/v1/transform-points']['post']
+    query_parameters = {p['name'] for p in operation['parameters']
+                        if p['in'] == 'query'}
+    assert {'dtype', 'precision',
+            'source_space', 'target_space'} <= query_parameters
+    # The binary encodings are alternatives to the JSON request body
+    assert set(operation['requestBody']['content']) == {
+        'application/json', 'application/octet-stream', 'application/x-npy'}
+
+
+def test_transform_points_precision(app, client, dummy_graph_yaml):
+    app.config['DEFAULT_TRANSFORM_GRAPH'] = dummy_graph_yaml
+    response = client.post('/v1/transform-points',
+                           query_string={'precision': 1},
+                           json={
+                               'source_space': 'A',
+                               'target_space': 'B',
+                               'source_points': [[1.234, -5.678, 0.04]],
+                           })
+    assert response.status_code == 200
+    assert response.json == {'target_points': [[1.2, -5.7, 0.0]]}
+
+    response = client.post('/v1/transform-points',
+                           query_string={'precision': -1},
+                           json={
+                               'source_space': 'A',
+                               'target_space': 'B',
+                               'source_points': [[1.234, -5.678, 0.04]],
+                           })
+    assert response.status_code == 422
+
+
+def test_transform_points_compression(app, client, dummy_graph_yaml):
+    import gzip
+    app.config['DEFAULT_TRANSFORM_GRAPH'] = dummy_graph_yaml
+    points = np.arange(3000, dtype=float).reshape(-1, 3)
+    request_json = {
+        'source_space': 'A',
+        'target_space': 'B',
+        'source_points': points.tolist(),
+    }
+
+    response = client.post('/v1/transform-points', json=request_json,
+                           headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.content_encoding is None
+
+    app.config['COMPRESS_RESPONSES'] = True
+    response = client.post('/v1/transform-points', json=request_json,
+                           headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.content_encoding == 'gzip'
+    assert 'Accept-Encoding' in response.vary
+    assert json.loads(gzip.decompress(response.data)) == {
+        'target_points': points.tolist()}
+
+    response = client.post('/v1/transform-points', json=request_json,
+                           headers={'Accept-Encoding': 'identity'})
+    assert response.status_code == 200
+    assert response.content_encoding is None
+    assert response.json == {'target_points': points.tolist()}
+
+    # Small responses are not worth compressing
+    request_json['source_points'] = points[:1].tolist()
+    response = client.post('/v1/transform-points', json=request_json,
+                           headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.content_encoding is None
+
+
+def test_points_field():
+    from marshmallow import ValidationError
+    from hbp_spatial_backend.api_v1 import TransformPointsRequestSchema
+    schema = TransformPointsRequestSchema()
+
+    def load(source_points):
+        return schema.load({'source_space': 'A', 'target_space': 'B',
+                            'source_points': source_points})['source_points']
+
+    res = load([[1, 2, 3.5], [0, -1, 0.5]])
+    assert isinstance(res, np.ndarray)
+    assert res.dtype == np.float64
+    assert res.tolist() == [[1, 2, 3.5], [0, -1, 0.5]]
+    assert load([]).shape == (0, 3)
+    # Accepted by marshmallow through the slow path
+    assert load([['1', 2, 3]]).tolist() == [[1, 2, 3]]
+
+    for invalid_points in ([[1, 2]],
+                           [[1, 2, 3], [1, 2]],
+                           [[1, 2, 3, 4]],
+                           [1, 2, 3],
+                           [[1, 2, 'a']],
+                           [[1, 2, None]],
+                           [[True, False, True]],
+                           [[1, 2, float('nan')]],
+                           [[1, 2, float('inf')]],
+                           'garbage'):
+        with pytest.raises(ValidationError):
+            load(invalid_points)
+
+
+def test_transform_points_validation_errors(app, client, dummy_graph_yaml):
+    app.config['DEFAULT_TRANSFORM_GRAPH'] = dummy_graph_yaml
+    response = client.post('/v1/transform-points', json={
+        'source_space': 'A',
+        'target_space': 'B',
+        'source_points': [[1, 2, 3], [1, 2]],
+    })
+    assert response.status_code == 422
+    # The error message points to the offending element
+    assert '1' in response.json['errors']['source_points']
+
+
+def test_transform_points_stream(app, client, dummy_graph_yaml):
+    app.config['DEFAULT_TRANSFORM_GRAPH'] = dummy_graph_yaml
+    app.config['STREAM_CHUNK_SIZE'] = 2
+    query_string = {'source_space': 'A', 'target_space': 'B'}
+    points = np.array([[1, 2, 3.5], [0, -1, 0.5], [4, 5, 6]])
+
+    response = client.post('/v1/transform-points-stream',
+                           query_string=query_string,
+                           data='[1, 2, 3.5]\n\n[0, -1, 0.5]\n[4, 5, 6]',
+                           content_type='application/x-ndjson')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    lines = response.data.decode('utf-8').splitlines()
+    assert [json.loads(line) for line in lines] == points.tolist()
+
+    response = client.post('/v1/transform-points-stream',
+                           query_string=dict(query_string, dtype='float32'),
+                           data=points.astype('<f4').tobytes(),
+                           content_type='application/octet-stream')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/octet-stream'
+    assert np.array_equal(
+        np.frombuffer(response.data, dtype='<f4').reshape(-1, 3), points)
+
+    response = client.post('/v1/transform-points-stream',
+                           query_string=query_string,
+                           data=points.tobytes(),
+                           content_type='application/octet-stream',
+                           headers={'Accept': 'application/x-ndjson'})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    lines = response.data.decode('utf-8').splitlines()
+    assert [json.loads(line) for line in lines] == points.tolist()
+
+    response = client.post('/v1/transform-points-stream',
+                           query_string=query_string,
+                           data=b'',
+                           content_type='application/x-ndjson')
+    assert response.status_code == 200
+    assert response.data == b''
+
+
+def test_transform_points_stream_validation(app, client, dummy_graph_yaml):
+    app.config['DEFAULT_TRANSFORM_GRAPH'] = dummy_graph_yaml
+    app.config['STREAM_CHUNK_SIZE'] = 2
+    query_string = {'source_space': 'A', 'target_space': 'B'}
+
+    response = client.post('/v1/transform-points-stream',
+                           query_string=query_string,
+                           json=[[1, 2, 3]])
+    assert response.status_code == 415
+
+    response = client.post('/v1/transform-points-stream',
+                           query_string={'source_space': 'A',
+                                         'target_space': 'nonexistent'},
+                           data='[1, 2, 3]\n',
+                           content_type='application/x-ndjson')
+    assert response.status_code == 400
+
+    # Errors in the first chunk are reported with a status code
+    response = client.post('/v1/transform-points-stream',
+                           query_string=query_string,
+                           data='[1, 2, 3]\n[1, 2]\n',
+                           content_type='application/x-ndjson')
+    assert response.status_code == 422
+    assert 'line 2' in response.json['message']
+
+    # Later errors truncate the response
+    response = client.post('/v1/transform-points-stream',
+                           query_string=query_string,
+                           data='[1, 2, 3]\n[4, 5, 6]\n[7, 8, NaN]\n',
+                           content_type='application/x-ndjson')
+    assert response.status_code == 200
+    lines = response.data.decode('utf-8').splitlines()
+    assert [json.loads(line) for line in lines[:2]] == [[1, 2, 3],
+                                                        [4, 5, 6]]
+    assert 'line 3' in json.loads(lines[2])['error']
+
+    # The transfer of a binary response is aborted
+    response = client.post('/v1/transform-points-stream',
+                           query_string=query_string,
+                           data=np.zeros((5, 3)).tobytes()[:-8],
+                           content_type='application/octet-stream')
+    assert response.status_code == 200
+    with pytest.raises(ValueError):
+        response.data
+
+
+def test_transform_points_batch(app, client, tmpdir):
+    graph_yaml = str(tmpdir / 'graph.yaml')
+    with open(graph_yaml, 'w') as f:
+        f.write('{A: {B: A_to_B, C: A_to_C}, B: {A: B_to_A}, D: {}}')
+    app.config['DEFAULT_TRANSFORM_GRAPH'] = graph_yaml
+    response = client.post('/v1/transform-points-batch', json={'jobs': [
+        {'source_space': 'A', 'target_space': 'B',
+         'source_points': [[1, 2, 3], [4, 5, 6]]},
+        {'source_space': 'A', 'target_space': 'unknown',
+         'source_points': [[1, 2, 3]]},
+        {'source_space': 'B', 'target_space': 'A',
+         'source_points': [[7, 8, 9]]},
+        {'source_space': 'A', 'target_space': 'D',
+         'source_points': [[1, 2, 3]]},
+        # Raises RuntimeError in fake_apply_transform
+        {'source_space': 'A', 'target_space': 'C',
+         'source_points': [[1, 2, 3]]},
+        {'source_space': 'A', 'target_space': 'B',
+         'source_points': []},
+    ]})
+    assert response.status_code == 200
+    results = response.json['results']
+    assert results[0] == {'target_points': [[1, 2, 3], [4, 5, 6]]}
+    assert results[1]['error']['code'] == 400
+    assert results[2] == {'target_points': [[7, 8, 9]]}
+    assert results[3]['error']['code'] == 400
+    assert results[4]['error']['code'] == 500
+    assert results[5] == {'target_points': []}
+
+    response = client.post('/v1/transform-points-batch', json={'jobs': []})
+    assert response.status_code == 200
+    assert response.json == {'results': []}
+
+    response = client.post('/v1/transform-points-batch', json={'jobs': [
+        {'source_space': 'A', 'target_space': 'B',
+         'source_points': [[1, 2]]},
+    ]})
+    assert response.status_code == 422
+    response = client.post('/v1/transform-points-batch', json={})
+    assert response.status_code == 422
+
+
+def test_result_store(app, client, tmpdir, monkeypatch):
+    from hbp_spatial_backend import apply_transform
+    graph_yaml = str(tmpdir / 'graph.yaml')
+    with open(graph_yaml, 'w') as f:
+        f.write('{A: {B: a.trm}, B: {A: inv:a.trm}}')
+    with open(str(tmpdir / 'a.trm'), 'w') as f:
+        f.write('0 0 0\n1 0 0\n0 1 0\n0 0 1\n')
+    app.config['DEFAULT_TRANSFORM_GRAPH'] = graph_yaml
+    app.config['RESULT_STORE_SIZE'] = 10**6
+    app.config['RESULT_STORE_DIR'] = str(tmpdir / 'results')
+    calls = []
+
+    def transform_points_mock(source_points, transform_chain, cwd=None,
+                              shortcut=None):
+        calls.append(transform_chain)
+        return [(x + 1, y, z) for x, y, z in np.asarray(source_points)]
+    monkeypatch.setattr(apply_transform, 'transform_points',
+                        transform_points_mock)
+    request_data = {'source_space': 'A', 'target_space': 'B',
+                    'source_points': [[1, 2, 3], [4, 5, 6]]}
+    expected = [[2, 2, 3], [5, 5, 6]]
+
+    response = client.post('/v1/transform-points', json=request_data)
+    assert response.status_code == 200
+    assert response.json == {'target_points': expected}
+    location = response.headers['Location']
+    # Identical requests are served from the store
+    response = client.post('/v1/transform-points', json=request_data)
+    assert response.json == {'target_points': expected}
+    assert response.headers['Location'] == location
+    points = np.array(request_data['source_points'], dtype='<f8')
+    response = client.post('/v1/transform-points',
+                           query_string={'source_space': 'A',
+                                         'target_space': 'B'},
+                           data=points.tobytes(),
+                           content_type='application/octet-stream',
+                           headers={'Accept': 'application/octet-stream'})
+    assert np.frombuffer(response.data, '<f8').reshape(-1, 3).tolist() == (
+        expected)
+    assert response.headers['Location'] == location
+    assert len(calls) == 1
+
+    response = client.get(location)
+    assert response.status_code == 200
+    assert response.json == {'target_points': expected}
+    assert response.cache_control.public
+    assert 'Accept' in response.headers['Vary']
+    etag = response.get_etag()[0]
+    response = client.get(location,
+                          headers={'If-None-Match': '"{0}"'.format(etag)})
+    assert response.status_code == 304
+    response = client.get(location, query_string={'dtype': 'float32'},
+                          headers={'Accept': 'application/octet-stream'})
+    assert response.status_code == 200
+    assert np.frombuffer(response.data, '<f4').reshape(-1, 3).tolist() == (
+        expected)
+    assert response.get_etag()[0] != etag
+
+    # A result that does not fit in the store has no Location
+    app.config['RESULT_STORE_SIZE'] = 8
+    result_store_ext = app.extensions.pop('hbp_spatial_backend.result_store')
+    response = client.post('/v1/transform-points', json={
+        'source_space': 'A', 'target_space': 'B',
+        'source_points': [[7, 8, 9]]})
+    assert response.json == {'target_points': [[8, 8, 9]]}
+    assert 'Location' not in response.headers
+    app.extensions['hbp_spatial_backend.result_store'] = result_store_ext
+
+    response = client.get('/v1/transform-points-results/' + 'f' * 64)
+    assert response.status_code == 404
+    response = client.get('/v1/transform-points-results/invalid')
+    assert response.status_code == 404
+    app.config['RESULT_STORE_SIZE'] = 0
+    response = client.get(location)
+    assert response.status_code == 404
+
+
+def test_fold_affine_transforms(app, client, tmpdir):
+    graph_yaml = str(tmpdir / 'graph.yaml')
+    with open(graph_yaml, 'w') as f:
+        f.write('{A: {B: a.trm}, B: {A: inv:a.trm, C: b.trm}, '
+                'C: {B: inv:b.trm}}')
+    for name in ('a.trm', 'b.trm'):
+        with open(str(tmpdir / name), 'w') as f:
+            f.write('1 2 3\n1 0 0\n0 1 0\n0 0 1\n')
+    app.config['DEFAULT_TRANSFORM_GRAPH'] = graph_yaml
+    app.config['FOLD_AFFINE_TRANSFORMS'] = True
+    app.config['FOLDED_TRANSFORMS_DIR'] = str(tmpdir / 'folded')
+    from hbp_spatial_backend import api_v1
+    from hbp_spatial_backend import apply_transform
+    api_v1.clear_transform_graph_cache()
+    try:
+        response = client.get('/v1/get-mesh-transform-command',
+                              query_string={'source_space': 'A',
+                                            'target_space': 'C'})
+        assert response.status_code == 200
+        # The composed files only exist on the server, so the commands that
+        # are run by the clients use the original chain
+        cmd = response.json['transform_command']
+        assert cmd.count('--direct-transform') == 2
+        assert cmd.count('--inverse-transform') == 2
+        assert not any(arg.startswith('folded') for arg in cmd)
+        with app.test_request_context():
+            folded_chain = apply_transform.fold_transform_chain(
+                ['a.trm', 'b.trm'], cwd=str(tmpdir))
+        assert len(folded_chain) == 1
+        assert folded_chain[0].startswith('folded' + os.sep)
+        with open(str(tmpdir / folded_chain[0])) as f:
+            assert [float(v) for v in f.read().split()[:3]] == [2, 4, 6]
+    finally:
+        api_v1.clear_transform_graph_cache()
+
+
+def test_fold_affine_transforms_modified_file(app, client, tmpdir,
+                                              monkeypatch):
+    from hbp_spatial_backend import api_v1
+    from hbp_spatial_backend import apply_transform
+    monkeypatch.undo()  # use the real apply_transform.transform_points
+    graph_yaml = str(tmpdir / 'graph.yaml')
+    with open(graph_yaml, 'w') as f:
+        f.write('{A: {C: s1.trm}, C: {B: s2.trm}}')
+
+    def write_shift(name, shift):
+        with open(str(tmpdir / name), 'w') as f:
+            f.write('{0} {1} {2}\n1 0 0\n0 1 0\n0 0 1\n'.format(*shift))
+
+    write_shift('s1.trm', (1, 0, 0))
+    write_shift('s2.trm', (0, 1, 0))
+    app.config['DEFAULT_TRANSFORM_GRAPH'] = graph_yaml
+    app.config['FOLD_AFFINE_TRANSFORMS'] = True
+    app.config['FOLDED_TRANSFORMS_DIR'] = str(tmpdir / 'folded')
+    app.config['TRANSFORM_ENGINE'] = 'numpy'
+    app.config['POINT_CACHE_SIZE'] = 10
+    point_args = {'source_space': 'A', 'target_space': 'B',
+                  'x': 0, 'y': 0, 'z': 0}
+    api_v1.clear_transform_graph_cache()
+    try:
+        response = client.get('/v1/transform-point', query_string=point_args)
+        assert response.status_code == 200
+        assert response.json == {'target_point': [1, 1, 0]}
+        etag = response.get_etag()[0]
+
+        # Neither the folded chain nor the cached point are stale
+        write_shift('s1.trm', (100, 0, 0))
+        response = client.get('/v1/transform-point', query_string=point_args)
+        assert response.status_code == 200
+        assert response.get_etag()[0] != etag
+        assert response.json == {'target_point': [100, 1, 0]}
+    finally:
+        api_v1.clear_transform_graph_cache()
+        apply_transform.clear_folded_chains_cache()
+
+
+def test_shortcut(app, client, tmpdir, monkeypatch):
+    from hbp_spatial_backend import api_v1
+    from hbp_spatial_backend import compose_field
+    from hbp_spatial_backend import numpy_transform
+    monkeypatch.undo()  # use the real apply_transform.transform_points
+    for name, shift in (('s1.trm', (1, 0, 0)), ('s2.trm', (0, 2, 3))):
+        matrix = np.eye(4)
+        matrix[:3, 3] = shift
+        numpy_transform.write_trm(str(tmpdir / name), matrix)
+    origin = (-10, -10, -10)
+    field = compose_field.compose_displacement_field(
+        ['s1.trm', 's2.trm'], origin, (21, 21, 21), (1, 1, 1),
+        cwd=str(tmpdir))
+    compose_field.write_composed_transform(str(tmpdir / 'composed'), field,
+                                           origin, (1, 1, 1))
+    graph_yaml = str(tmpdir / 'graph.yaml')
+    with open(graph_yaml, 'w') as f:
+        f.write('{A: {C: s1.trm, B: {shortcut: [composed-shift.trm, '
+                'composed.ima]}}, C: {B: s2.trm}}')
+    app.config['DEFAULT_TRANSFORM_GRAPH'] = graph_yaml
+    app.config['TRANSFORM_ENGINE'] = 'numpy'
+    api_v1.clear_transform_graph_cache()
+    try:
+        response = client.post('/v1/transform-points', json={
+            'source_space': 'A',
+            'target_space': 'B',
+            'source_points': [[0, 0, 0], [50, 0, 0]],
+        })
+        assert response.status_code == 200
+        # The point outside of the box of the shortcut is transformed along
+        # the whole chain
+        assert np.allclose(response.json['target_points'],
+                           [[1, 2, 3], [51, 2, 3]], atol=1e-4)
+
+        # The commands use the whole chain
+        response = client.get('/v1/get-mesh-transform-command',
+                              query_string={'source_space': 'A',
+                                            'target_space': 'B'})
+        assert response.status_code == 200
+        cmd = response.json['transform_command']
+        assert 's1.trm' in cmd and 's2.trm' in cmd
+        assert not any('composed' in arg for arg in cmd)
+    finally:
+        api_v1.clear_transform_graph_cache()
@@ -134,3 +134,42 @@ def test_openapi_spec_development_mode():
     with app.test_client() as client:
         response = client.get('/openapi.json')
     assert response.json['servers'][0]['url'] == '/'
+
+
+def test_stats_route():
+    from hbp_spatial_backend import create_app
+    app = create_app({'TESTING': True})
+    with app.test_client() as client:
+        response = client.get('/stats')
+    assert response.status_code == 404
+
+    app = create_app({'TESTING': True, 'ENABLE_STATS': True})
+    with app.test_client() as client:
+        response = client.get('/stats')
+    assert response.status_code == 200
+    assert response.json['point_cache'] is None
+    assert 'resident_size' in response.json['field_store']
+    assert response.json['result_store'] is None
+    assert response.json['single_flight'] is None
+    assert response.json['micro_batcher'] is None
+
+    app = create_app({'TESTING': True, 'ENABLE_STATS': True,
+                      'POINT_CACHE_SIZE': 10})
+    with app.test_client() as client:
+        response = client.get('/stats')
+    assert response.json['point_cache']['hits'] == 0
+    assert response.json['point_cache']['max_size'] == 10
+
+    app = create_app({'TESTING': True, 'ENABLE_STATS': True,
+                      'COALESCE_TRANSFORMATIONS': True})
+    with app.test_client() as client:
+        response = client.get('/stats')
+    assert response.json['single_flight'] == {
+        'in_flight': 0, 'calls': 0, 'coalesced_calls': 0}
+
+    app = create_app({'TESTING': True, 'ENABLE_STATS': True,
+                      'MICRO_BATCH_WINDOW': 0.003})
+    with app.test_client() as client:
+        response = client.get('/stats')
+    assert response.json['micro_batcher'] == {
+        'open_batches': 0, 'batches': 0, 'items': 0}
@@ -14,11 +14,17 @@
 # See the Licence for the specific language governing permissions and
 # limitations under the Licence.
 
+import concurrent.futures
 from distutils.spawn import find_executable
 import io
 import logging
+import subprocess
+import sys
+import threading
+import time
 import unittest.mock
 
+import numpy as np
 import pytest
 
 from hbp_spatial_backend import apply_transform
@@ -41,6 +47,52 @@ def test_parse_points_output():
     assert res == [(1, 2, 3)]
 
 
+def test_parse_points_output_array():
+    res = apply_transform.parse_points_output_array('')
+    assert res.shape == (0, 3)
+    res = apply_transform.parse_points_output_array(
+        'garbage\n(1, 2 ,3)\n  ( 1e-1 ,0.2,\t-3.5e2 )  \r\n(1, 2)\n(1,\n2, 3)')
+    assert res.tolist() == [[1, 2, 3], [1e-1, 0.2, -3.5e2]]
+    with pytest.raises(ValueError):
+        apply_transform.parse_points_output_array('(1, 2, x)\n')
+
+
+def test_parse_points_output_array_matches_parse_points_output():
+    random = np.random.RandomState(42)
+    number_formats = ['{0!r}', '{0:g}', '{0:.3e}', '{0:+.17g}', '{0:.0f}']
+    spaces = ['', ' ', '  ', '\t', ' \t ']
+    garbage_lines = [
+        '',
+        'Warning: some message from AIMS',
+        '(1, 2)',
+        '(1, 2, 3, 4)',
+        '1, 2, 3',
+        '(1, 2, 3',
+        'x (1, 2, 3)',
+        '(1, 2, 3) x',
+    ]
+    for _ in range(50):
+        lines = []
+        for _ in range(random.randint(0, 30)):
+            if random.rand() < 0.2:
+                lines.append(garbage_lines[random.randint(len(garbage_lines))])
+                continue
+            coords = random.standard_normal(3) * 10.0 ** random.randint(
+                -20, 20, size=3)
+            parts = [number_formats[random.randint(len(number_formats))]
+                     .format(c) for c in coords.tolist()]
+            s = [spaces[random.randint(len(spaces))] for _ in range(8)]
+            lines.append('{s[0]}({s[1]}{p[0]}{s[2]},{s[3]}{p[1]}{s[4]},'
+                         '{s[5]}{p[2]}{s[6]}){s[7]}'.format(s=s, p=parts))
+        stdout = '\n'.join(lines)
+        if random.rand() < 0.5:
+            stdout += '\n'
+        expected = list(parse_points_output(io.StringIO(stdout)))
+        res = apply_transform.parse_points_output_array(stdout)
+        assert res.shape == (len(expected), 3)
+        assert res.tolist() == [list(p) for p in expected]
+
+
 def test_get_transform_command(app):
     with app.app_context():
         cmd = apply_transform.get_transform_command(
@@ -150,3 +202,390 @@ def test_AimsApplyTransform_with_trm(tmpdir, app):
     with app.app_context():
         res = apply_transform.transform_point([1, 2, 3], [test_trm])
     assert res == (-1, -2, -3)
+
+
+def test_transform_points_stub_aims(app, stub_aims, monkeypatch):
+    monkeypatch.setenv('STUB_AIMS_OFFSET', '1')
+    with app.app_context():
+        res = apply_transform.transform_points([(1, 2, 3), (4, 5, 6)], [])
+    assert res == [(2, 3, 4), (5, 6, 7)]
+
+
+def _time_concurrent_calls(app, num_calls):
+    def call():
+        with app.app_context():
+            return apply_transform.transform_point((1, 2, 3), [])
+
+    time_before = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(num_calls) as executor:
+        results = list(executor.map(lambda _: call(), range(num_calls)))
+    assert results == [(1, 2, 3)] * num_calls
+    return time.perf_counter() - time_before
+
+
+def test_concurrent_subprocesses(app, stub_aims, monkeypatch):
+    delay = 0.3
+    monkeypatch.setenv('STUB_AIMS_DELAY', str(delay))
+    # Throughput scales with the number of concurrent subprocesses...
+    app.config['MAX_CONCURRENT_SUBPROCESSES'] = 8
+    elapsed = _time_concurrent_calls(app, 8)
+    assert elapsed < 4 * delay
+    # ... within the configured limit
+    app.extensions.pop('hbp_spatial_backend.semaphore')
+    app.config['MAX_CONCURRENT_SUBPROCESSES'] = 2
+    elapsed = _time_concurrent_calls(app, 8)
+    assert elapsed >= 4 * delay
+
+
+def test_concurrent_subprocesses_not_limited_by_default(app, stub_aims):
+    assert app.config['MAX_CONCURRENT_SUBPROCESSES'] is None
+    with app.app_context():
+        assert apply_transform._get_subprocess_semaphore() is None
+        assert apply_transform.transform_point((1, 2, 3), []) == (1, 2, 3)
+
+
+def test_semaphore_timeout(app, stub_aims):
+    app.config['MAX_CONCURRENT_SUBPROCESSES'] = 1
+    app.config['REQUEST_TIMEOUT'] = 0.1
+    with app.app_context():
+        semaphore = apply_transform._get_subprocess_semaphore()
+        with semaphore:
+            with pytest.raises(subprocess.TimeoutExpired):
+                apply_transform.transform_point((1, 2, 3), [])
+
+
+def test_semaphore_wait_counts_towards_timeout(app, stub_aims, monkeypatch):
+    monkeypatch.setenv('STUB_AIMS_DELAY', '0.4')
+    app.config['MAX_CONCURRENT_SUBPROCESSES'] = 1
+    app.config['REQUEST_TIMEOUT'] = 0.6
+    with app.app_context():
+        semaphore = apply_transform._get_subprocess_semaphore()
+        semaphore.acquire()
+        threading.Timer(0.4, semaphore.release).start()
+        # Each wait fits within the timeout, but not their sum
+        with pytest.raises(subprocess.TimeoutExpired):
+            apply_transform.transform_point((1, 2, 3), [])
+
+
+def test_parallel_chunks(app, stub_aims, monkeypatch):
+    delay = 0.3
+    monkeypatch.setenv('STUB_AIMS_DELAY', str(delay))
+    monkeypatch.setenv('STUB_AIMS_OFFSET', '1')
+    app.config['TRANSFORM_PARALLEL_THRESHOLD'] = 10
+    app.config['TRANSFORM_CHUNK_SIZE'] = 3
+    app.config['TRANSFORM_PARALLEL_WORKERS'] = 8
+    source_points = np.arange(60, dtype=float).reshape(20, 3)
+    with app.app_context():
+        time_before = time.perf_counter()
+        res = apply_transform.transform_points(source_points, [])
+        elapsed = time.perf_counter() - time_before
+    # The 7 chunks are transformed concurrently, and reassembled in order
+    assert res == [tuple(p) for p in (source_points + 1).tolist()]
+    assert elapsed < 3 * delay
+
+    # Smaller batches are transformed in one call
+    with unittest.mock.patch.object(apply_transform,
+                                    '_transform_points_parallel') as mock:
+        with app.app_context():
+            res = apply_transform.transform_points(source_points[:9], [])
+    assert not mock.called
+    assert len(res) == 9
+
+
+def test_transform_points_jobs(app, monkeypatch):
+    calls = []
+
+    def transform_points_mock(source_points, transform_chain, cwd=None,
+                              shortcut=None):
+        calls.append((len(source_points), transform_chain))
+        if transform_chain == ['fail']:
+            raise RuntimeError('failure')
+        offset = len(transform_chain)
+        return [tuple(p) for p in (np.asarray(source_points) + offset)]
+
+    monkeypatch.setattr(apply_transform, 'transform_points',
+                        transform_points_mock)
+    app.config['TRANSFORM_PARALLEL_WORKERS'] = 2
+    points = np.arange(12, dtype=float).reshape(4, 3)
+    with app.app_context():
+        res = apply_transform.transform_points_jobs([
+            (points[:2], ['a']),
+            (points[2:], ['a', 'b']),
+            (points[:1], ['fail']),
+            (points[2:3].tolist(), ['a']),
+            (np.empty((0, 3)), ['a', 'b']),
+        ])
+    # The jobs that share a chain are transformed in one call
+    assert sorted(calls, key=repr) == sorted([
+        (3, ['a']), (2, ['a', 'b']), (1, ['fail'])], key=repr)
+    assert res[0] == [tuple(p) for p in (points[:2] + 1).tolist()]
+    assert res[1] == [tuple(p) for p in (points[2:] + 2).tolist()]
+    assert isinstance(res[2], RuntimeError)
+    assert res[3] == [tuple(p) for p in (points[2:3] + 1).tolist()]
+    assert res[4] == []
+
+
+def test_transform_points_jobs_parallel_chunks(app, stub_aims, monkeypatch):
+    # Groups that are big enough to be split into chunks must not wait for
+    # the executor that runs them
+    monkeypatch.setenv('STUB_AIMS_OFFSET', '1')
+    app.config['TRANSFORM_PARALLEL_THRESHOLD'] = 2
+    app.config['TRANSFORM_CHUNK_SIZE'] = 1
+    app.config['TRANSFORM_PARALLEL_WORKERS'] = 2
+    points = np.arange(12, dtype=float).reshape(4, 3)
+    with app.app_context():
+        res = apply_transform.transform_points_jobs([
+            (points, ['a.trm']),
+            (points, ['b.trm']),
+            (points, ['c.trm']),
+        ])
+    assert res == [[tuple(p) for p in (points + 1).tolist()]] * 3
+
+
+GEVENT_LOAD_TEST = '''\
+from gevent import monkey
+monkey.patch_all()
+import sys
+import time
+import gevent
+import hbp_spatial_backend
+from hbp_spatial_backend import apply_transform
+app = hbp_spatial_backend.create_app({
+    'TESTING': True,
+    'MAX_CONCURRENT_SUBPROCESSES': int(sys.argv[2]),
+})
+def call():
+    with app.app_context():
+        return apply_transform.transform_point((1, 2, 3), [])
+num_calls = int(sys.argv[1])
+time_before = time.perf_counter()
+greenlets = [gevent.spawn(call) for _ in range(num_calls)]
+gevent.joinall(greenlets, raise_error=True)
+assert all(g.value == (1, 2, 3) for g in greenlets)
+print(time.perf_counter() - time_before)
+'''
+
+
+def test_gevent_concurrent_subprocesses(stub_aims, monkeypatch, tmpdir):
+    pytest.importorskip('gevent')
+    delay = 0.3
+    monkeypatch.setenv('STUB_AIMS_DELAY', str(delay))
+    script = str(tmpdir / 'gevent_load_test.py')
+    with open(script, 'w') as f:
+        f.write(GEVENT_LOAD_TEST)
+
+    def run(num_calls, max_subprocesses):
+        res = subprocess.run(
+            [sys.executable, script, str(num_calls), str(max_subprocesses)],
+            check=True, stdout=subprocess.PIPE, universal_newlines=True)
+        return float(res.stdout)
+
+    # A single worker process can keep many transforms in flight
+    assert run(20, 20) < 4 * delay
+    assert run(20, 5) >= 4 * delay
+
+
+def test_coalesce_transformations(app, stub_aims, monkeypatch):
+    delay = 0.3
+    monkeypatch.setenv('STUB_AIMS_DELAY', str(delay))
+    app.config['MAX_CONCURRENT_SUBPROCESSES'] = 1
+    app.config['COALESCE_TRANSFORMATIONS'] = True
+    # The identical calls share a single AimsApplyTransform run
+    elapsed = _time_concurrent_calls(app, 8)
+    assert elapsed < 3 * delay
+    stats = app.extensions['hbp_spatial_backend.single_flight'].stats()
+    assert stats['calls'] + stats['coalesced_calls'] == 8
+    assert stats['calls'] < 8
+    assert stats['in_flight'] == 0
+
+    # Different points are not coalesced
+    with app.app_context():
+        res = apply_transform.transform_points_jobs([
+            ([(1, 2, 3)], ['a.trm']),
+            ([(4, 5, 6)], ['b.trm']),
+        ])
+    assert res == [[(1, 2, 3)], [(4, 5, 6)]]
+
+
+def test_micro_batching(app, stub_aims, monkeypatch):
+    delay = 0.3
+    monkeypatch.setenv('STUB_AIMS_DELAY', str(delay))
+    monkeypatch.setenv('STUB_AIMS_OFFSET', '1')
+    app.config['MAX_CONCURRENT_SUBPROCESSES'] = 1
+    app.config['MICRO_BATCH_WINDOW'] = 0.1
+    app.config['MICRO_BATCH_MAX_SIZE'] = 4
+
+    def call(i):
+        with app.app_context():
+            return apply_transform.transform_point((i, i % 2, 0), [])
+
+    time_before = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(call, range(8)))
+    elapsed = time.perf_counter() - time_before
+    # Each caller gets its own point back
+    assert results == [(i + 1, i % 2 + 1, 1) for i in range(8)]
+    # The 8 points are transformed in two batches
+    assert elapsed < 4 * delay
+    stats = app.extensions['hbp_spatial_backend.micro_batcher'].stats()
+    assert stats['items'] == 8
+    assert stats['batches'] < 8
+
+
+def test_transform_point_batch(app, monkeypatch):
+    calls = []
+
+    def transform_points_mock(source_points, transform_chain, cwd=None,
+                              shortcut=None):
+        calls.append(source_points)
+        return [(x + 1, y, z) for x, y, z in source_points]
+
+    monkeypatch.setattr(apply_transform, 'transform_points',
+                        transform_points_mock)
+    res = apply_transform._transform_point_batch(
+        [(1, 2, 3), (4, 5, 6), (1, 2, 3)], ['a.trm'])
+    # Duplicate points are only transformed once
+    assert calls == [[(1, 2, 3), (4, 5, 6)]]
+    assert res == [(2, 2, 3), (5, 5, 6), (2, 2, 3)]
+
+
+GEVENT_COALESCING_TEST = '''\
+from gevent import monkey
+monkey.patch_all()
+import time
+import gevent
+import hbp_spatial_backend
+from hbp_spatial_backend import apply_transform
+app = hbp_spatial_backend.create_app({
+    'TESTING': True,
+    'MAX_CONCURRENT_SUBPROCESSES': 1,
+    'COALESCE_TRANSFORMATIONS': True,
+})
+def call():
+    with app.app_context():
+        return apply_transform.transform_point((1, 2, 3), [])
+time_before = time.perf_counter()
+greenlets = [gevent.spawn(call) for _ in range(20)]
+gevent.joinall(greenlets, raise_error=True)
+assert all(g.value == (1, 2, 3) for g in greenlets)
+print(time.perf_counter() - time_before)
+'''
+
+
+def test_gevent_coalesce_transformations(stub_aims, monkeypatch, tmpdir):
+    pytest.importorskip('gevent')
+    delay = 0.3
+    monkeypatch.setenv('STUB_AIMS_DELAY', str(delay))
+    script = str(tmpdir / 'gevent_coalescing_test.py')
+    with open(script, 'w') as f:
+        f.write(GEVENT_COALESCING_TEST)
+    res = subprocess.run([sys.executable, script], check=True,
+                         stdout=subprocess.PIPE, universal_newlines=True)
+    # 20 calls with a single subprocess slot, but only one run
+    assert float(res.stdout) < 3 * delay
+
+
+@pytest.mark.parametrize('backend', ['memory', 'sqlite'])
+@unittest.mock.patch('subprocess.run', autospec=True)
+def test_point_cache(subprocess_run_mock, app, backend, tmpdir):
+    class CompletedProcessMock:
+        def __init__(self, cmd, input, **kwargs):
+            points = list(parse_points_output(io.StringIO(input)))
+            self.stdout = '\n'.join('({0}, {1}, {2})'.format(
+                -x, -y, -z) for x, y, z in points)
+    subprocess_run_mock.side_effect = CompletedProcessMock
+    app.config['POINT_CACHE_SIZE'] = 3
+    app.config['POINT_CACHE_PRECISION'] = 2
+    app.config['POINT_CACHE_BACKEND'] = backend
+    app.config['POINT_CACHE_PATH'] = str(tmpdir / 'point-cache.sqlite3')
+    with app.app_context():
+        res = apply_transform.transform_points([(1, 2, 3), (4, 5, 6)],
+                                               ['A.trm'])
+        assert res == [(-1, -2, -3), (-4, -5, -6)]
+        assert subprocess_run_mock.call_count == 1
+
+        # Only the cache misses are sent to AimsApplyTransform, the results
+        # are merged back in order
+        res = apply_transform.transform_points(
+            [(7, 8, 9), (4.001, 5, 6), (1, 2, 3)], ['A.trm'])
+        assert res == [(-7, -8, -9), (-4, -5, -6), (-1, -2, -3)]
+        assert subprocess_run_mock.call_count == 2
+        _, kwargs = subprocess_run_mock.call_args
+        assert list(parse_points_output(
+            io.StringIO(kwargs['input']))) == [(7, 8, 9)]
+
+        # The chain is part of the key
+        res = apply_transform.transform_points([(1, 2, 3)], ['B.trm'])
+        assert subprocess_run_mock.call_count == 3
+
+        cache = apply_transform.get_point_cache()
+        assert cache.stats() == {
+            'hits': 2,
+            'misses': 4,
+            'size': 3,
+            'max_size': 3,
+        }
+
+
+@unittest.mock.patch('subprocess.run', autospec=True)
+def test_point_cache_file_versions(subprocess_run_mock, app, tmpdir):
+    class CompletedProcessMock:
+        stdout = '(4, 5, 6)'
+    subprocess_run_mock.return_value = CompletedProcessMock()
+    app.config['POINT_CACHE_SIZE'] = 10
+    with open(str(tmpdir / 'A.trm'), 'w') as f:
+        f.write('0 0 0\n1 0 0\n0 1 0\n0 0 1\n')
+    with app.app_context():
+        apply_transform.transform_points([(1, 2, 3)], ['A.trm'],
+                                         cwd=str(tmpdir))
+        apply_transform.transform_points([(1, 2, 3)], ['A.trm'],
+                                         cwd=str(tmpdir))
+        assert subprocess_run_mock.call_count == 1
+        # The cached points are not used after the file has been modified
+        with open(str(tmpdir / 'A.trm'), 'w') as f:
+            f.write('10 0 0\n1 0 0\n0 1 0\n0 0 1\n')
+        apply_transform.transform_points([(1, 2, 3)], ['A.trm'],
+                                         cwd=str(tmpdir))
+        assert subprocess_run_mock.call_count == 2
+
+
+def test_point_cache_version_of_folded_chain(app, tmpdir):
+    from hbp_spatial_backend import file_digests
+    app.config['POINT_CACHE_SIZE'] = 10
+    app.config['FOLD_AFFINE_TRANSFORMS'] = True
+    app.config['FOLDED_TRANSFORMS_DIR'] = str(tmpdir / 'folded')
+    app.config['TRANSFORM_ENGINE'] = 'numpy'
+    chain = ['A.trm', 'B.trm']
+    for name in chain:
+        with open(str(tmpdir / name), 'w') as f:
+            f.write('1 0 0\n1 0 0\n0 1 0\n0 0 1\n')
+    try:
+        with app.app_context():
+            cache = apply_transform.get_point_cache()
+            with unittest.mock.patch.object(
+                    cache, 'make_keys', wraps=cache.make_keys) as mock:
+                res = apply_transform.transform_points([(1, 2, 3)], chain,
+                                                       cwd=str(tmpdir))
+                [batch_res] = apply_transform.transform_points_jobs(
+                    [([(1, 2, 3)], chain)], cwd=str(tmpdir))
+            hits = cache.hits
+    finally:
+        apply_transform.clear_folded_chains_cache()
+    assert res == batch_res == [(3, 2, 3)]
+    # The version is the digest of the chain before folding, from which the
+    # ETags of the API are also computed
+    version = file_digests.chain_digest(chain, cwd=str(tmpdir))
+    assert [call[1]['version'] for call in mock.call_args_list] == [
+        version, version]
+    # Batch jobs share the cache keys of /v1/transform-points
+    assert hits == 1
+
+
+def test_format_points_input():
+    assert apply_transform.format_points_input([]) == ''
+    res = apply_transform.format_points_input([(1, 2, 3), (0.1, -2e-30, 4)])
+    assert res == '(1.0, 2.0, 3.0)\n(0.1, -2e-30, 4.0)\n'
+    points = np.random.RandomState(0).normal(size=(100, 3))
+    res = apply_transform.format_points_input(points)
+    assert list(parse_points_output(io.StringIO(res))) == [
+        tuple(p) for p in points.tolist()]
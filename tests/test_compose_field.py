@@ -0,0 +1,160 @@
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+import os
+import unittest.mock
+
+import numpy as np
+import pytest
+
+from hbp_spatial_backend import compose_field
+from hbp_spatial_backend import numpy_transform
+
+
+CHAIN = ['shift.trm', 'field.ima', 'rotate.trm']
+# The box of source space over which the chain is composed
+BOX_ORIGIN = (0, 0, 0)
+BOX_EXTENT = (29, 35, 23)
+
+
+@pytest.fixture
+def transform_dir(tmpdir):
+    shift = np.eye(4)
+    shift[:3, 3] = [1, 2, 3]
+    numpy_transform.write_trm(str(tmpdir / 'shift.trm'), shift)
+    rotate = np.array([[0, -1, 0, 10],
+                       [1, 0, 0, -5],
+                       [0, 0, 1, 0],
+                       [0, 0, 0, 1]])
+    numpy_transform.write_trm(str(tmpdir / 'rotate.trm'), rotate)
+    # Smooth non-linear displacement field, with an amplitude of 2 mm
+    voxel_size = (1.5, 1.5, 1.5)
+    z, y, x = np.meshgrid(np.arange(20) * voxel_size[2],
+                          np.arange(30) * voxel_size[1],
+                          np.arange(25) * voxel_size[0],
+                          indexing='ij')
+    field = 2 * np.stack([np.sin(x / 7), np.cos(y / 5), np.sin(z / 9)],
+                         axis=-1)
+    numpy_transform.write_gis_field(str(tmpdir / 'field.ima'), field,
+                                    voxel_size)
+    with open(str(tmpdir / 'graph.yaml'), 'w') as f:
+        f.write('{A: {B: shift.trm}, B: {C: field.ima}, C: {D: rotate.trm},'
+                ' D: {}}')
+    return str(tmpdir)
+
+
+def compose(transform_dir, voxel_size):
+    shape = [int(round(e / v)) + 1 for e, v in zip(BOX_EXTENT, voxel_size)]
+    field = compose_field.compose_displacement_field(
+        CHAIN, BOX_ORIGIN, shape, voxel_size, cwd=transform_dir)
+    return compose_field.write_composed_transform(
+        os.path.join(transform_dir, 'composed'), field, BOX_ORIGIN,
+        voxel_size)
+
+
+@pytest.mark.parametrize('voxel_size,tolerance', [
+    ((1, 1, 1), 0.05),
+    ((0.5, 0.5, 0.5), 0.015),
+])
+def test_composed_field_approximation_error(transform_dir, voxel_size,
+                                            tolerance):
+    composed_chain = compose(transform_dir, voxel_size)
+    points = np.random.RandomState(0).uniform(0, 1, size=(10000, 3))
+    points *= BOX_EXTENT
+    reference = numpy_transform.transform_points(points, CHAIN,
+                                                 cwd=transform_dir)
+    res = numpy_transform.transform_points(points, composed_chain,
+                                           cwd=transform_dir)
+    error = np.linalg.norm(res - reference, axis=1)
+    assert np.max(error) < tolerance
+
+    # The composed field is exact at the grid nodes (up to the float32
+    # precision of the stored field)
+    nodes = np.array([[0, 0, 0], [3, 4, 5], [29, 35, 23]], dtype=float)
+    assert np.allclose(
+        numpy_transform.transform_points(nodes, composed_chain,
+                                         cwd=transform_dir),
+        numpy_transform.transform_points(nodes, CHAIN, cwd=transform_dir),
+        atol=1e-4)
+
+
+def test_shortcut_domain(transform_dir):
+    composed_chain = compose(transform_dir, (1, 1, 1))
+    points = np.array([[0, 0, 0], [29, 35, 23], [10, 10, 10],
+                       [-0.1, 0, 0], [50, 0, 0], [0, 0, 23.1]])
+    assert compose_field.shortcut_domain(
+        points, composed_chain, cwd=transform_dir).tolist() == [
+            True, True, True, False, False, False]
+    with pytest.raises(numpy_transform.UnsupportedTransformError):
+        compose_field.shortcut_domain(points, ['shift.trm'],
+                                      cwd=transform_dir)
+    with pytest.raises(numpy_transform.UnsupportedTransformError):
+        compose_field.shortcut_domain(points, ['field.ima', 'shift.trm'],
+                                      cwd=transform_dir)
+
+
+def test_transform_points_with_shortcut(app, tmpdir):
+    from hbp_spatial_backend import apply_transform
+    shift = np.eye(4)
+    shift[:3, 3] = [1, 2, 3]
+    numpy_transform.write_trm(str(tmpdir / 'shift.trm'), shift)
+    origin = (-10, -10, -10)
+    field = compose_field.compose_displacement_field(
+        ['shift.trm'], origin, (21, 21, 21), (1, 1, 1), cwd=str(tmpdir))
+    shortcut = compose_field.write_composed_transform(
+        str(tmpdir / 'composed'), field, origin, (1, 1, 1))
+    app.config['TRANSFORM_ENGINE'] = 'numpy'
+    with app.app_context(), unittest.mock.patch.object(
+            apply_transform, '_transform_points_cached',
+            wraps=apply_transform._transform_points_cached) as mock:
+        res = apply_transform.transform_points(
+            [(0, 0, 0), (50, 0, 0), (5, -5, 10)], ['shift.trm'],
+            cwd=str(tmpdir), shortcut=shortcut)
+    # The point outside of the box is transformed along the whole chain
+    assert np.allclose(res, [(1, 2, 3), (51, 2, 3), (6, -3, 13)], atol=1e-4)
+    assert [(len(args[0]), args[1]) for args, _ in mock.call_args_list] == [
+        (2, shortcut), (1, ['shift.trm'])]
+
+    # An unusable shortcut is ignored
+    with app.app_context():
+        res = apply_transform.transform_points(
+            [(50, 0, 0)], ['shift.trm'], cwd=str(tmpdir),
+            shortcut=['missing.ima'])
+    assert res == [(51, 2, 3)]
+
+
+def test_compose_transform_chain_main(transform_dir, capsys):
+    graph_yaml = os.path.join(transform_dir, 'graph.yaml')
+    ret = compose_field.main([
+        'compose_transform_chain.py', '-g', graph_yaml,
+        '-s', 'A', '-t', 'D',
+        '--origin', '0', '0', '0', '--shape', '30', '36', '24',
+        '--voxel_size', '1', '1', '1',
+        '-o', os.path.join(transform_dir, 'composed', 'A-to-D'),
+    ])
+    assert ret == 0
+    out = capsys.readouterr().out
+    assert ('D: {shortcut: [composed/A-to-D-shift.trm, composed/A-to-D.ima]}'
+            .replace('/', os.sep) in out)
+
+    ret = compose_field.main([
+        'compose_transform_chain.py', '-g', graph_yaml,
+        '-s', 'D', '-t', 'A',
+        '--origin', '0', '0', '0', '--shape', '2', '2', '2',
+        '--voxel_size', '1', '1', '1',
+        '-o', os.path.join(transform_dir, 'D-to-A'),
+    ])
+    assert ret == 1
@@ -0,0 +1,67 @@
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+import gzip
+
+import pytest
+from werkzeug.datastructures import Accept
+from werkzeug.http import parse_accept_header
+
+from hbp_spatial_backend import compression
+
+
+DATA = b'{"target_points": [[1.0, 2.0, 3.0]]}' * 100
+
+
+def test_gzip():
+    compressed = compression.compress(DATA, 'gzip')
+    assert len(compressed) < len(DATA)
+    assert gzip.decompress(compressed) == DATA
+    # The output is deterministic
+    assert compression.compress(DATA, 'gzip') == compressed
+
+
+def test_brotli():
+    brotli = pytest.importorskip('brotli')
+    assert 'br' in compression.available_encodings()
+    assert brotli.decompress(compression.compress(DATA, 'br')) == DATA
+
+
+def test_zstd():
+    zstandard = pytest.importorskip('zstandard')
+    assert 'zstd' in compression.available_encodings()
+    compressed = compression.compress(DATA, 'zstd')
+    assert zstandard.ZstdDecompressor().decompress(compressed) == DATA
+
+
+def test_compress_unsupported():
+    with pytest.raises(ValueError):
+        compression.compress(DATA, 'compress')
+
+
+def test_negotiate_encoding(monkeypatch):
+    def negotiate(header):
+        return compression.negotiate_encoding(
+            parse_accept_header(header, Accept))
+    monkeypatch.setattr(compression, 'brotli', object())
+    monkeypatch.setattr(compression, 'zstandard', None)
+    assert negotiate('') is None
+    assert negotiate('identity') is None
+    assert negotiate('gzip') == 'gzip'
+    assert negotiate('gzip, deflate, br') == 'br'
+    assert negotiate('br;q=0.5, gzip') == 'gzip'
+    assert negotiate('zstd, gzip;q=0') is None
+    assert negotiate('*') == 'br'
@@ -0,0 +1,50 @@
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+
+import concurrent.futures
+import threading
+
+from hbp_spatial_backend import extensions
+
+
+def test_get_extension(app):
+    created = []
+
+    def factory():
+        created.append(object())
+        return created[-1]
+    extension = extensions.get_extension(app, 'test', factory)
+    assert extensions.get_extension(app, 'test', factory) is extension
+    assert app.extensions['hbp_spatial_backend.test'] is extension
+    assert created == [extension]
+
+
+def test_get_extension_concurrent(app):
+    barrier = threading.Barrier(8)
+    created = []
+
+    def factory():
+        created.append(object())
+        return created[-1]
+
+    def call(_):
+        barrier.wait(5)
+        return extensions.get_extension(app, 'test', factory)
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(call, range(8)))
+    assert len(created) == 1
+    assert results == created * 8
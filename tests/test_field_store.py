@@ -0,0 +1,75 @@
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+import os
+
+import numpy as np
+import pytest
+
+from hbp_spatial_backend import field_store
+from hbp_spatial_backend import numpy_transform
+
+
+@pytest.fixture
+def field_path(tmpdir):
+    path = str(tmpdir / 'field.ima')
+    field = np.random.RandomState(0).normal(size=(20, 30, 40, 3))
+    numpy_transform.write_gis_field(path, field, (1, 2, 3))
+    return path
+
+
+def test_field_store(field_path):
+    store = field_store.FieldStore()
+    field, voxel_size = store.get(field_path)
+    assert isinstance(field, np.memmap)
+    assert not field.flags.writeable
+    assert field.shape == (20, 30, 40, 3)
+    assert voxel_size == (1, 2, 3)
+    # The field is mapped once
+    assert store.get(field_path)[0] is field
+    assert len(store) == 1
+
+    # A modified field is mapped again
+    numpy_transform.write_gis_field(field_path, np.zeros((2, 3, 4, 3)),
+                                    (1, 2, 3))
+    st = os.stat(field_path)
+    os.utime(field_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert store.get(field_path)[0].shape == (2, 3, 4, 3)
+    assert len(store) == 1
+
+
+def test_field_store_stats(field_path):
+    store = field_store.FieldStore()
+    assert store.stats() == {'fields': [], 'size': 0, 'resident_size': 0}
+    store.preload(field_path)
+    field, _ = store.get(field_path)
+    field.sum()  # fault in every page
+    stats = store.stats()
+    assert stats['size'] == 20 * 30 * 40 * 3 * 4
+    assert stats['fields'] == [{
+        'path': os.path.abspath(field_path),
+        'size': stats['size'],
+        'resident_size': stats['resident_size'],
+    }]
+    if stats['resident_size'] is None:
+        pytest.skip('mincore is not available')
+    assert stats['resident_size'] == stats['size']
+
+
+def test_resident_size():
+    assert field_store.resident_size(np.zeros(0)) in (0, None)
+    array = np.ones(10**6)
+    assert field_store.resident_size(array) in (array.nbytes, None)
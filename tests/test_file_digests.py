@@ -0,0 +1,99 @@
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+import hashlib
+import os
+import subprocess
+import sys
+
+import pytest
+
+from hbp_spatial_backend import file_digests
+
+
+def test_file_digest(tmpdir):
+    path = str(tmpdir / 'a.trm')
+    with open(path, 'wb') as f:
+        f.write(b'content')
+    assert file_digests.file_digest(path) == hashlib.sha1(
+        b'content').hexdigest()
+    # The digest is re-computed after the file has been replaced
+    with open(path + '.new', 'wb') as f:
+        f.write(b'new content')
+    os.replace(path + '.new', path)
+    assert file_digests.file_digest(path) == hashlib.sha1(
+        b'new content').hexdigest()
+    with pytest.raises(OSError):
+        file_digests.file_digest(str(tmpdir / 'missing.trm'))
+
+
+GEVENT_HASHING_TEST = '''\
+from gevent import monkey
+monkey.patch_all()
+import sys
+import gevent
+from hbp_spatial_backend import file_digests
+file_digests._READ_CHUNK_SIZE = 1024
+ticks = []
+def tick():
+    while True:
+        ticks.append(None)
+        gevent.sleep(0)
+ticker = gevent.spawn(tick)
+gevent.sleep(0)
+ticks.clear()
+file_digests.file_digest(sys.argv[1])
+print(len(ticks))
+'''
+
+
+def test_gevent_file_digest_yields(tmpdir):
+    pytest.importorskip('gevent')
+    path = str(tmpdir / 'field.ima')
+    with open(path, 'wb') as f:
+        f.write(b'\0' * (64 * 1024))
+    script = str(tmpdir / 'gevent_hashing_test.py')
+    with open(script, 'w') as f:
+        f.write(GEVENT_HASHING_TEST)
+    res = subprocess.run([sys.executable, script, path], check=True,
+                         stdout=subprocess.PIPE, universal_newlines=True)
+    # Other greenlets run between the chunks of the file
+    assert int(res.stdout) >= 32
+
+
+def test_transform_files():
+    assert file_digests.transform_files('a.trm', cwd='/d') == ['/d/a.trm']
+    assert file_digests.transform_files('inv:b.ima') == ['b.ima', 'b.dim']
+
+
+def test_chain_digest(tmpdir):
+    for name in ('a.trm', 'b.ima', 'b.dim'):
+        with open(str(tmpdir / name), 'w') as f:
+            f.write(name)
+    cwd = str(tmpdir)
+    digest = file_digests.chain_digest(['a.trm', 'b.ima'], cwd=cwd)
+    assert file_digests.chain_digest(['a.trm', 'b.ima'], cwd=cwd) == digest
+    assert file_digests.chain_digest(['b.ima', 'a.trm'], cwd=cwd) != digest
+    assert file_digests.chain_digest(['inv:a.trm', 'b.ima'],
+                                     cwd=cwd) != digest
+    assert file_digests.chain_digest([]) == file_digests.chain_digest(None)
+
+    with open(str(tmpdir / 'b.dim'), 'w') as f:
+        f.write('modified header')
+    assert file_digests.chain_digest(['a.trm', 'b.ima'], cwd=cwd) != digest
+
+    with pytest.raises(OSError):
+        file_digests.chain_digest(['missing.trm'], cwd=cwd)
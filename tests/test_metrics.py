@@ -0,0 +1,151 @@
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+import flask
+import pytest
+
+import hbp_spatial_backend
+from hbp_spatial_backend import api_v1
+from hbp_spatial_backend import metrics
+
+
+prometheus_client = pytest.importorskip('prometheus_client')
+
+
+@pytest.fixture
+def graph_yaml(tmpdir):
+    with open(str(tmpdir / 'shift.trm'), 'w') as f:
+        f.write('1 2 3\n1 0 0\n0 1 0\n0 0 1\n')
+    path = str(tmpdir / 'graph.yaml')
+    with open(path, 'w') as f:
+        f.write('{A: {B: shift.trm}}')
+    yield path
+    api_v1.clear_transform_graph_cache()
+
+
+@pytest.fixture
+def metrics_app(graph_yaml):
+    return hbp_spatial_backend.create_app({
+        'TESTING': True,
+        'ENABLE_METRICS': True,
+        'DEFAULT_TRANSFORM_GRAPH': graph_yaml,
+        'TRANSFORM_ENGINE': 'numpy',
+    })
+
+
+def get_sample(app, name, labels):
+    registry = app.extensions['hbp_spatial_backend.metrics'].registry
+    return registry.get_sample_value('hbp_spatial_backend_' + name, labels)
+
+
+def test_metrics_disabled(client):
+    response = client.get('/metrics')
+    assert response.status_code == 404
+
+
+def test_metrics_endpoint(metrics_app):
+    with metrics_app.test_client() as client:
+        response = client.post('/v1/transform-points', json={
+            'source_space': 'A',
+            'target_space': 'B',
+            'source_points': [[0, 0, 0], [1, 1, 1], [2, 2, 2]],
+        })
+        assert response.status_code == 200
+        response = client.get('/v1/transform-point', query_string={
+            'source_space': 'A', 'target_space': 'Z', 'x': 0, 'y': 0, 'z': 0,
+        })
+        assert response.status_code == 400
+        response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    text = response.get_data(as_text=True)
+    assert 'hbp_spatial_backend_requests_total' in text
+    assert 'hbp_spatial_backend_stage_duration_seconds' in text
+
+    assert get_sample(metrics_app, 'requests_total', {
+        'endpoint': 'api_v1.transform_points', 'status': '200'}) == 1
+    assert get_sample(metrics_app, 'requests_total', {
+        'endpoint': 'api_v1.transform_point', 'status': '400'}) == 1
+    assert get_sample(metrics_app, 'request_duration_seconds_count', {
+        'endpoint': 'api_v1.transform_points'}) == 1
+    assert get_sample(metrics_app, 'pair_requests_total', {
+        'endpoint': 'api_v1.transform_points',
+        'source_space': 'A', 'target_space': 'B'}) == 1
+    assert get_sample(metrics_app, 'pair_request_duration_seconds_count', {
+        'source_space': 'A', 'target_space': 'B'}) == 1
+    # Unknown spaces do not become label values
+    assert 'target_space="Z"' not in text
+    assert get_sample(metrics_app, 'batch_size_points_sum', {
+        'endpoint': 'api_v1.transform_points'}) == 3
+    for stage in ('validation', 'graph_lookup', 'engine', 'serialization'):
+        assert get_sample(metrics_app, 'stage_duration_seconds_count',
+                          {'stage': stage}) >= 1
+    assert get_sample(metrics_app, 'engine_calls_in_progress',
+                      {'engine': 'numpy'}) == 0
+    # Only the /metrics request itself is in progress
+    assert get_sample(metrics_app, 'requests_in_progress', {
+        'endpoint': 'api_v1.transform_points'}) == 0
+
+
+def test_batch_metrics(metrics_app):
+    with metrics_app.test_client() as client:
+        response = client.post('/v1/transform-points-batch', json={'jobs': [
+            {'source_space': 'A', 'target_space': 'B',
+             'source_points': [[0, 0, 0]]},
+            {'source_space': 'A', 'target_space': 'unknown',
+             'source_points': [[0, 0, 0]]},
+            {'source_space': 'B', 'target_space': 'A',
+             'source_points': [[0, 0, 0]]},
+        ]})
+        assert response.status_code == 200
+        response = client.get('/metrics')
+    text = response.get_data(as_text=True)
+    assert get_sample(metrics_app, 'pair_requests_total', {
+        'endpoint': 'api_v1.transform_points_batch',
+        'source_space': 'A', 'target_space': 'B'}) == 1
+    # Only the jobs whose chain was found are recorded
+    assert 'target_space="unknown"' not in text
+    assert get_sample(metrics_app, 'pair_requests_total', {
+        'endpoint': 'api_v1.transform_points_batch',
+        'source_space': 'B', 'target_space': 'A'}) is None
+
+
+def test_stage_without_metrics(app):
+    with app.test_request_context():
+        with metrics.stage('engine'):
+            pass
+        with metrics.engine_call('numpy'):
+            pass
+        metrics.observe_transform_request('A', 'B', 1)
+        assert [name for name, _ in flask.g.stage_timings] == ['engine']
+    # Outside of a context, stages are silently ignored
+    with metrics.stage('engine'):
+        pass
+
+
+def test_subprocess_stages(metrics_app, stub_aims):
+    with metrics_app.test_client() as client:
+        metrics_app.config['TRANSFORM_ENGINE'] = 'subprocess'
+        response = client.post('/v1/transform-points', json={
+            'source_space': 'A',
+            'target_space': 'B',
+            'source_points': [[0, 0, 0]],
+        })
+        assert response.status_code == 200
+    assert get_sample(metrics_app, 'stage_duration_seconds_count',
+                      {'stage': 'parsing'}) == 1
+    assert get_sample(metrics_app, 'stage_duration_seconds_count',
+                      {'stage': 'engine'}) == 1
@@ -0,0 +1,118 @@
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+import concurrent.futures
+import threading
+import time
+
+import pytest
+
+from hbp_spatial_backend import micro_batch
+from hbp_spatial_backend.micro_batch import MicroBatcher
+
+
+def test_micro_batcher():
+    batcher = MicroBatcher(window=0.5, max_size=4)
+    calls = []
+
+    def func(items):
+        calls.append(list(items))
+        return [2 * item for item in items]
+
+    # A full batch is run without waiting for the window to expire
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        futures = [executor.submit(batcher.submit, 'key', i, func)
+                   for i in range(8)]
+        results = [future.result(timeout=0.4) for future in futures]
+    assert results == [2 * i for i in range(8)]
+    assert sorted(len(items) for items in calls) == [4, 4]
+    assert batcher.stats() == {'open_batches': 0, 'batches': 2, 'items': 8}
+
+    # The batches of different keys are separate
+    calls.clear()
+    batcher = MicroBatcher(window=0.01, max_size=4)
+    assert batcher.submit('a', 1, func) == 2
+    assert batcher.submit('b', 2, func) == 4
+    assert calls == [[1], [2]]
+
+    with pytest.raises(ValueError):
+        MicroBatcher(window=0.01, max_size=0)
+
+
+def test_micro_batcher_exception():
+    batcher = MicroBatcher(window=0.1, max_size=3)
+
+    def func(items):
+        raise RuntimeError('failure')
+
+    with concurrent.futures.ThreadPoolExecutor(3) as executor:
+        futures = [executor.submit(batcher.submit, 'key', i, func)
+                   for i in range(3)]
+        for future in futures:
+            with pytest.raises(RuntimeError):
+                future.result()
+
+    with pytest.raises(ValueError):
+        batcher.submit('key', 0, lambda items: [])
+    assert batcher.stats()['open_batches'] == 0
+
+
+class Interrupt(BaseException):
+    pass
+
+
+class InterruptingEvent(threading.Event):
+    def wait(self, timeout=None):
+        time.sleep(0.1)
+        raise Interrupt()
+
+
+@pytest.mark.parametrize('interrupt_while_collecting', [False, True])
+def test_micro_batcher_interrupted_leader(monkeypatch,
+                                          interrupt_while_collecting):
+    batcher = MicroBatcher(window=0.2, max_size=10)
+    calls = []
+
+    def func(items):
+        calls.append(list(items))
+        if len(calls) == 1 and not interrupt_while_collecting:
+            raise Interrupt()
+        return [2 * item for item in items]
+
+    if interrupt_while_collecting:
+        # The first batch is interrupted while it collects the items
+        batches = []
+
+        class InterruptedBatch(micro_batch._Batch):
+            def __init__(self):
+                super().__init__()
+                if not batches:
+                    self.full = InterruptingEvent()
+                batches.append(self)
+
+        monkeypatch.setattr(micro_batch, '_Batch', InterruptedBatch)
+
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        leader = executor.submit(batcher.submit, 'key', 1, func)
+        time.sleep(0.05)
+        waiter = executor.submit(batcher.submit, 'key', 2, func)
+        with pytest.raises(Interrupt):
+            leader.result()
+        # The exception of the leader is not shared, the waiter submits its
+        # item again
+        assert waiter.result(timeout=1) == 4
+    assert calls[-1] == [2]
+    assert batcher.stats()['open_batches'] == 0
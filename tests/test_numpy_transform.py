@@ -0,0 +1,336 @@
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+from distutils.spawn import find_executable
+import os
+import unittest.mock
+
+import numpy as np
+import pytest
+
+from hbp_spatial_backend import apply_transform
+from hbp_spatial_backend import numpy_transform
+
+
+FLIP_TRM = '0 0 0\n-1 0 0\n0 -1 0\n0 0 -1\n'
+SHIFT_TRM = '1 2 3\n1 0 0\n0 1 0\n0 0 1\n'
+
+# Reference inputs and outputs of AimsApplyTransform, see make_expected.sh in
+# that directory
+AIMS_PARITY_DIR = os.path.join(os.path.dirname(__file__),
+                               'data', 'aims_parity')
+AIMS_PARITY_CHAINS = [
+    ('expected-field.txt', ['field.ima']),
+    ('expected-affine-field.txt', ['affine.trm', 'field.ima']),
+    ('expected-field-invaffine.txt', ['field.ima', 'inv:affine.trm']),
+]
+
+
+@pytest.fixture
+def transform_dir(tmpdir):
+    with open(str(tmpdir / 'flip.trm'), 'w') as f:
+        f.write(FLIP_TRM)
+    with open(str(tmpdir / 'shift.trm'), 'w') as f:
+        f.write(SHIFT_TRM)
+    # Affine displacement field D(x, y, z) = (0.1 x, -0.2 z, 1), which
+    # trilinear interpolation reproduces exactly
+    voxel_size = (2.0, 1.5, 1.0)
+    z, y, x = np.meshgrid(np.arange(20) * voxel_size[2],
+                          np.arange(30) * voxel_size[1],
+                          np.arange(25) * voxel_size[0],
+                          indexing='ij')
+    field = np.stack([0.1 * x, -0.2 * z, np.ones_like(x)], axis=-1)
+    numpy_transform.write_gis_field(str(tmpdir / 'field.ima'), field,
+                                    voxel_size)
+    return str(tmpdir)
+
+
+def expected_field_transform(points):
+    points = np.asarray(points, dtype=float)
+    return points + np.stack([0.1 * points[:, 0],
+                              -0.2 * points[:, 2],
+                              np.ones(len(points))], axis=-1)
+
+
+def test_trm_roundtrip(tmpdir):
+    matrix = np.array([[0, 1, 0, 10],
+                       [-1, 0, 0, 20.5],
+                       [0, 0, 2, -3e-3],
+                       [0, 0, 0, 1]])
+    path = str(tmpdir / 'test.trm')
+    numpy_transform.write_trm(path, matrix)
+    assert np.array_equal(numpy_transform.read_trm(path), matrix)
+
+
+def test_read_malformed_trm(tmpdir):
+    path = str(tmpdir / 'test.trm')
+    with open(path, 'w') as f:
+        f.write('1 2 3\n')
+    with pytest.raises(ValueError):
+        numpy_transform.read_trm(path)
+
+
+def test_gis_field_roundtrip(tmpdir):
+    field = np.random.RandomState(0).normal(size=(4, 5, 6, 3))
+    path = str(tmpdir / 'field.ima')
+    numpy_transform.write_gis_field(path, field, (1, 2, 3))
+    header = numpy_transform.read_gis_header(str(tmpdir / 'field.dim'))
+    assert header['shape'] == (6, 5, 4, 1)
+    assert header['type'] == 'POINT3DF'
+    data, voxel_size = numpy_transform.read_gis_field(path)
+    assert voxel_size == (1, 2, 3)
+    assert np.allclose(data, field.astype(np.float32))
+
+
+def test_affine_chain(transform_dir):
+    res = numpy_transform.transform_points([(1, 2, 3)], ['flip.trm'],
+                                           cwd=transform_dir)
+    assert np.array_equal(res, [(-1, -2, -3)])
+    res = numpy_transform.transform_points([(1, 2, 3)],
+                                           ['flip.trm', 'shift.trm'],
+                                           cwd=transform_dir)
+    assert np.array_equal(res, [(0, 0, 0)])
+    res = numpy_transform.transform_points([(1, 2, 3)],
+                                           ['inv:shift.trm'],
+                                           cwd=transform_dir)
+    assert np.array_equal(res, [(0, 0, 0)])
+    res = numpy_transform.transform_points([(1, 2, 3)], [],
+                                           cwd=transform_dir)
+    assert np.array_equal(res, [(1, 2, 3)])
+
+
+def test_displacement_field(transform_dir):
+    points = np.array([
+        (0, 0, 0),
+        (10.3, 20.1, 5.7),
+        (48, 43.5, 19),  # corner of the field of view
+    ])
+    res = numpy_transform.transform_points(points, ['field.ima'],
+                                           cwd=transform_dir)
+    assert np.allclose(res, expected_field_transform(points))
+
+    # Points outside of the field of view are not displaced
+    outside_points = [(-1, 0, 0), (0, 0, 19.5), (100, 100, 100)]
+    res = numpy_transform.transform_points(outside_points, ['field.ima'],
+                                           cwd=transform_dir)
+    assert np.array_equal(res, outside_points)
+
+    with pytest.raises(numpy_transform.UnsupportedTransformError):
+        numpy_transform.transform_points(points, ['inv:field.ima'],
+                                         cwd=transform_dir)
+
+
+def test_unsupported_format(transform_dir):
+    with open(os.path.join(transform_dir, 'field.nii'), 'w'):
+        pass
+    with pytest.raises(numpy_transform.UnsupportedTransformError):
+        numpy_transform.transform_points([(0, 0, 0)], ['field.nii'],
+                                         cwd=transform_dir)
+
+
+def test_modified_transform_is_reloaded(transform_dir):
+    res = numpy_transform.transform_points([(1, 2, 3)], ['flip.trm'],
+                                           cwd=transform_dir)
+    assert np.array_equal(res, [(-1, -2, -3)])
+    path = os.path.join(transform_dir, 'flip.trm')
+    with open(path, 'w') as f:
+        f.write(SHIFT_TRM)
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    res = numpy_transform.transform_points([(1, 2, 3)], ['flip.trm'],
+                                           cwd=transform_dir)
+    assert np.array_equal(res, [(2, 4, 6)])
+
+
+def test_numpy_engine(app, transform_dir):
+    app.config['TRANSFORM_ENGINE'] = 'numpy'
+    with app.app_context():
+        res = apply_transform.transform_points(
+            [(1, 2, 3), (4, 5, 6)], ['flip.trm'], cwd=transform_dir)
+    assert res == [(-1, -2, -3), (-4, -5, -6)]
+
+
+@unittest.mock.patch('subprocess.run', autospec=True)
+def test_numpy_engine_fallback(subprocess_run_mock, app, transform_dir):
+    class CompletedProcessMock:
+        stdout = '(4, 5, 6)\n'
+    subprocess_run_mock.return_value = CompletedProcessMock()
+    app.config['TRANSFORM_ENGINE'] = 'numpy'
+    with app.app_context():
+        res = apply_transform.transform_points(
+            [(1, 2, 3)], ['inv:field.ima'], cwd=transform_dir)
+    assert subprocess_run_mock.called
+    assert res == [(4, 5, 6)]
+
+
+def test_invalid_engine(app):
+    app.config['TRANSFORM_ENGINE'] = 'nonexistent'
+    with app.app_context():
+        with pytest.raises(ValueError):
+            apply_transform.transform_points([(1, 2, 3)], [])
+
+
+@pytest.mark.skipif(find_executable('AimsApplyTransform') is None,
+                    reason='AimsApplyTransform not found on PATH')
+@pytest.mark.parametrize('chain', [
+    [],
+    ['flip.trm'],
+    ['inv:shift.trm', 'flip.trm'],
+    ['field.ima'],
+    ['shift.trm', 'field.ima', 'flip.trm'],
+])
+def test_engines_agree_with_AimsApplyTransform(app, transform_dir, chain):
+    points = np.random.RandomState(0).uniform(0, 18, size=(100, 3))
+    with app.app_context():
+        app.config['TRANSFORM_ENGINE'] = 'subprocess'
+        res_subprocess = apply_transform.transform_points(
+            points.tolist(), chain, cwd=transform_dir)
+        app.config['TRANSFORM_ENGINE'] = 'numpy'
+        res_numpy = apply_transform.transform_points(
+            points.tolist(), chain, cwd=transform_dir)
+    assert np.allclose(res_numpy, res_subprocess, atol=1e-4)
+
+
+def read_aims_parity_points(filename):
+    with open(os.path.join(AIMS_PARITY_DIR, filename)) as f:
+        return apply_transform.parse_points_output_array(f.read())
+
+
+@pytest.mark.parametrize('expected_file,chain', AIMS_PARITY_CHAINS)
+def test_numpy_engine_matches_AIMS_reference(app, expected_file, chain):
+    # The points cover the inside of the field, its borders (where the
+    # trilinear interpolation uses the last voxels), and its outside (where
+    # points are not displaced)
+    points = read_aims_parity_points('points.txt')
+    expected = read_aims_parity_points(expected_file)
+    assert len(points) == len(expected) == 14
+    with app.app_context():
+        app.config['TRANSFORM_ENGINE'] = 'numpy'
+        result = apply_transform.transform_points(
+            points.tolist(), chain, cwd=AIMS_PARITY_DIR)
+    assert np.allclose(result, expected, atol=1e-4)
+
+
+@pytest.mark.skipif(find_executable('AimsApplyTransform') is None,
+                    reason='AimsApplyTransform not found on PATH')
+@pytest.mark.parametrize('expected_file,chain', AIMS_PARITY_CHAINS)
+def test_AimsApplyTransform_matches_AIMS_reference(app, expected_file,
+                                                   chain):
+    points = read_aims_parity_points('points.txt')
+    expected = read_aims_parity_points(expected_file)
+    with app.app_context():
+        app.config['TRANSFORM_ENGINE'] = 'subprocess'
+        result = apply_transform.transform_points(
+            points.tolist(), chain, cwd=AIMS_PARITY_DIR)
+    assert np.allclose(result, expected, atol=1e-4)
+
+
+def test_affine_inverse_is_cached(transform_dir):
+    transform = numpy_transform.load_transform('shift.trm',
+                                               cwd=transform_dir)
+    with unittest.mock.patch('numpy.linalg.inv',
+                             wraps=np.linalg.inv) as inv_mock:
+        inverse = transform.inverse()
+        assert transform.inverse() is inverse
+        assert numpy_transform.load_transform(
+            'inv:shift.trm', cwd=transform_dir) is inverse
+        assert inverse.inverse() is transform
+    assert inv_mock.call_count == 1
+    assert np.allclose(inverse.transform(np.array([[1., 2., 3.]])), 0)
+
+
+def test_fold_affine_transforms(transform_dir):
+    output_dir = os.path.join(transform_dir, 'folded')
+    chain = ['shift.trm', 'inv:flip.trm', 'field.ima', 'flip.trm',
+             'inv:shift.trm', 'shift.trm', 'field.ima', 'shift.trm']
+    folded_chain = numpy_transform.fold_affine_transforms(
+        chain, output_dir, cwd=transform_dir)
+    assert len(folded_chain) == 5
+    assert folded_chain[1] == 'field.ima'
+    assert folded_chain[3] == 'field.ima'
+    assert folded_chain[4] == 'shift.trm'
+    # The composed files are referenced relative to cwd
+    assert folded_chain[0].startswith('folded' + os.sep)
+    assert len(os.listdir(output_dir)) == 2
+
+    points = np.random.RandomState(0).uniform(0, 18, size=(100, 3))
+    res = numpy_transform.transform_points(points, chain, cwd=transform_dir)
+    res_folded = numpy_transform.transform_points(points, folded_chain,
+                                                  cwd=transform_dir)
+    assert np.allclose(res_folded, res, atol=1e-12)
+
+    # The composed files are shared
+    assert numpy_transform.fold_affine_transforms(
+        ['flip.trm', 'inv:shift.trm', 'shift.trm'], output_dir,
+        cwd=transform_dir) == [folded_chain[2]]
+    assert len(os.listdir(output_dir)) == 2
+    # Lone affine transformations are kept as they are
+    assert numpy_transform.fold_affine_transforms(
+        ['inv:flip.trm', 'field.ima'], output_dir,
+        cwd=transform_dir) == ['inv:flip.trm', 'field.ima']
+
+
+def test_fold_transform_chain(app, transform_dir, tmpdir):
+    app.config['FOLD_AFFINE_TRANSFORMS'] = True
+    app.config['FOLDED_TRANSFORMS_DIR'] = str(tmpdir / 'folded')
+    app.config['TRANSFORM_ENGINE'] = 'numpy'
+    with app.app_context():
+        res = apply_transform.transform_points(
+            [(1, 2, 3)], ['shift.trm', 'flip.trm'], cwd=transform_dir)
+        assert res == [(-2, -4, -6)]
+        folded_chain = apply_transform.fold_transform_chain(
+            ['shift.trm', 'flip.trm', 'field.ima'], cwd=transform_dir)
+        assert len(folded_chain) == 2
+        assert folded_chain[1] == 'field.ima'
+        # The commands are run by the clients, which do not have the
+        # composed files
+        cmd = apply_transform.get_transform_command(
+            ['shift.trm', 'flip.trm', 'field.ima'],
+            ['inv:field.ima', 'flip.trm', 'inv:shift.trm'],
+            cwd=transform_dir)
+        assert cmd.count('--direct-transform') == 3
+        assert cmd.count('--inverse-transform') == 3
+        # Chains that cannot be folded are used as they are
+        assert apply_transform.fold_transform_chain(
+            ['missing.trm', 'flip.trm'], cwd=transform_dir) == [
+                'missing.trm', 'flip.trm']
+    apply_transform.clear_folded_chains_cache()
+
+
+def test_fold_transform_chain_modified_file(app, tmpdir):
+    app.config['FOLD_AFFINE_TRANSFORMS'] = True
+    app.config['FOLDED_TRANSFORMS_DIR'] = str(tmpdir / 'folded')
+    app.config['TRANSFORM_ENGINE'] = 'numpy'
+    cwd = str(tmpdir)
+
+    def write_shift(name, shift):
+        with open(str(tmpdir / name), 'w') as f:
+            f.write('{0} {1} {2}\n1 0 0\n0 1 0\n0 0 1\n'.format(*shift))
+
+    write_shift('s1.trm', (1, 0, 0))
+    write_shift('s2.trm', (0, 1, 0))
+    try:
+        with app.app_context():
+            res = apply_transform.transform_points(
+                [(0, 0, 0)], ['s1.trm', 's2.trm'], cwd=cwd)
+            assert res == [(1, 1, 0)]
+            # The chain is folded again when one of its files changes
+            write_shift('s1.trm', (100, 0, 0))
+            res = apply_transform.transform_points(
+                [(0, 0, 0)], ['s1.trm', 's2.trm'], cwd=cwd)
+            assert res == [(100, 1, 0)]
+    finally:
+        apply_transform.clear_folded_chains_cache()
@@ -0,0 +1,128 @@
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+import subprocess
+import sys
+import time
+
+import pytest
+
+from hbp_spatial_backend import point_cache
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def make_cache(request, tmpdir):
+    def make_cache(**kwargs):
+        if request.param == 'memory':
+            return point_cache.MemoryPointCache(**kwargs)
+        else:
+            return point_cache.SQLitePointCache(
+                str(tmpdir / 'point-cache.sqlite3'), **kwargs)
+    return make_cache
+
+
+def test_point_cache(make_cache):
+    cache = make_cache(max_size=10, precision=1)
+    keys = cache.make_keys([(1, 2, 3), (1.04, 2, 3), (1.1, 2, 3)], ['A.trm'],
+                           cwd='/toto')
+    assert keys[0] == keys[1]
+    assert keys[0] != keys[2]
+    assert cache.get_many(keys) == [None, None, None]
+    cache.set_many(keys[:1], [[4, 5, 6]])
+    assert cache.get_many(keys) == [(4, 5, 6), (4, 5, 6), None]
+    other_keys = cache.make_keys([(1, 2, 3)], ['A.trm'], cwd='/titi')
+    assert cache.get_many(other_keys) == [None]
+    other_keys = cache.make_keys([(1, 2, 3)], ['B.trm'], cwd='/toto')
+    assert cache.get_many(other_keys) == [None]
+    other_keys = cache.make_keys([(1, 2, 3)], ['A.trm'], cwd='/toto',
+                                 version='modified')
+    assert cache.get_many(other_keys) == [None]
+    assert cache.stats() == {'hits': 2, 'misses': 7, 'size': 1,
+                             'max_size': 10}
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.get_many(keys[:1]) == [None]
+
+
+def test_point_cache_expiry(make_cache):
+    cache = make_cache(max_size=10, ttl=0.1)
+    keys = cache.make_keys([(1, 2, 3)], ['A.trm'])
+    cache.set_many(keys, [(4, 5, 6)])
+    assert cache.get_many(keys) == [(4, 5, 6)]
+    time.sleep(0.2)
+    assert cache.get_many(keys) == [None]
+
+
+def test_point_cache_size(make_cache):
+    cache = make_cache(max_size=3)
+    points = [(i, 0, 0) for i in range(5)]
+    keys = cache.make_keys(points, ['A.trm'])
+    for key, point in zip(keys, points):
+        cache.set_many([key], [point])
+    assert len(cache) == 3
+    # The most recent points are kept
+    assert cache.get_many(keys[2:]) == points[2:]
+
+
+def test_memory_point_cache_lru():
+    cache = point_cache.MemoryPointCache(max_size=2)
+    keys = cache.make_keys([(1, 2, 3), (4, 5, 6), (7, 8, 9)], ['A.trm'])
+    cache.set_many(keys[:2], [(1, 1, 1), (2, 2, 2)])
+    cache.get_many(keys[:1])
+    cache.set_many(keys[2:], [(3, 3, 3)])
+    # (4, 5, 6) was the least recently used point
+    assert cache.get_many(keys) == [(1, 1, 1), None, (3, 3, 3)]
+
+
+def test_sqlite_point_cache_eviction_with_gaps(tmpdir):
+    cache = point_cache.SQLitePointCache(str(tmpdir / 'point-cache.sqlite3'),
+                                         max_size=3)
+    points = [(i, 0, 0) for i in range(4)]
+    keys = cache.make_keys(points, ['A.trm'])
+    cache.set_many(keys[:3], points[:3])
+    # e.g. the row has been evicted by another process
+    cache._connect().execute('DELETE FROM points WHERE x = 1')
+    cache.set_many(keys[3:], points[3:])
+    assert len(cache) == 3
+    assert cache.get_many(keys) == [points[0], None, points[2], points[3]]
+
+
+def test_sqlite_point_cache_purges_expired(tmpdir):
+    cache = point_cache.SQLitePointCache(str(tmpdir / 'point-cache.sqlite3'),
+                                         max_size=10, ttl=0.1)
+    keys = cache.make_keys([(1, 2, 3), (4, 5, 6)], ['A.trm'])
+    cache.set_many(keys[:1], [(1, 1, 1)])
+    time.sleep(0.2)
+    cache.set_many(keys[1:], [(2, 2, 2)])
+    assert len(cache) == 1
+
+
+SQLITE_WRITER = '''\
+import sys
+from hbp_spatial_backend import point_cache
+cache = point_cache.SQLitePointCache(sys.argv[1], max_size=10)
+cache.set_many(cache.make_keys([(1, 2, 3)], ['A.trm']), [(4, 5, 6)])
+'''
+
+
+def test_sqlite_point_cache_is_shared(tmpdir):
+    path = str(tmpdir / 'point-cache.sqlite3')
+    cache = point_cache.SQLitePointCache(path, max_size=10)
+    keys = cache.make_keys([(1, 2, 3)], ['A.trm'])
+    assert cache.get_many(keys) == [None]
+    # Points computed by another process are visible
+    subprocess.run([sys.executable, '-c', SQLITE_WRITER, path], check=True)
+    assert cache.get_many(keys) == [(4, 5, 6)]
@@ -0,0 +1,128 @@
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+import io
+
+import numpy as np
+import pytest
+
+from hbp_spatial_backend import point_io
+
+
+@pytest.mark.parametrize('mimetype', point_io.BINARY_MIMETYPES)
+@pytest.mark.parametrize('dtype', ['float32', 'float64'])
+def test_points_buffer_roundtrip(mimetype, dtype):
+    points = np.random.RandomState(0).normal(size=(10, 3)).astype(dtype)
+    data = point_io.points_to_buffer(points, mimetype, dtype=dtype)
+    res = point_io.parse_points_buffer(data, mimetype, dtype=dtype)
+    assert res.dtype == np.dtype(dtype)
+    assert np.array_equal(res, points)
+    # No copy is made
+    assert not res.flags.owndata
+
+
+def test_parse_octet_stream():
+    data = np.array([1, 2, 3, 4, 5, 6], dtype='<f8').tobytes()
+    res = point_io.parse_points_buffer(data, 'application/octet-stream')
+    assert res.tolist() == [[1, 2, 3], [4, 5, 6]]
+    res = point_io.parse_points_buffer(b'', 'application/octet-stream')
+    assert res.shape == (0, 3)
+    with pytest.raises(ValueError):
+        point_io.parse_points_buffer(data[:-8], 'application/octet-stream')
+    with pytest.raises(ValueError):
+        point_io.parse_points_buffer(data, 'application/octet-stream',
+                                     dtype='int32')
+
+
+def test_parse_npy():
+    def npy(array):
+        buf = io.BytesIO()
+        np.save(buf, array)
+        return buf.getvalue()
+
+    res = point_io.parse_points_buffer(npy(np.zeros((2, 3), dtype='>f4')),
+                                       'application/x-npy')
+    assert res.tolist() == [[0, 0, 0], [0, 0, 0]]
+    with pytest.raises(ValueError):
+        point_io.parse_points_buffer(npy(np.zeros((2, 4))),
+                                     'application/x-npy')
+    with pytest.raises(ValueError):
+        point_io.parse_points_buffer(npy(np.zeros((2, 3), dtype=int)),
+                                     'application/x-npy')
+    with pytest.raises(ValueError):
+        point_io.parse_points_buffer(npy(np.zeros((3, 2)).T),
+                                     'application/x-npy')
+    with pytest.raises(ValueError):
+        point_io.parse_points_buffer(npy(np.zeros((2, 3)))[:-1],
+                                     'application/x-npy')
+    with pytest.raises(ValueError):
+        point_io.parse_points_buffer(b'garbage', 'application/x-npy')
+
+
+def test_parse_non_finite():
+    data = np.array([0, 0, np.inf]).tobytes()
+    with pytest.raises(ValueError):
+        point_io.parse_points_buffer(data, 'application/octet-stream')
+
+
+class ShortReadStream(io.BytesIO):
+    """Stream that returns at most 7 bytes per read, like a socket may."""
+
+    def read(self, size=-1):
+        return super().read(min(size, 7) if size >= 0 else 7)
+
+
+def test_iter_octet_stream_chunks():
+    points = np.arange(15, dtype='<f4').reshape(5, 3)
+    chunks = list(point_io.iter_points_chunks(
+        ShortReadStream(points.tobytes()), 'application/octet-stream', 2,
+        dtype='float32'))
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    assert np.array_equal(np.concatenate(chunks), points)
+    assert list(point_io.iter_points_chunks(
+        io.BytesIO(b''), 'application/octet-stream', 2)) == []
+
+    chunks = point_io.iter_points_chunks(
+        io.BytesIO(points.tobytes()[:-1]), 'application/octet-stream', 2,
+        dtype='float32')
+    assert len(next(chunks)) == 2
+    assert len(next(chunks)) == 2
+    with pytest.raises(ValueError):
+        next(chunks)
+
+
+def test_iter_ndjson_chunks():
+    data = b'[1, 2, 3]\n\n[4.5, 5, 6]\r\n[7, 8, 9]'
+    chunks = list(point_io.iter_points_chunks(
+        io.BytesIO(data), 'application/x-ndjson', 2))
+    assert [chunk.tolist() for chunk in chunks] == [
+        [[1, 2, 3], [4.5, 5, 6]],
+        [[7, 8, 9]],
+    ]
+    assert chunks[0].dtype == np.float64
+
+    for invalid_line in (b'[1, 2]', b'[1, 2, 3, 4]', b'[1, 2, "a"]',
+                         b'[1, 2, NaN]', b'[1, 2, 1e400]',
+                         b'[1, 2, ' + b'9' * 400 + b']',
+                         b'[true, false, true]', b'{"x": 1}', b'garbage'):
+        chunks = point_io.iter_points_chunks(
+            io.BytesIO(b'[1, 2, 3]\n\n' + invalid_line + b'\n'),
+            'application/x-ndjson', 10)
+        with pytest.raises(ValueError, match='line 3'):
+            next(chunks)
+
+    with pytest.raises(ValueError):
+        point_io.iter_points_chunks(io.BytesIO(data), 'application/x-npy', 2)
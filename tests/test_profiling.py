@@ -0,0 +1,101 @@
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+import os
+import pstats
+
+import pytest
+
+import hbp_spatial_backend
+from hbp_spatial_backend import api_v1
+from hbp_spatial_backend import profiling
+
+
+@pytest.fixture
+def profiling_app(tmpdir):
+    with open(str(tmpdir / 'shift.trm'), 'w') as f:
+        f.write('1 2 3\n1 0 0\n0 1 0\n0 0 1\n')
+    graph_yaml = str(tmpdir / 'graph.yaml')
+    with open(graph_yaml, 'w') as f:
+        f.write('{A: {B: shift.trm}}')
+    yield hbp_spatial_backend.create_app({
+        'TESTING': True,
+        'ENABLE_PROFILING': True,
+        'PROFILING_DIR': str(tmpdir / 'profiles'),
+        'DEFAULT_TRANSFORM_GRAPH': graph_yaml,
+        'TRANSFORM_ENGINE': 'numpy',
+    })
+    api_v1.clear_transform_graph_cache()
+
+
+def test_format_server_timing():
+    assert profiling.format_server_timing([]) == ''
+    assert profiling.format_server_timing(
+        [('engine', 0.001), ('parsing', 0.0005), ('engine', 0.002)],
+        total_time=0.01,
+    ) == 'engine;dur=3.000, parsing;dur=0.500, total;dur=10.000'
+
+
+def test_profiling_disabled(client):
+    response = client.get('/health', headers={'X-Profile': '1'})
+    assert 'Server-Timing' not in response.headers
+    assert 'X-Profile-File' not in response.headers
+
+
+@pytest.mark.parametrize('request_kwargs', [
+    {'headers': {'X-Profile': '1'}},
+    {'query_string': {'profile': 'yes'}},
+])
+def test_profile_request(profiling_app, request_kwargs):
+    with profiling_app.test_client() as client:
+        response = client.post('/v1/transform-points', json={
+            'source_space': 'A',
+            'target_space': 'B',
+            'source_points': [[0, 0, 0], [1, 1, 1]],
+        }, **request_kwargs)
+    assert response.status_code == 200
+    timings = dict(item.split(';dur=') for item in
+                   response.headers['Server-Timing'].split(', '))
+    assert set(timings) == {'validation', 'graph_lookup', 'engine',
+                            'serialization', 'total'}
+    assert all(float(t) >= 0 for t in timings.values())
+
+    path = os.path.join(profiling_app.config['PROFILING_DIR'],
+                        response.headers['X-Profile-File'])
+    stats = pstats.Stats(path)
+    profiled_functions = {(os.path.basename(filename), name)
+                          for filename, _, name in stats.stats}
+    assert ('api_v1.py', 'transform_points') in profiled_functions
+    assert ('api_v1.py', '_get_transform_graph') in profiled_functions
+    assert ('apply_transform.py', 'transform_points') in profiled_functions
+
+
+def test_request_not_profiled(profiling_app):
+    with profiling_app.test_client() as client:
+        response = client.get('/health', headers={'X-Profile': '0'})
+    assert response.status_code == 200
+    assert 'Server-Timing' not in response.headers
+
+
+def test_profile_binary_request(profiling_app):
+    with profiling_app.test_client() as client:
+        response = client.post(
+            '/v1/transform-points',
+            query_string={'source_space': 'A', 'target_space': 'B',
+                          'profile': '1'},
+            data=b'\0' * 24, content_type='application/octet-stream')
+    assert response.status_code == 200
+    assert 'validation;dur=' in response.headers['Server-Timing']
@@ -0,0 +1,95 @@
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+import os
+import time
+
+import numpy as np
+import pytest
+
+from hbp_spatial_backend import result_store
+
+
+def test_result_key(tmpdir):
+    with open(str(tmpdir / 'a.trm'), 'w') as f:
+        f.write('0 0 0\n1 0 0\n0 1 0\n0 0 1\n')
+    cwd = str(tmpdir)
+    points = np.arange(6, dtype=float).reshape(2, 3)
+    key = result_store.result_key(['a.trm'], points, cwd=cwd)
+    assert result_store.KEY_RE.match(key)
+    assert result_store.result_key(['a.trm'], points.tolist(),
+                                   cwd=cwd) == key
+    assert result_store.result_key(['inv:a.trm'], points, cwd=cwd) != key
+    assert result_store.result_key(['a.trm'], points[:1], cwd=cwd) != key
+    with pytest.raises(OSError):
+        result_store.result_key(['missing.trm'], points, cwd=cwd)
+
+
+def test_result_store(tmpdir):
+    store = result_store.ResultStore(str(tmpdir / 'results'), 10**6)
+    key = 'a' * 64
+    assert store.get(key) is None
+    store.put(key, [(1, 2, 3), (4, 5, 6)])
+    assert store.get(key).tolist() == [[1, 2, 3], [4, 5, 6]]
+    assert store.stats()['results'] == 1
+    with pytest.raises(ValueError):
+        store.get('../graph')
+
+
+def test_result_store_eviction(tmpdir):
+    points = np.zeros((100, 3))
+    store = result_store.ResultStore(str(tmpdir), 10**6)
+    store.put('0' * 64, points)
+    result_size = os.path.getsize(str(tmpdir / ('0' * 64 + '.npy')))
+    # Room for 3 results
+    store = result_store.ResultStore(str(tmpdir), 3 * result_size)
+    for i in range(1, 3):
+        time.sleep(0.01)
+        store.put(str(i) * 64, points)
+    time.sleep(0.01)
+    # Reading a result makes it the most recently used
+    assert store.get('0' * 64) is not None
+    time.sleep(0.01)
+    store.put('3' * 64, points)
+    assert store.stats()['results'] == 3
+    assert store.get('1' * 64) is None
+    for i in (0, 2, 3):
+        assert store.get(str(i) * 64) is not None
+
+
+def test_result_store_too_large(tmpdir):
+    store = result_store.ResultStore(str(tmpdir), 1000)
+    assert not store.put('0' * 64, np.zeros((100, 3)))
+    assert store.get('0' * 64) is None
+    assert store.put('1' * 64, np.zeros((10, 3)))
+    assert store.get('1' * 64) is not None
+
+
+def test_result_store_eviction_scans(tmpdir, monkeypatch):
+    store = result_store.ResultStore(str(tmpdir), 10**6)
+    scans = []
+    evict = store.evict
+
+    def evict_spy():
+        scans.append(None)
+        evict()
+    monkeypatch.setattr(store, 'evict', evict_spy)
+    monkeypatch.setattr(result_store, 'EVICTION_INTERVAL', 5)
+    for i in range(11):
+        store.put('{0:064x}'.format(i), np.zeros((10, 3)))
+    # The first put measures the store, then it is re-scanned periodically
+    assert len(scans) == 3
+    assert store.stats()['size'] == store._size
@@ -0,0 +1,137 @@
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+import concurrent.futures
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from hbp_spatial_backend.single_flight import SingleFlight
+
+
+def test_single_flight():
+    coalescer = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def func():
+        calls.append(None)
+        release.wait()
+        return ['result']
+
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        futures = [executor.submit(coalescer.do, 'key', func)
+                   for _ in range(4)]
+        while coalescer.stats()['coalesced_calls'] < 3:
+            release.wait(0.01)
+        assert len(coalescer) == 1
+        release.set()
+        results = [future.result() for future in futures]
+    assert len(calls) == 1
+    assert results == [['result']] * 4
+    assert coalescer.stats() == {
+        'in_flight': 0, 'calls': 1, 'coalesced_calls': 3}
+
+    # Calls that are not concurrent are not coalesced
+    assert coalescer.do('key', func) == ['result']
+    assert len(calls) == 2
+    assert len(coalescer) == 0
+
+
+def test_single_flight_exception():
+    coalescer = SingleFlight()
+    release = threading.Event()
+
+    def func():
+        release.wait()
+        raise RuntimeError('failure')
+
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        futures = [executor.submit(coalescer.do, 'key', func)
+                   for _ in range(2)]
+        while coalescer.stats()['coalesced_calls'] < 1:
+            release.wait(0.01)
+        release.set()
+        for future in futures:
+            with pytest.raises(RuntimeError):
+                future.result()
+    assert len(coalescer) == 0
+    assert coalescer.do('key', lambda: 1) == 1
+
+
+class Interrupt(BaseException):
+    pass
+
+
+def test_single_flight_interrupted_leader():
+    coalescer = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def func():
+        calls.append(None)
+        if len(calls) == 1:
+            release.wait()
+            raise Interrupt()
+        return 'result'
+
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        leader = executor.submit(coalescer.do, 'key', func)
+        while not calls:
+            release.wait(0.01)
+        waiter = executor.submit(coalescer.do, 'key', func)
+        while coalescer.stats()['coalesced_calls'] < 1:
+            release.wait(0.01)
+        release.set()
+        with pytest.raises(Interrupt):
+            leader.result()
+        # The exception of the leader is not shared, the waiter calls func
+        # again
+        assert waiter.result() == 'result'
+    assert len(calls) == 2
+    assert len(coalescer) == 0
+
+
+GEVENT_TIMEOUT_TEST = '''\
+from gevent import monkey
+monkey.patch_all()
+import gevent
+from hbp_spatial_backend.single_flight import SingleFlight
+coalescer = SingleFlight()
+def func():
+    gevent.sleep(0.2)
+    return 'result'
+def leader():
+    with gevent.Timeout(0.1):
+        return coalescer.do('key', func)
+leader_greenlet = gevent.spawn(leader)
+gevent.sleep(0.01)
+waiter_greenlet = gevent.spawn(coalescer.do, 'key', func)
+gevent.joinall([leader_greenlet, waiter_greenlet])
+assert isinstance(leader_greenlet.exception, gevent.Timeout)
+assert waiter_greenlet.successful(), waiter_greenlet.exception
+assert waiter_greenlet.value == 'result'
+'''
+
+
+def test_single_flight_gevent_timeout(tmpdir):
+    pytest.importorskip('gevent')
+    script = str(tmpdir / 'gevent_timeout_test.py')
+    with open(script, 'w') as f:
+        f.write(GEVENT_TIMEOUT_TEST)
+    subprocess.run([sys.executable, script], check=True)
@@ -16,6 +16,7 @@
 
 import collections
 import io
+import random
 
 import pytest
 
@@ -95,3 +96,59 @@ def test_load_from_yaml():
     assert chain == ['AtoB']
     with pytest.raises(ValueError):
         transform_graph.TransformGraph.from_yaml('[A, B, C]')
+
+
+def test_shortcuts():
+    tg = transform_graph.TransformGraph.from_yaml(
+        b'{A: {B: AtoB, C: {shortcut: [shift.trm, AtoC.ima]}}, '
+        b'B: {C: BtoC}, C: {}}')
+    # Shortcuts are not part of the chains
+    assert tg.get_transform_chain('A', 'C') == ['AtoB', 'BtoC']
+    assert tg.get_shortcut('A', 'C') == ['shift.trm', 'AtoC.ima']
+    assert tg.get_shortcut('A', 'B') is None
+    assert 'C' not in tg.links['A']
+    assert sorted(tg.iter_transforms()) == ['AtoB', 'AtoC.ima', 'BtoC',
+                                            'shift.trm']
+    for yaml in (b'{A: {B: {shortcut: AtoB}}}', b'{A: {B: {link: [AtoB]}}}',
+                 b'{A: {B: {shortcut: [AtoB], other: 1}}}'):
+        with pytest.raises(ValueError):
+            transform_graph.TransformGraph.from_yaml(yaml)
+
+
+def test_chain_table_matches_reference_search():
+    rng = random.Random(0)
+    for num_spaces in (1, 5, 30):
+        tg = transform_graph.TransformGraph()
+        spaces = ['space{0}'.format(i) for i in range(num_spaces)]
+        for space in spaces:
+            tg.add_space(space)
+        for from_space in spaces:
+            for to_space in rng.sample(spaces, min(3, num_spaces)):
+                if to_space not in tg.links[from_space]:
+                    tg.add_link(from_space, to_space,
+                                '{0}_to_{1}'.format(from_space, to_space))
+        table = tg.get_chain_table()
+        for from_space in spaces:
+            for to_space in spaces:
+                reference = tg._find_transform_chain(from_space, to_space)
+                assert tg.get_transform_chain(from_space,
+                                              to_space) == reference
+                if reference is None:
+                    assert (from_space, to_space) not in table
+                else:
+                    assert table[from_space, to_space] == tuple(reference)
+
+
+def test_chain_table_is_read_only():
+    tg = transform_graph.TransformGraph.from_yaml(b'{A: {B: AtoB}, B: {}}')
+    table = tg.get_chain_table()
+    assert table['A', 'B'] == ('AtoB',)
+    with pytest.raises(TypeError):
+        table['B', 'A'] = ('BtoA',)
+    # Modifying a returned chain does not affect the table
+    tg.get_transform_chain('A', 'B').append('garbage')
+    assert tg.get_transform_chain('A', 'B') == ['AtoB']
+    # The table is re-computed when the graph is modified
+    tg.add_link('B', 'A', 'BtoA')
+    assert tg.get_chain_table() is not table
+    assert tg.get_chain_table()['B', 'A'] == ('BtoA',)
@@ -0,0 +1,149 @@
+# Copyright 2019–2020 CEA
+#
+# Author: Yann Leprince <yann.leprince@cea.fr>
+#
+# Licensed under the Apache Licence, Version 2.0 (the "Licence");
+# you may not use this file except in compliance with the Licence.
+# You may obtain a copy of the Licence at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the Licence is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the Licence for the specific language governing permissions and
+# limitations under the Licence.
+
+import os
+import sys
+import threading
+import types
+
+import numpy as np
+import pytest
+
+import hbp_spatial_backend
+from hbp_spatial_backend import api_v1
+from hbp_spatial_backend import apply_transform
+from hbp_spatial_backend import field_store
+from hbp_spatial_backend import gunicorn_config
+from hbp_spatial_backend import numpy_transform
+from hbp_spatial_backend import warmup
+
+
+@pytest.fixture
+def graph_yaml(tmpdir):
+    with open(str(tmpdir / 'shift.trm'), 'w') as f:
+        f.write('1 2 3\n1 0 0\n0 1 0\n0 0 1\n')
+    numpy_transform.write_gis_field(str(tmpdir / 'field.ima'),
+                                    np.zeros((4, 5, 6, 3)), (1, 1, 1))
+    path = str(tmpdir / 'graph.yaml')
+    with open(path, 'w') as f:
+        f.write('{A: {B: shift.trm}, B: {A: inv:shift.trm, C: field.ima}, '
+                'C: {B: missing.ima}}')
+    yield path
+    api_v1.clear_transform_graph_cache()
+
+
+@pytest.fixture
+def make_warm_up_app(graph_yaml):
+    def make_warm_up_app():
+        return hbp_spatial_backend.create_app({
+            'TESTING': True,
+            'WARM_UP': True,
+            'DEFAULT_TRANSFORM_GRAPH': graph_yaml,
+            'TRANSFORM_ENGINE': 'numpy',
+        })
+    return make_warm_up_app
+
+
+@pytest.fixture
+def warm_up_app(make_warm_up_app):
+    app = make_warm_up_app()
+    app.extensions['hbp_spatial_backend.warm_up'].thread.join(5)
+    return app
+
+
+def test_health_reports_warm_up(make_warm_up_app, monkeypatch):
+    proceed = threading.Event()
+    monkeypatch.setattr(warmup, 'warm_up', lambda: proceed.wait(5))
+    app = make_warm_up_app()
+    # The warm-up is started with the application, before any request
+    state = app.extensions['hbp_spatial_backend.warm_up']
+    assert state.thread.is_alive()
+    with app.test_client() as client:
+        response = client.get('/health')
+        assert response.status_code == 503
+        assert response.data == b'warming up'
+        proceed.set()
+        state.thread.join(5)
+        response = client.get('/health')
+        assert response.status_code == 200
+
+
+def test_health_reports_failed_warm_up(make_warm_up_app, monkeypatch):
+    def failing_warm_up():
+        raise RuntimeError('cannot load the graph')
+    monkeypatch.setattr(warmup, 'warm_up', failing_warm_up)
+    app = make_warm_up_app()
+    state = app.extensions['hbp_spatial_backend.warm_up']
+    state.thread.join(5)
+    assert not warmup.is_ready(app)
+    assert warmup.ensure_started(app) is state
+    with app.test_client() as client:
+        response = client.get('/health')
+        assert response.status_code == 503
+        assert b'warm-up failed' in response.data
+        assert b'cannot load the graph' in response.data
+
+
+def test_gunicorn_post_worker_init(make_warm_up_app, monkeypatch):
+    monkeypatch.setitem(sys.modules, 'gunicorn', types.ModuleType('gunicorn'))
+    # The application may be created in the gunicorn master (--preload)...
+    app = make_warm_up_app()
+    assert 'hbp_spatial_backend.warm_up' not in app.extensions
+    # ... so the warm-up is started by the hook in every worker
+    gunicorn_config.post_worker_init(types.SimpleNamespace(wsgi=app))
+    state = app.extensions['hbp_spatial_backend.warm_up']
+    state.thread.join(5)
+    assert warmup.is_ready(app)
+
+
+def test_warm_up_restarts_after_fork(warm_up_app):
+    state = warmup.ensure_started(warm_up_app)
+    assert warmup.ensure_started(warm_up_app) is state
+    state.thread.join(5)
+    # Simulate a state that was inherited from a parent process
+    state.pid = -1
+    new_state = warmup.ensure_started(warm_up_app)
+    assert new_state is not state
+    new_state.thread.join(5)
+    assert warmup.is_ready(warm_up_app)
+
+
+def test_warm_up(warm_up_app, graph_yaml, monkeypatch, caplog):
+    calls = []
+
+    def transform_points_mock(source_points, chain, cwd=None):
+        calls.append(chain)
+        return source_points
+    monkeypatch.setattr(apply_transform, 'transform_points',
+                        transform_points_mock)
+    field_path = os.path.join(os.path.dirname(graph_yaml), 'field.ima')
+    field_store.default_store.clear()
+
+    with warm_up_app.app_context():
+        warmup.warm_up()
+    assert len(field_store.default_store) == 1
+    assert field_store.default_store.stats()['fields'][0]['path'] == (
+        os.path.abspath(field_path))
+    assert 'missing.ima' in caplog.text
+    assert calls == []
+
+    warm_up_app.config['WARM_UP_CANARY'] = True
+    with warm_up_app.app_context():
+        warmup.warm_up()
+    # One canary transformation per pair of distinct connected spaces
+    assert len(calls) == 6
+    assert ['shift.trm', 'field.ima'] in calls
+    field_store.default_store.clear()